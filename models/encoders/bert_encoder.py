@@ -1,11 +1,15 @@
-from typing import List
+from typing import List, Dict
 
 import torch.nn as nn
 import logging
+import threading
 import warnings
 import torch
 from transformers import AutoModel, AutoTokenizer
 
+from utils.batching import token_budget_batches, pad_token_ids
+from utils.token_store import TokenStore
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -16,32 +20,183 @@ device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cp
 
 
 class BERTEncoder(nn.Module):
-    def __init__(self, config_name_or_path):
+    def __init__(self, config_name_or_path, max_tokens: int = None, packed: bool = False, pack_length: int = 128, token_store_path: str = None):
+        """
+        :param max_tokens: if set, sentences are sorted by length and encoded in sub-batches of at most `max_tokens`
+            (padded) tokens each. Otherwise, all sentences are encoded in a single batch.
+        :param packed: if set, several sentences are packed in each row of `pack_length` tokens, with a block-diagonal
+            attention mask and per-sentence position ids.
+        :param token_store_path: root of a pre-tokenized corpus store (see `utils.token_store`). Sentences found in the
+            store are not tokenized again.
+        """
         super(BERTEncoder, self).__init__()
         logger.info(f"Loading Encoder @ {config_name_or_path}")
         self.tokenizer = AutoTokenizer.from_pretrained(config_name_or_path)
         self.bert = AutoModel.from_pretrained(config_name_or_path).to(device)
         logger.info(f"Encoder loaded.")
         self.warmed: bool = False
+        self.max_length = 64
+        self.max_tokens = max_tokens
+        self.packed = packed
+        self.pack_length = pack_length
+        assert self.pack_length >= self.max_length
+        self.padding_stats = {"n_tokens": 0, "n_slots": 0}
+        self.token_store: TokenStore = TokenStore.load(token_store_path, self.tokenizer) if token_store_path else None
+        # Sentences may be tokenized by episode prefetching threads, and fast tokenizers are not thread-safe
+        self.tokenizer_lock = threading.Lock()
+
+    def tokenize(self, sentences: List[str]) -> List[List[int]]:
+        with self.tokenizer_lock:
+            if self.token_store:
+                return self.token_store.encode(sentences, tokenizer=self.tokenizer, max_length=self.max_length)
+            return self.tokenizer.batch_encode_plus(
+                sentences,
+                max_length=self.max_length,
+                truncation=True,
+                padding=False
+            )["input_ids"]
 
     def embed_sentences(self, sentences: List[str]):
+        if self.max_tokens or self.packed or self.token_store:
+            return self.embed_token_ids(self.tokenize(sentences))
+
         if self.warmed:
             padding = True
         else:
             padding = "max_length"
             self.warmed = True
-        batch = self.tokenizer.batch_encode_plus(
-            sentences,
-            return_tensors="pt",
-            max_length=64,
-            truncation=True,
-            padding=padding
-        )
+        with self.tokenizer_lock:
+            batch = self.tokenizer.batch_encode_plus(
+                sentences,
+                return_tensors="pt",
+                max_length=self.max_length,
+                truncation=True,
+                padding=padding
+            )
         batch = {k: v.to(device) for k, v in batch.items()}
+        self.padding_stats["n_tokens"] += batch["attention_mask"].sum().item()
+        self.padding_stats["n_slots"] += batch["attention_mask"].numel()
 
         fw = self.bert.forward(**batch)
         return fw.pooler_output
 
+    def embed_token_ids(self, token_ids: List[List[int]]):
+        """
+        Encodes already tokenized sentences, in sub-batches of at most `self.max_tokens` tokens.
+        Pooled outputs are returned in the order of `token_ids`.
+        """
+        if self.packed:
+            return self.embed_packed(token_ids)
+
+        if not self.max_tokens:
+            return self.forward_padded(token_ids)
+
+        batches = token_budget_batches([len(ids) for ids in token_ids], max_tokens=self.max_tokens)
+        pooled = torch.cat([self.forward_padded([token_ids[ix] for ix in batch]) for batch in batches])
+
+        # Scatter back to the original order
+        order = torch.tensor([ix for batch in batches for ix in batch], device=pooled.device)
+        return pooled.index_select(0, torch.argsort(order))
+
+    def forward_padded(self, token_ids: List[List[int]]):
+        input_ids, attention_mask = pad_token_ids(token_ids, pad_token_id=self.tokenizer.pad_token_id)
+        self.padding_stats["n_tokens"] += sum([len(ids) for ids in token_ids])
+        self.padding_stats["n_slots"] += input_ids.numel()
+
+        fw = self.bert.forward(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device))
+        return fw.pooler_output
+
+    def embed_packed(self, token_ids: List[List[int]]):
+        # First-fit decreasing: each row holds sentences whose lengths sum up to at most `self.pack_length`
+        rows: List[List[int]] = list()
+        row_lengths: List[int] = list()
+        for ix in sorted(range(len(token_ids)), key=lambda ix: -len(token_ids[ix])):
+            for row_ix, row_length in enumerate(row_lengths):
+                if row_length + len(token_ids[ix]) <= self.pack_length:
+                    rows[row_ix].append(ix)
+                    row_lengths[row_ix] += len(token_ids[ix])
+                    break
+            else:
+                rows.append([ix])
+                row_lengths.append(len(token_ids[ix]))
+
+        rows_per_batch = max(1, self.max_tokens // self.pack_length) if self.max_tokens else len(rows)
+        pooled = torch.cat([
+            self.forward_packed([[token_ids[ix] for ix in row] for row in rows[i:i + rows_per_batch]])
+            for i in range(0, len(rows), rows_per_batch)
+        ])
+
+        # Scatter back to the original order
+        order = torch.tensor([ix for row in rows for ix in row], device=pooled.device)
+        return pooled.index_select(0, torch.argsort(order))
+
+    def forward_packed(self, rows: List[List[List[int]]]):
+        """
+        :param rows: for each row, token ids of the sentences packed in this row
+        :return: pooled output of each sentence, in row-major order
+        """
+        # RoBERTa-like models start position ids after the padding index
+        position_offset = getattr(self.bert.embeddings, "padding_idx", -1) + 1
+
+        row_length = max([sum([len(ids) for ids in row]) for row in rows])
+        input_ids = torch.full((len(rows), row_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        position_ids = torch.zeros((len(rows), row_length), dtype=torch.long)
+        segment_ids = torch.full((len(rows), row_length), -1, dtype=torch.long)
+        cls_row, cls_position = list(), list()
+        for row_ix, row in enumerate(rows):
+            start = 0
+            for segment_ix, ids in enumerate(row):
+                end = start + len(ids)
+                input_ids[row_ix, start:end] = torch.tensor(ids, dtype=torch.long)
+                position_ids[row_ix, start:end] = torch.arange(position_offset, position_offset + len(ids))
+                segment_ids[row_ix, start:end] = segment_ix
+                cls_row.append(row_ix)
+                cls_position.append(start)
+                start = end
+
+        # Block-diagonal attention: a token only attends to tokens of the same sentence
+        attention_mask = ((segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)) & (segment_ids.unsqueeze(2) >= 0)).long()
+        self.padding_stats["n_tokens"] += int((segment_ids >= 0).sum().item())
+        self.padding_stats["n_slots"] += segment_ids.numel()
+
+        fw = self.bert.forward(
+            input_ids=input_ids.to(device),
+            attention_mask=attention_mask.to(device),
+            position_ids=position_ids.to(device)
+        )
+        cls_hidden_states = fw.last_hidden_state[torch.tensor(cls_row, device=device), torch.tensor(cls_position, device=device)]
+        return self.bert.pooler.activation(self.bert.pooler.dense(cls_hidden_states))
+
+    def check_packing(self, sentences: List[str]) -> float:
+        """
+        Encodes `sentences` with and without packing (dropout disabled).
+        :return: max absolute difference between both pooled outputs
+        """
+        was_training, packed = self.training, self.packed
+        self.eval()
+        try:
+            token_ids = self.tokenize(sentences)
+            with torch.no_grad():
+                self.packed = True
+                z_packed = self.embed_token_ids(token_ids)
+                self.packed = False
+                z_unpacked = self.embed_token_ids(token_ids)
+        finally:
+            self.packed = packed
+            self.train(was_training)
+            self.pop_padding_stats()
+        return (z_packed - z_unpacked).abs().max().item()
+
+    def pop_padding_stats(self) -> Dict[str, float]:
+        """
+        :return: share of padding tokens in the batches encoded since the last call
+        """
+        stats = dict()
+        if self.padding_stats["n_slots"]:
+            stats["padding_ratio"] = 1 - self.padding_stats["n_tokens"] / self.padding_stats["n_slots"]
+        self.padding_stats = {"n_tokens": 0, "n_slots": 0}
+        return stats
+
 
 def test():
     encoder = BERTEncoder("bert-base-cased")
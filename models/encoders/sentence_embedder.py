@@ -0,0 +1,82 @@
+import threading
+import logging
+from typing import List
+
+import numpy as np
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class SentenceEmbedder:
+    """
+    Embeds batches of sentences. `embedder_id` identifies the embeddings an embedder outputs (model, pooling...): two
+    embedders with the same id output interchangeable embeddings.
+    """
+    embedder_id: str = None
+
+    def embed_many(self, sentences: List[str]) -> np.ndarray:
+        """
+        :return: embeddings (n_sentences x dim)
+        """
+        raise NotImplementedError
+
+    def embed_one(self, sentence: str) -> np.ndarray:
+        return self.embed_many([sentence])
+
+
+class CachedSentenceEmbedder(SentenceEmbedder):
+    """
+    Serves embeddings from an `EmbeddingStore`, only calling the wrapped embedder for sentences missing from the store.
+    The store keeps embeddings as output by the wrapped embedder: embeddings served don't depend on what the store
+    already held.
+    """
+
+    def __init__(self, embedder: SentenceEmbedder, store_path: str):
+        """
+        :param store_path: root of the embedding store, shared by embedders (each one has its own directory)
+        """
+        from utils.embedding_store import EmbeddingStore
+
+        if not embedder.embedder_id:
+            raise ValueError(f"{type(embedder).__name__} has no `embedder_id`: its embeddings can't be stored")
+        self.embedder = embedder
+        self.embedder_id = embedder.embedder_id
+        self.store = EmbeddingStore(store_path, embedder.embedder_id)
+
+        self.lock = threading.Lock()
+        self.stats = {"n_hits": 0, "n_misses": 0}
+
+    def embed_many(self, sentences: List[str]) -> np.ndarray:
+        if not len(sentences):
+            return self.embedder.embed_many(sentences)
+        embeddings = self.store.get_many(sentences)
+        n_misses = len([sentence for sentence in sentences if sentence not in embeddings])
+        missing = list(dict.fromkeys([sentence for sentence in sentences if sentence not in embeddings]))
+        if missing:
+            missing_embeddings = np.asarray(self.embedder.embed_many(missing))
+            self.store.add_many(missing, missing_embeddings)
+            embeddings.update(zip(missing, missing_embeddings))
+        with self.lock:
+            self.stats["n_hits"] += len(sentences) - n_misses
+            self.stats["n_misses"] += n_misses
+        return np.stack([embeddings[sentence] for sentence in sentences])
+
+
+def get_sentence_embedder(name_or_path: str = "use", store_path: str = None, **kwargs) -> SentenceEmbedder:
+    """
+    :param name_or_path: `use` (Universal Sentence Encoder, TF-Hub), or a local / HuggingFace encoder (see
+        `models.encoders.torch_embedder.TorchSentenceEmbedder`, which gets `kwargs`)
+    :param store_path: if set, embeddings are persisted in an embedding store there (see `utils.embedding_store`), and
+        only sentences never embedded before are embedded
+    """
+    if name_or_path == "use":
+        from models.use import get_use_embedder
+        embedder = get_use_embedder()
+    else:
+        from models.encoders.torch_embedder import TorchSentenceEmbedder
+        embedder = TorchSentenceEmbedder(name_or_path, **kwargs)
+    if store_path:
+        embedder = CachedSentenceEmbedder(embedder, store_path)
+    return embedder
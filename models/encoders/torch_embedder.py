@@ -0,0 +1,74 @@
+import os
+from typing import List
+
+import numpy as np
+import logging
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+from models.encoders.sentence_embedder import SentenceEmbedder
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+default_device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+
+def model_fingerprint(model_name_or_path: str) -> str:
+    """
+    Identifies the weights of a local checkpoint (path, size and modification time of its files), so that a checkpoint
+    overwritten in place gets a new fingerprint. Hub model names are returned as is.
+    """
+    if not os.path.isdir(model_name_or_path):
+        return model_name_or_path
+    files = [
+        f"{name}:{os.path.getsize(os.path.join(model_name_or_path, name))}:{int(os.path.getmtime(os.path.join(model_name_or_path, name)))}"
+        for name in sorted(os.listdir(model_name_or_path))
+        if os.path.isfile(os.path.join(model_name_or_path, name))
+    ]
+    return f"{os.path.abspath(model_name_or_path)}[{','.join(files)}]"
+
+
+class TorchSentenceEmbedder(SentenceEmbedder):
+    """
+    Frozen sentence encoder loaded from disk (e.g. the few-shot encoder the run starts from), with the same
+    `embed_many` interface as `models.use.USEEmbedder`, but no TF-Hub download.
+    """
+
+    def __init__(self, model_name_or_path: str, device=None, batch_size: int = 64, max_length: int = 64, pooling: str = "mean"):
+        """
+        :param pooling: `mean` (average of the last hidden states over non-padding tokens) or `pooler` (pooler output)
+        """
+        assert pooling in ("mean", "pooler")
+        logger.info(f"Loading sentence embedder @ {model_name_or_path}")
+        self.device = device if device else default_device
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+        self.model = AutoModel.from_pretrained(model_name_or_path).to(self.device).eval()
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.pooling = pooling
+        self.embedder_id = f"torch:{model_fingerprint(model_name_or_path)}:{pooling}:{max_length}"
+
+    def embed_many(self, sentences: List[str]) -> np.ndarray:
+        """
+        :return: embeddings (n_sentences x dim), float32
+        """
+        embeddings = list()
+        with torch.no_grad():
+            for i in range(0, len(sentences), self.batch_size):
+                batch = self.tokenizer.batch_encode_plus(
+                    sentences[i:i + self.batch_size],
+                    return_tensors="pt",
+                    max_length=self.max_length,
+                    truncation=True,
+                    padding=True
+                )
+                batch = {k: v.to(self.device) for k, v in batch.items()}
+                fw = self.model.forward(**batch)
+                if self.pooling == "pooler":
+                    embeddings.append(fw.pooler_output)
+                else:
+                    mask = batch["attention_mask"].unsqueeze(-1).to(fw.last_hidden_state.dtype)
+                    embeddings.append((fw.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1))
+        return torch.cat(embeddings).float().cpu().numpy()
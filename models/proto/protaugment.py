@@ -4,25 +4,24 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 
 import json
 import argparse
+import os
+
+# transformers imports TensorFlow (installed for USE) at import time unless told otherwise: models here are torch ones.
+# TensorFlow is only loaded if the USE embedder is needed (see `models.use.get_use_embedder`)
+os.environ.setdefault("USE_TORCH", "1")
 
 from transformers import AutoTokenizer
 
 from models.encoders.bert_encoder import BERTEncoder
-from paraphrase.modeling import (
-    UnigramRandomDropParaphraseBatchPreparer,
-    DBSParaphraseModel,
-    BigramDropParaphraseBatchPreparer,
-    BaseParaphraseBatchPreparer,
-    EDAParaphraseModel
-)
+from paraphrase.service import ParaphraseService, build_paraphrase_model
 from paraphrase.utils.data import FewShotDataset, FewShotSSLParaphraseDataset, FewShotSSLFileDataset
-from utils.data import get_jsonl_data, FewShotDataLoader
-from utils.python import now, set_seeds
+from utils.data import get_jsonl_data, get_txt_data, FewShotDataLoader
+from utils.python import now, set_seeds, get_torch_rng_state, set_torch_rng_state
+from utils.prefetch import EpisodePrefetcher
 import random
 import collections
-import os
-from typing import List, Dict, Callable, Union
-from tensorboardX import SummaryWriter
+import time
+from typing import List, Dict, Callable, Union, Tuple
 import numpy as np
 import torch
 import torch.nn as nn
@@ -49,6 +48,42 @@ class ProtAugmentNet(nn.Module):
         self.metric = metric
         assert self.metric in ('euclidean', 'cosine')
 
+    def distances(self, z_query: torch.Tensor, z_prototypes: torch.Tensor) -> torch.Tensor:
+        if self.metric == "euclidean":
+            return euclidean_dist(z_query, z_prototypes)
+        elif self.metric == "cosine":
+            return (-cosine_similarity(z_query, z_prototypes) + 1) * 5
+        else:
+            raise NotImplementedError
+
+    def supervised_loss(self, z_support: torch.Tensor, z_query: torch.Tensor):
+        """
+        :param z_support: prototypes, n_class x z_dim
+        :param z_query: query embeddings, grouped by class, (n_class * n_query) x z_dim
+        :return: loss, loss_dict (same format as `loss` on a regular meta-learning episode)
+        """
+        n_class = z_support.size(0)
+        n_query = z_query.size(0) // n_class
+
+        target_inds = torch.arange(0, n_class).view(n_class, 1, 1).expand(n_class, n_query, 1).long()
+        target_inds = Variable(target_inds, requires_grad=False).to(device)
+
+        supervised_dists = self.distances(z_query, z_support)
+
+        from torch.nn import CrossEntropyLoss
+        supervised_loss = CrossEntropyLoss()(-supervised_dists, target_inds.reshape(-1))
+        _, y_hat_supervised = (-supervised_dists).max(1)
+        acc_val_supervised = torch.eq(y_hat_supervised, target_inds.reshape(-1)).float().mean()
+
+        return supervised_loss, {
+            "metrics": {
+                "acc": acc_val_supervised.item(),
+                "loss": supervised_loss.item(),
+            },
+            "dists": supervised_dists,
+            "target": target_inds
+        }
+
     def loss(self, sample, supervised_loss_share: float = 0):
         """
         :param supervised_loss_share: share of supervised loss in total loss
@@ -74,6 +109,25 @@ class ProtAugmentNet(nn.Module):
         }
         :return:
         """
+        z = self.encoder.embed_sentences(self.episode_texts(sample))
+        return self.loss_from_embeddings(sample, z, supervised_loss_share=supervised_loss_share)
+
+    @staticmethod
+    def episode_texts(sample) -> List[str]:
+        """
+        :return: texts of `sample` to encode, in the order expected by `loss_from_embeddings`: supports, queries, then
+            (if any) augmentations of each unlabeled text, followed by the unlabeled texts themselves
+        """
+        x = [item["sentence"] for xs_ in sample["xs"] for item in xs_] + [item["sentence"] for xq_ in sample["xq"] for item in xq_]
+        if "x_augment" in sample:
+            x += [item2 for item1 in sample["x_augment"] for item2 in item1["tgt_texts"]]
+            x += [item["src_text"] for item in sample["x_augment"]]
+        return x
+
+    def loss_from_embeddings(self, sample, z: torch.Tensor, supervised_loss_share: float = 0):
+        """
+        :param z: embeddings of `self.episode_texts(sample)`
+        """
         xs = sample['xs']  # support
         xq = sample['xq']  # query
 
@@ -81,125 +135,204 @@ class ProtAugmentNet(nn.Module):
         assert len(xq) == n_class
         n_support = len(xs[0])
         n_query = len(xq[0])
+        n_supports = n_class * n_support
+        n_queries = n_class * n_query
+        z_dim = z.size(-1)
 
         target_inds = torch.arange(0, n_class).view(n_class, 1, 1).expand(n_class, n_query, 1).long()
         target_inds = Variable(target_inds, requires_grad=False).to(device)
 
+        # Dispatch
+        z_support = z[:n_supports].view(n_class, n_support, z_dim).mean(dim=[1])
+        z_query = z[n_supports:n_supports + n_queries]
+
         # x_augment is not always present in `sample`
         # Indeed, at evaluation / test time, the network is judged on a regular meta-learning episode (i.e. only samples and query points)
-        has_augment = "x_augment" in sample
-
-        if has_augment:
-            augmentations = sample["x_augment"]
-
-            n_augmentations_samples = len(sample["x_augment"])
-            n_augmentations_per_sample = [len(item['tgt_texts']) for item in augmentations]
-            assert len(set(n_augmentations_per_sample)) == 1
-            n_augmentations_per_sample = n_augmentations_per_sample[0]
-
-            supports = [item["sentence"] for xs_ in xs for item in xs_]
-            queries = [item["sentence"] for xq_ in xq for item in xq_]
-            augmentations_supports = [[item2 for item2 in item["tgt_texts"]] for item in sample["x_augment"]]
-            augmentation_queries = [item["src_text"] for item in sample["x_augment"]]
-
-            # Encode
-            x = supports + queries + [item2 for item1 in augmentations_supports for item2 in item1] + augmentation_queries
-            z = self.encoder.embed_sentences(x)
-            z_dim = z.size(-1)
-
-            # Dispatch
-            z_support = z[:len(supports)].view(n_class, n_support, z_dim).mean(dim=[1])
-            z_query = z[len(supports):len(supports) + len(queries)]
-            z_aug_support = (z[len(supports) + len(queries):len(supports) + len(queries) + n_augmentations_per_sample * n_augmentations_samples]
-                             .view(n_augmentations_samples, n_augmentations_per_sample, z_dim).mean(dim=[1]))
-            z_aug_query = z[-len(augmentation_queries):]
-        else:
-            # When not using augmentations
-            supports = [item["sentence"] for xs_ in xs for item in xs_]
-            queries = [item["sentence"] for xq_ in xq for item in xq_]
+        if "x_augment" not in sample:
+            return self.supervised_loss(z_support, z_query)
 
-            # Encode
-            x = supports + queries
-            z = self.encoder.embed_sentences(x)
-            z_dim = z.size(-1)
+        augmentations = sample["x_augment"]
 
-            # Dispatch
-            z_support = z[:len(supports)].view(n_class, n_support, z_dim).mean(dim=[1])
-            z_query = z[len(supports):len(supports) + len(queries)]
+        n_augmentations_samples = len(sample["x_augment"])
+        n_augmentations_per_sample = [len(item['tgt_texts']) for item in augmentations]
+        assert len(set(n_augmentations_per_sample)) == 1
+        n_augmentations_per_sample = n_augmentations_per_sample[0]
 
-        if self.metric == "euclidean":
-            supervised_dists = euclidean_dist(z_query, z_support)
-            if has_augment:
-                unsupervised_dists = euclidean_dist(z_aug_query, z_aug_support)
-        elif self.metric == "cosine":
-            supervised_dists = (-cosine_similarity(z_query, z_support) + 1) * 5
-            if has_augment:
-                unsupervised_dists = (-cosine_similarity(z_aug_query, z_aug_support) + 1) * 5
-        else:
-            raise NotImplementedError
+        z_aug_support = (z[n_supports + n_queries:n_supports + n_queries + n_augmentations_per_sample * n_augmentations_samples]
+                         .view(n_augmentations_samples, n_augmentations_per_sample, z_dim).mean(dim=[1]))
+        z_aug_query = z[-n_augmentations_samples:]
+
+        supervised_dists = self.distances(z_query, z_support)
+        unsupervised_dists = self.distances(z_aug_query, z_aug_support)
 
         from torch.nn import CrossEntropyLoss
         supervised_loss = CrossEntropyLoss()(-supervised_dists, target_inds.reshape(-1))
         _, y_hat_supervised = (-supervised_dists).max(1)
         acc_val_supervised = torch.eq(y_hat_supervised, target_inds.reshape(-1)).float().mean()
 
-        if has_augment:
-            # Unsupervised loss
-            unsupervised_target_inds = torch.range(0, n_augmentations_samples - 1).to(device).long()
-            unsupervised_loss = CrossEntropyLoss()(-unsupervised_dists, unsupervised_target_inds)
-            _, y_hat_unsupervised = (-unsupervised_dists).max(1)
-            acc_val_unsupervised = torch.eq(y_hat_unsupervised, unsupervised_target_inds.reshape(-1)).float().mean()
-
-            # Final loss
-            assert 0 <= supervised_loss_share <= 1
-            final_loss = (supervised_loss_share) * supervised_loss + (1 - supervised_loss_share) * unsupervised_loss
-
-            return final_loss, {
-                "metrics": {
-                    "supervised_acc": acc_val_supervised.item(),
-                    "unsupervised_acc": acc_val_unsupervised.item(),
-                    "supervised_loss": supervised_loss.item(),
-                    "unsupervised_loss": unsupervised_loss.item(),
-                    "supervised_loss_share": supervised_loss_share,
-                    "final_loss": final_loss.item(),
-                },
-                "supervised_dists": supervised_dists,
-                "unsupervised_dists": unsupervised_dists,
-                "target": target_inds
-            }
+        # Unsupervised loss
+        unsupervised_target_inds = torch.range(0, n_augmentations_samples - 1).to(device).long()
+        unsupervised_loss = CrossEntropyLoss()(-unsupervised_dists, unsupervised_target_inds)
+        _, y_hat_unsupervised = (-unsupervised_dists).max(1)
+        acc_val_unsupervised = torch.eq(y_hat_unsupervised, unsupervised_target_inds.reshape(-1)).float().mean()
 
-        return supervised_loss, {
+        # Final loss
+        assert 0 <= supervised_loss_share <= 1
+        final_loss = (supervised_loss_share) * supervised_loss + (1 - supervised_loss_share) * unsupervised_loss
+
+        return final_loss, {
             "metrics": {
-                "acc": acc_val_supervised.item(),
-                "loss": supervised_loss.item(),
+                "supervised_acc": acc_val_supervised.item(),
+                "unsupervised_acc": acc_val_unsupervised.item(),
+                "supervised_loss": supervised_loss.item(),
+                "unsupervised_loss": unsupervised_loss.item(),
+                "supervised_loss_share": supervised_loss_share,
+                "final_loss": final_loss.item(),
             },
-            "dists": supervised_dists,
+            "supervised_dists": supervised_dists,
+            "unsupervised_dists": unsupervised_dists,
             "target": target_inds
         }
 
-    def train_step(self, optimizer, episode, supervised_loss_share: float):
+    def grad_cached_backward(self, texts: List, loss_fn: Callable[[torch.Tensor], Tuple[torch.Tensor, Dict]], chunk_size: int, embed_fn: Callable[[List], torch.Tensor] = None):
+        """
+        Computes `loss_fn` on the embeddings of `texts` and back-propagates it to the encoder, holding the autograd graph
+        of at most `chunk_size` texts at a time:
+            1. embeds `texts` chunk by chunk, without graph
+            2. computes the loss and its gradient w/r to the embeddings
+            3. re-embeds each chunk with a graph (same dropout masks) and back-propagates the cached embedding gradients
+        Gradients are the same as back-propagating `loss_fn` on embeddings computed in one pass.
+        :param embed_fn: encodes a chunk of `texts` (defaults to `self.encoder.embed_sentences`). Use
+            `self.encoder.embed_token_ids` when `texts` are already tokenized.
+        """
+        embed_fn = embed_fn if embed_fn else self.encoder.embed_sentences
+        # First-call padding of the encoder would change the dropout masks between both passes
+        self.encoder.warmed = True
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+
+        rng_states = list()
+        with torch.no_grad():
+            z_chunks = list()
+            for chunk in chunks:
+                rng_states.append(get_torch_rng_state())
+                z_chunks.append(embed_fn(chunk))
+        z = torch.cat(z_chunks).detach().requires_grad_()
+
+        loss, loss_dict = loss_fn(z)
+        loss.backward()
+
+        rng_state_after = get_torch_rng_state()
+        for chunk, rng_state, z_grad in zip(chunks, rng_states, z.grad.split([len(chunk) for chunk in chunks])):
+            set_torch_rng_state(rng_state)
+            embed_fn(chunk).backward(gradient=z_grad)
+        set_torch_rng_state(rng_state_after)
+
+        return loss, loss_dict
+
+    def episodes_loss_from_embeddings(self, episodes: List[Dict], z: torch.Tensor, supervised_loss_share: float = 0):
+        """
+        :param z: embeddings of the texts of all `episodes`, concatenated
+        :return: loss averaged over episodes, metrics averaged over episodes
+        """
+        z_episodes = z.split([len(self.episode_texts(episode)) for episode in episodes])
+        if len(episodes) == 1:
+            return self.loss_from_embeddings(episodes[0], z_episodes[0], supervised_loss_share=supervised_loss_share)
+
+        losses = list()
+        metrics = collections.defaultdict(list)
+        for episode, z_episode in zip(episodes, z_episodes):
+            loss, loss_dict = self.loss_from_embeddings(episode, z_episode, supervised_loss_share=supervised_loss_share)
+            losses.append(loss)
+            for key, value in loss_dict["metrics"].items():
+                metrics[key].append(value)
+
+        return torch.stack(losses).mean(), {
+            "metrics": {key: np.mean(value) for key, value in metrics.items()}
+        }
+
+    def prepare_episode(self, episode: Dict) -> Dict:
+        """
+        Tokenizes the texts of `episode` ahead of `train_step` (e.g. in a prefetching thread).
+        Token ids are stored under `episode["token_ids"]`, in the order of `episode_texts`.
+        """
+        episode["token_ids"] = self.encoder.tokenize(self.episode_texts(episode))
+        return episode
+
+    def train_step(self, optimizer, episode, supervised_loss_share: float, grad_cache_chunk_size: int = None):
+        """
+        :param episode: an episode, or a list of episodes (meta-batch). Texts of all episodes are encoded together, then
+            the loss of each episode is computed separately and losses are averaged. Episodes already tokenized by
+            `prepare_episode` are not tokenized again.
+        :param grad_cache_chunk_size: if set, episode texts are encoded by chunks of this size (see `grad_cached_backward`)
+        """
+        episodes = episode if isinstance(episode, list) else [episode]
+        if all(["token_ids" in episode_ for episode_ in episodes]):
+            texts = [token_ids for episode_ in episodes for token_ids in episode_["token_ids"]]
+            embed_fn = self.encoder.embed_token_ids
+        else:
+            texts = [text for episode_ in episodes for text in self.episode_texts(episode_)]
+            embed_fn = self.encoder.embed_sentences
+
+        def loss_fn(z: torch.Tensor):
+            return self.episodes_loss_from_embeddings(episodes, z, supervised_loss_share=supervised_loss_share)
+
         self.train()
         optimizer.zero_grad()
         torch.cuda.empty_cache()
-        loss, loss_dict = self.loss(episode, supervised_loss_share=supervised_loss_share)
-        loss.backward()
+        if grad_cache_chunk_size:
+            loss, loss_dict = self.grad_cached_backward(texts=texts, loss_fn=loss_fn, chunk_size=grad_cache_chunk_size, embed_fn=embed_fn)
+        else:
+            loss, loss_dict = loss_fn(embed_fn(texts))
+            loss.backward()
         optimizer.step()
 
         return loss, loss_dict
 
-    def test_step(self, dataset: FewShotDataset, n_episodes: int = 1000):
+    def embed_dataset(self, dataset: FewShotDataset, batch_size: int = 64) -> torch.Tensor:
+        """
+        Embeds every sentence of `dataset` once.
+        :return: embeddings matrix (n_sentences x z_dim), row `i` being the embedding of `dataset.items[i]`
+        """
+        sentences = dataset.sampler.sentences.tolist()
+        with torch.no_grad():
+            return torch.cat([
+                self.encoder.embed_sentences(sentences[i:i + batch_size])
+                for i in range(0, len(sentences), batch_size)
+            ])
+
+    def embedded_episode_loss(self, episode_indices: Dict[str, torch.Tensor], embeddings: torch.Tensor):
+        n_class, n_support = episode_indices["xs"].shape
+        z_dim = embeddings.size(-1)
+
+        z_support = embeddings.index_select(0, episode_indices["xs"].view(-1).to(embeddings.device)).view(n_class, n_support, z_dim).mean(dim=[1])
+        z_query = embeddings.index_select(0, episode_indices["xq"].view(-1).to(embeddings.device))
+        return self.supervised_loss(z_support, z_query)
+
+    def test_step(self, dataset: FewShotDataset, n_episodes: int = 1000, embed_once: bool = False, embed_batch_size: int = 64):
+        """
+        :param embed_once: if set, embeds every sentence of `dataset` once, then evaluates episodes on those embeddings.
+            Episodes sampled are the same as when `embed_once` is not set.
+        :param embed_batch_size: number of sentences per encoder forward when `embed_once` is set
+        """
         metrics = collections.defaultdict(list)
 
         self.eval()
-        for i in range(n_episodes):
-            episode = dataset.get_episode()
+        if embed_once:
+            embeddings = self.embed_dataset(dataset, batch_size=embed_batch_size)
 
+        for i in range(n_episodes):
             with torch.no_grad():
-                loss, loss_dict = self.loss(episode, supervised_loss_share=1)
+                if embed_once:
+                    loss, loss_dict = self.embedded_episode_loss(dataset.get_episode_indices(), embeddings=embeddings)
+                else:
+                    loss, loss_dict = self.loss(dataset.get_episode(), supervised_loss_share=1)
 
             for k, v in loss_dict["metrics"].items():
                 metrics[k].append(v)
 
+        for k, v in self.encoder.pop_padding_stats().items():
+            metrics[k].append(v)
+
         return {
             key: np.mean(value) for key, value in metrics.items()
         }
@@ -216,6 +349,12 @@ def run_protaugment(
         n_query: int,
         n_classes: int,
         metric: str = "euclidean",
+        encoder_max_tokens: int = None,
+        encoder_packed: bool = False,
+        encoder_pack_length: int = 128,
+
+        # Optional pre-tokenized corpus store
+        token_store_path: str = None,
 
         # Optional path to augmented data
         unlabeled_path: str = None,
@@ -228,6 +367,8 @@ def run_protaugment(
         test_labels_path: str = None,
         evaluate_every: int = 100,
         n_test_episodes: int = 1000,
+        evaluate_embed_once: bool = False,
+        evaluate_batch_size: int = 64,
 
         # Logging & Saving
         output_path: str = f'runs/{now()}',
@@ -236,18 +377,40 @@ def run_protaugment(
         # Training stuff
         max_iter: int = 10000,
         early_stop: int = None,
+        grad_cache_chunk_size: int = None,
+        meta_batch_size: int = 1,
+        prefetch_workers: int = 0,
+        prefetch_depth: int = 2,
+        prefetch_seed: int = 42,
 
         # Augmentation & paraphrase
         n_unlabeled: int = 5,
+        unlabeled_without_replacement: bool = False,
         paraphrase_model_name_or_path: str = None,
         paraphrase_tokenizer_name_or_path: str = None,
         paraphrase_num_beams: int = None,
         paraphrase_beam_group_size: int = None,
         paraphrase_diversity_penalty: float = None,
         paraphrase_filtering_strategy: str = None,
+        paraphrase_clustering_embedder_name_or_path: str = None,
+        paraphrase_clustering_embedding_store_path: str = None,
+        paraphrase_restricted_vocabulary_path: str = None,
+        paraphrase_device: str = None,
+        paraphrase_quantize: bool = False,
         paraphrase_drop_strategy: str = None,
         paraphrase_drop_chance_speed: str = None,
         paraphrase_drop_chance_auc: float = None,
+        paraphrase_cache_path: str = None,
+        paraphrase_cache_samples: int = 4,
+        paraphrase_cache_refresh_prob: float = 0.25,
+        paraphrase_cache_max_entries: int = 1000000,
+        paraphrase_workers: int = 0,
+        paraphrase_threads: int = None,
+        paraphrase_lookahead: int = 1,
+        paraphrase_eda_synonyms_path: str = None,
+        paraphrase_eda_workers: int = 0,
+        paraphrase_eda_random_synonym_insertion: bool = False,
+        encoder_threads: int = None,
         supervised_loss_share_fn: Callable[[int, int], float] = lambda x, y: 1 - (x / y),
 
         paraphrase_generation_method: str = None,
@@ -261,6 +424,7 @@ def run_protaugment(
     # --------------------
     # Creating Log Writers
     # --------------------
+    from tensorboardX import SummaryWriter
     os.makedirs(output_path)
     os.makedirs(os.path.join(output_path, "logs/train"))
     train_writer: SummaryWriter = SummaryWriter(logdir=os.path.join(output_path, "logs/train"), flush_secs=1, max_queue=1)
@@ -271,7 +435,15 @@ def run_protaugment(
     # ----------
     # Load model
     # ----------
-    bert = BERTEncoder(model_name_or_path).to(device)
+    if encoder_threads:
+        torch.set_num_threads(encoder_threads)
+    bert = BERTEncoder(
+        model_name_or_path,
+        max_tokens=encoder_max_tokens,
+        packed=encoder_packed,
+        pack_length=encoder_pack_length,
+        token_store_path=token_store_path
+    ).to(device)
     protonet: ProtAugmentNet = ProtAugmentNet(encoder=bert, metric=metric)
     optimizer = torch.optim.Adam(protonet.parameters(), lr=2e-5)
 
@@ -288,45 +460,65 @@ def run_protaugment(
             n_query=n_query,
             n_unlabeled=n_unlabeled,
             unlabeled_file_path=augmentation_data_path,
+            unlabeled_replace=not unlabeled_without_replacement
         )
 
     else:
-        if paraphrase_generation_method:
-            if paraphrase_generation_method == "eda":
-                paraphrase_model = EDAParaphraseModel(num_paraphrases=5)
-            else:
-                raise NotImplementedError(f"--paraphrase-generation-method `{paraphrase_generation_method}` not recognised.")
-
-        else:
-            # ---------------------
-            # Load paraphrase model
-            # ---------------------
-            paraphrase_model_device = torch.device("cpu") if "20newsgroup" in data_path else torch.device("cuda")
-            logger.info(f"Paraphrase model device: {paraphrase_model_device}")
-            paraphrase_tokenizer = AutoTokenizer.from_pretrained(paraphrase_tokenizer_name_or_path)
-            if paraphrase_drop_strategy == "unigram":
-                paraphrase_batch_preparer = UnigramRandomDropParaphraseBatchPreparer(
-                    tokenizer=paraphrase_tokenizer,
-                    auc=paraphrase_drop_chance_auc,
-                    drop_chance_speed=paraphrase_drop_chance_speed,
-                    device=paraphrase_model_device
-                )
-            elif paraphrase_drop_strategy == "bigram":
-                paraphrase_batch_preparer = BigramDropParaphraseBatchPreparer(tokenizer=paraphrase_tokenizer, device=paraphrase_model_device)
-            else:
-                paraphrase_batch_preparer = BaseParaphraseBatchPreparer(tokenizer=paraphrase_tokenizer, device=paraphrase_model_device)
-
-            paraphrase_model = DBSParaphraseModel(
+        if paraphrase_generation_method and paraphrase_generation_method != "eda":
+            raise NotImplementedError(f"--paraphrase-generation-method `{paraphrase_generation_method}` not recognised.")
+
+        # ---------------------
+        # Load paraphrase model
+        # ---------------------
+        if paraphrase_filtering_strategy == "clustering" and not paraphrase_clustering_embedder_name_or_path:
+            # Candidates are embedded by a frozen copy of the encoder the run starts from
+            paraphrase_clustering_embedder_name_or_path = model_name_or_path
+        paraphrase_spec = {"generation_method": paraphrase_generation_method if paraphrase_generation_method else "dbs"}
+        if not paraphrase_generation_method:
+            paraphrase_spec["model"] = dict(
                 model_name_or_path=paraphrase_model_name_or_path,
                 tok_name_or_path=paraphrase_tokenizer_name_or_path,
                 num_beams=paraphrase_num_beams,
                 beam_group_size=paraphrase_beam_group_size,
                 diversity_penalty=paraphrase_diversity_penalty,
                 filtering_strategy=paraphrase_filtering_strategy,
-                paraphrase_batch_preparer=paraphrase_batch_preparer,
-                device=paraphrase_model_device
+                drop_strategy=paraphrase_drop_strategy,
+                drop_chance_speed=paraphrase_drop_chance_speed,
+                drop_chance_auc=paraphrase_drop_chance_auc,
+                device=paraphrase_device if paraphrase_device else ("cpu" if "20newsgroup" in data_path else "auto"),
+                token_store_path=token_store_path,
+                clustering_embedder_name_or_path=paraphrase_clustering_embedder_name_or_path,
+                clustering_embedding_store_path=paraphrase_clustering_embedding_store_path,
+                restricted_vocabulary_path=paraphrase_restricted_vocabulary_path,
+                quantize=paraphrase_quantize
+            )
+        elif paraphrase_generation_method == "eda":
+            if paraphrase_eda_synonyms_path and not os.path.exists(paraphrase_eda_synonyms_path):
+                from paraphrase.eda import SynonymIndex
+                # WordNet is queried once for the vocabulary of the texts to augment, for all runs on this dataset
+                sentences = get_txt_data(unlabeled_path) if unlabeled_path else [item["sentence"] for item in get_jsonl_data(train_path if train_path else data_path)]
+                SynonymIndex.build(sentences).save(paraphrase_eda_synonyms_path)
+            paraphrase_spec["model"] = dict(
+                num_paraphrases=5,
+                synonyms_path=paraphrase_eda_synonyms_path,
+                n_workers=paraphrase_eda_workers,
+                random_synonym_insertion=paraphrase_eda_random_synonym_insertion
+            )
+        if paraphrase_cache_path:
+            # Paraphrases are stored on disk, and shared by all runs using the same generation config
+            paraphrase_spec["cache"] = dict(
+                path=paraphrase_cache_path,
+                max_samples=paraphrase_cache_samples,
+                max_entries=paraphrase_cache_max_entries,
+                refresh_prob=paraphrase_cache_refresh_prob
             )
 
+        if paraphrase_workers:
+            # Paraphrases are generated in worker processes, ahead of the episodes that need them
+            paraphrase_model = ParaphraseService(paraphrase_spec, n_workers=paraphrase_workers, n_threads=paraphrase_threads)
+        else:
+            paraphrase_model = build_paraphrase_model(paraphrase_spec)
+
         train_dataset = FewShotSSLParaphraseDataset(
             data_path=train_path if train_path else data_path,
             labels_path=train_labels_path,
@@ -335,10 +527,20 @@ def run_protaugment(
             n_query=n_query,
             n_unlabeled=n_unlabeled,
             unlabeled_file_path=unlabeled_path,
-            paraphrase_model=paraphrase_model
+            paraphrase_model=paraphrase_model,
+            unlabeled_replace=not unlabeled_without_replacement,
+            paraphrase_lookahead=paraphrase_lookahead
         )
     logger.info(f"Train dataset has {len(train_dataset)} items")
 
+    if encoder_packed:
+        # Make sure packed sequences are encoded the same way as unpacked ones
+        check_sentences = [item["sentence"] for items in train_dataset.data.values() for item in items][:64]
+        max_diff = bert.check_packing(check_sentences)
+        logger.info(f"Packed vs. unpacked encoder max abs. difference: {max_diff:.2e}")
+        if max_diff > 1e-3:
+            raise ValueError(f"Packed encoder does not match the unpacked one (max abs. difference: {max_diff:.2e})")
+
     # ---------
     # Load data
     # ---------
@@ -365,14 +567,39 @@ def run_protaugment(
     n_eval_since_last_best = 0
     best_valid_acc = 0.0
 
+    prefetcher: EpisodePrefetcher = None
+    if prefetch_workers:
+        # Episodes are sampled, paraphrased and tokenized in background threads
+        prefetcher = EpisodePrefetcher(
+            produce_fn=lambda rng: [protonet.prepare_episode(episode) for episode in train_dataset.get_episodes(meta_batch_size, rng=rng)],
+            n_workers=prefetch_workers,
+            depth=prefetch_depth,
+            seed=prefetch_seed
+        )
+
     for step in range(max_iter):
-        episode = train_dataset.get_episode()
+        step_start = time.time()
+        episodes = prefetcher.get() if prefetcher else train_dataset.get_episodes(meta_batch_size)
 
         supervised_loss_share = supervised_loss_share_fn(step, max_iter)
-        loss, loss_dict = protonet.train_step(optimizer=optimizer, episode=episode, supervised_loss_share=supervised_loss_share)
+        loss, loss_dict = protonet.train_step(
+            optimizer=optimizer,
+            episode=episodes,
+            supervised_loss_share=supervised_loss_share,
+            grad_cache_chunk_size=grad_cache_chunk_size
+        )
+        train_metrics["episodes_per_sec"].append(meta_batch_size / (time.time() - step_start))
 
         for key, value in loss_dict["metrics"].items():
             train_metrics[key].append(value)
+        for key, value in bert.pop_padding_stats().items():
+            train_metrics[key].append(value)
+        if prefetcher:
+            for key, value in prefetcher.pop_metrics().items():
+                train_metrics[key].append(value)
+        if hasattr(getattr(train_dataset, "paraphrase_model", None), "pop_stats"):
+            for key, value in train_dataset.paraphrase_model.pop_stats().items():
+                train_metrics[key].append(value)
 
         # Logging
         if (step + 1) % log_every == 0:
@@ -404,7 +631,9 @@ def run_protaugment(
 
                         set_results = protonet.test_step(
                             dataset=set_dataset,
-                            n_episodes=n_test_episodes
+                            n_episodes=n_test_episodes,
+                            embed_once=evaluate_embed_once,
+                            embed_batch_size=evaluate_batch_size
                         )
 
                         for key, val in set_results.items():
@@ -434,6 +663,11 @@ def run_protaugment(
                     logger.warning(f"Early-stopping.")
                     break
 
+    if prefetcher:
+        prefetcher.close()
+    if hasattr(getattr(train_dataset, "paraphrase_model", None), "close"):
+        train_dataset.paraphrase_model.close()
+
     with open(os.path.join(output_path, 'metrics.json'), "w") as file:
         json.dump(log_dict, file, ensure_ascii=False)
 
@@ -450,12 +684,18 @@ def main():
     parser.add_argument("--n-query", type=int, default=5, help="Number of query points for each class")
     parser.add_argument("--n-classes", type=int, default=5, help="Number of classes per episode")
     parser.add_argument("--metric", type=str, default="euclidean", help="Distance function to use", choices=("euclidean", "cosine"))
+    parser.add_argument("--encoder-max-tokens", type=int, help="If set, the encoder sorts sentences by length and encodes them in sub-batches of at most this many (padded) tokens")
+    parser.add_argument("--encoder-packed", action="store_true", default=False, help="Pack several sentences per encoder row (block-diagonal attention mask, per-sentence position ids)")
+    parser.add_argument("--encoder-pack-length", type=int, default=128, help="Length of a packed encoder row when --encoder-packed is set")
+    parser.add_argument("--token-store-path", type=str, help="Root of a pre-tokenized corpus store (built with utils/scripts/token_store/build-token-store.py), used by the encoder and the paraphrase model")
 
     # Validation & test
     parser.add_argument("--valid-labels-path", type=str, required=True, help="Path to valid labels. This file contains unique names of labels (i.e. one row per label)")
     parser.add_argument("--test-labels-path", type=str, required=True, help="Path to test labels. This file contains unique names of labels (i.e. one row per label)")
     parser.add_argument("--evaluate-every", type=int, default=100, help="Number of training episodes between each evaluation (on both valid, test)")
     parser.add_argument("--n-test-episodes", type=int, default=1000, help="Number of episodes during evaluation (valid, test)")
+    parser.add_argument("--evaluate-embed-once", action="store_true", default=False, help="Embed every valid/test sentence once per evaluation, then evaluate episodes on those embeddings")
+    parser.add_argument("--evaluate-batch-size", type=int, default=64, help="Number of sentences per encoder forward when --evaluate-embed-once is set")
 
     # Logging & Saving
     parser.add_argument("--output-path", type=str, default=f'runs/{now()}')
@@ -464,10 +704,15 @@ def main():
     # Training stuff
     parser.add_argument("--max-iter", type=int, default=10000, help="Max number of training episodes")
     parser.add_argument("--early-stop", type=int, default=0, help="Number of worse evaluation steps before stopping. 0=disabled")
+    parser.add_argument("--meta-batch-size", type=int, default=1, help="Number of episodes per training step. Their texts are encoded in a single forward, and their losses are averaged")
+    parser.add_argument("--prefetch-workers", type=int, default=0, help="Number of threads preparing (sampling, paraphrasing, tokenizing) training episodes ahead of the training loop. 0=disabled")
+    parser.add_argument("--prefetch-depth", type=int, default=2, help="Number of episodes each prefetching thread prepares ahead")
+    parser.add_argument("--grad-cache-chunk-size", type=int, help="If set, training episodes are encoded by chunks of this many texts, with gradient caching, so that episodes larger than what fits in memory can be used")
 
     # Augmentation & Paraphrase
     parser.add_argument("--unlabeled-path", type=str, help="Path to raw data (one sentence per line), to generate paraphrases from.")
     parser.add_argument("--n-unlabeled", type=int, help="Number of rows to draw from `--unlabeled-path` at each episode", default=5)
+    parser.add_argument("--unlabeled-without-replacement", action="store_true", default=False, help="Draw unlabeled rows of an episode without replacement")
 
     # If you are using a paraphrase generation model
     parser.add_argument("--paraphrase-model-name-or-path", type=str, help="Name or path to the paraphrase model")
@@ -476,9 +721,26 @@ def main():
     parser.add_argument("--paraphrase-beam-group-size", type=int, help="Size of each group of beams")
     parser.add_argument("--paraphrase-diversity-penalty", type=float, help="Diversity penalty (float) to use in Diverse Beam Search")
     parser.add_argument("--paraphrase-filtering-strategy", type=str, choices=["bleu", "clustering"], help="Filtering strategy to apply to a group of generated paraphrases to choose the one to pick. `bleu` takes the sentence which has the highest bleu_score w/r to the original sentence.")
+    parser.add_argument("--paraphrase-clustering-embedder-name-or-path", type=str, help="Local encoder embedding generated paraphrases when --paraphrase-filtering-strategy=clustering. Defaults to --model-name-or-path")
+    parser.add_argument("--paraphrase-clustering-embedding-store-path", type=str, help="If set, embeddings of generated paraphrases (--paraphrase-filtering-strategy=clustering) are persisted there, "
+                                                                                         "and reused across runs with the same embedder")
+    parser.add_argument("--paraphrase-restricted-vocabulary-path", type=str, help="Restricted output vocabulary of the paraphrase model, built with utils/scripts/paraphrase/build-restricted-vocabulary.py. Faster decoding on CPU, paraphrases may differ")
+    parser.add_argument("--paraphrase-device", type=str, help="Device of the paraphrase model: `cpu`, `cuda`, `cuda:<ix>` or `auto` (GPU if available). Defaults to `auto`")
+    parser.add_argument("--paraphrase-quantize", action="store_true", help="Dynamic int8 quantization of the paraphrase model's linear layers (CPU only). Check its outputs with utils/scripts/paraphrase/quantization-quality-check.py")
     parser.add_argument("--paraphrase-drop-strategy", type=str, choices=["bigram", "unigram"], help="Drop strategy to use to contraint the paraphrase generation. If not set, no words are forbidden.")
     parser.add_argument("--paraphrase-drop-chance-speed", type=str, choices=["flat", "down", "up"], help="Curve of drop probability depending on token position in the sentence")
     parser.add_argument("--paraphrase-drop-chance-auc", type=float, help="Area of the drop chance probability w/r to the position in the sentence. When --paraphrase-drop-chance-speed=flat (same chance for all tokens to be forbidden no matter the position in the sentence), this parameter equals to p_{mask}")
+    parser.add_argument("--paraphrase-cache-path", type=str, help="Path to a sqlite paraphrase cache, shared across runs. If set, paraphrases of unlabeled texts are read from / written to it")
+    parser.add_argument("--paraphrase-cache-samples", type=int, default=4, help="Max number of paraphrase generations kept per unlabeled text in the paraphrase cache")
+    parser.add_argument("--paraphrase-cache-refresh-prob", type=float, default=0.25, help="Probability to generate new paraphrases for an unlabeled text already in the cache (keeps paraphrases diverse)")
+    parser.add_argument("--paraphrase-cache-max-entries", type=int, default=1000000, help="Max number of unlabeled texts in the paraphrase cache. Least recently used ones are evicted")
+    parser.add_argument("--paraphrase-workers", type=int, default=0, help="Number of worker processes generating paraphrases asynchronously. 0=paraphrases are generated in the training process")
+    parser.add_argument("--paraphrase-threads", type=int, help="Number of torch threads of each paraphrase worker process")
+    parser.add_argument("--paraphrase-lookahead", type=int, default=1, help="Number of future training steps whose paraphrases are requested in advance to the paraphrase workers")
+    parser.add_argument("--paraphrase-eda-synonyms-path", type=str, help="WordNet synonyms of the dataset vocabulary (.json), used by --paraphrase-generation-method=eda. Built from the unlabeled texts if missing")
+    parser.add_argument("--paraphrase-eda-workers", type=int, default=0, help="Number of processes running EDA on the sentences of a batch in parallel. 0=in the training process (or paraphrase worker)")
+    parser.add_argument("--paraphrase-eda-random-synonym-insertion", action="store_true", default=False, help="EDA random insertion inserts a random synonym of the chosen word, instead of its first synonym (original EDA)")
+    parser.add_argument("--encoder-threads", type=int, help="Number of torch threads of the training process (e.g. to leave cores to paraphrase workers)")
 
     # If you want to use another augmentation technique, e.g. EDA (https://github.com/jasonwei20/eda_nlp/)
     parser.add_argument("--paraphrase-generation-method", type=str, choices=["eda"])
@@ -523,19 +785,31 @@ def main():
         n_query=args.n_query,
         n_classes=args.n_classes,
         metric=args.metric,
+        encoder_max_tokens=args.encoder_max_tokens,
+        encoder_packed=args.encoder_packed,
+        encoder_pack_length=args.encoder_pack_length,
+        token_store_path=args.token_store_path,
 
         valid_labels_path=args.valid_labels_path,
         test_labels_path=args.test_labels_path,
         evaluate_every=args.evaluate_every,
         n_test_episodes=args.n_test_episodes,
+        evaluate_embed_once=args.evaluate_embed_once,
+        evaluate_batch_size=args.evaluate_batch_size,
 
         output_path=args.output_path,
         log_every=args.log_every,
         max_iter=args.max_iter,
         early_stop=args.early_stop,
+        grad_cache_chunk_size=args.grad_cache_chunk_size,
+        meta_batch_size=args.meta_batch_size,
+        prefetch_workers=args.prefetch_workers,
+        prefetch_depth=args.prefetch_depth,
+        prefetch_seed=args.seed,
 
         unlabeled_path=args.unlabeled_path,
         n_unlabeled=args.n_unlabeled,
+        unlabeled_without_replacement=args.unlabeled_without_replacement,
 
         # Paraphrase generation model
         paraphrase_model_name_or_path=args.paraphrase_model_name_or_path,
@@ -543,9 +817,25 @@ def main():
         paraphrase_num_beams=args.paraphrase_num_beams,
         paraphrase_beam_group_size=args.paraphrase_beam_group_size,
         paraphrase_filtering_strategy=args.paraphrase_filtering_strategy,
+        paraphrase_clustering_embedder_name_or_path=args.paraphrase_clustering_embedder_name_or_path,
+        paraphrase_clustering_embedding_store_path=args.paraphrase_clustering_embedding_store_path,
+        paraphrase_restricted_vocabulary_path=args.paraphrase_restricted_vocabulary_path,
+        paraphrase_device=args.paraphrase_device,
+        paraphrase_quantize=args.paraphrase_quantize,
         paraphrase_drop_strategy=args.paraphrase_drop_strategy,
         paraphrase_drop_chance_speed=args.paraphrase_drop_chance_speed,
         paraphrase_drop_chance_auc=args.paraphrase_drop_chance_auc,
+        paraphrase_cache_path=args.paraphrase_cache_path,
+        paraphrase_cache_samples=args.paraphrase_cache_samples,
+        paraphrase_cache_refresh_prob=args.paraphrase_cache_refresh_prob,
+        paraphrase_cache_max_entries=args.paraphrase_cache_max_entries,
+        paraphrase_workers=args.paraphrase_workers,
+        paraphrase_threads=args.paraphrase_threads,
+        paraphrase_lookahead=args.paraphrase_lookahead,
+        paraphrase_eda_synonyms_path=args.paraphrase_eda_synonyms_path,
+        paraphrase_eda_workers=args.paraphrase_eda_workers,
+        paraphrase_eda_random_synonym_insertion=args.paraphrase_eda_random_synonym_insertion,
+        encoder_threads=args.encoder_threads,
         supervised_loss_share_fn=supervised_loss_share_fn,
 
         # Other paraphrase generation method
@@ -1,10 +1,17 @@
+import functools
 import os
 
+from models.encoders.sentence_embedder import SentenceEmbedder
+
+
+class USEEmbedder(SentenceEmbedder):
+    embedder_id = "universal-sentence-encoder/4"
 
-class USEEmbedder:
     def __init__(self, force_cpu=False):
         if force_cpu:
-            os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+            # Hides GPUs from TensorFlow only: torch (and child processes) may already be using them
+            import tensorflow as tf
+            tf.config.set_visible_devices([], "GPU")
         os.environ["TFHUB_CACHE_DIR"] = os.path.join(os.environ["HOME"], ".cache/tfhub")
         import tensorflow_hub as hub
         module_url = "https://tfhub.dev/google/universal-sentence-encoder/4"
@@ -13,8 +20,11 @@ class USEEmbedder:
     def embed_many(self, sentences):
         return self.model(sentences).numpy()
 
-    def embed_one(self, sentence):
-        return self.embed_many([sentence])
-
 
-use_embedder = USEEmbedder(force_cpu=True)
+@functools.lru_cache(maxsize=1)
+def get_use_embedder() -> USEEmbedder:
+    """
+    USE embedder of the process, built on first call: TensorFlow and TF-Hub are only loaded (and the model downloaded) when
+    USE embeddings are actually needed.
+    """
+    return USEEmbedder(force_cpu=True)
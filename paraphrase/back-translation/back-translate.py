@@ -0,0 +1,136 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+from typing import List, Tuple
+
+import torch
+from tqdm import tqdm
+
+from translate import BackTranslator, read_file
+from utils.batching import token_budget_batches
+from utils.sharding import ShardWriter, shard_range, shard_path, merge_shards
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file-in", type=str, required=True, help="Sentences to back-translate, one per line (e.g. raw.txt)")
+    parser.add_argument("--file-out", type=str, required=True, help="Output .jsonl file, one {\"src_text\", \"tgt_texts\"} record per line of --file-in, "
+                                                                     "`tgt_texts` holding one back-translation per pivot, in the order of the pivots")
+    parser.add_argument("--pivot", type=str, nargs=2, action="append", default=[], metavar=("MODEL_NAME_FW", "MODEL_NAME_BW"),
+                        help="Forward and backward translation models of a pivot language. Can be repeated")
+    parser.add_argument("--pivot-language", type=str, action="append", default=[],
+                        help="Pivot language, translated with Helsinki-NLP/opus-mt-<src-language>-<pivot-language> and back. Can be repeated")
+    parser.add_argument("--src-language", type=str, default="en", help="Language of --file-in (see --pivot-language)")
+    parser.add_argument("--max-tokens", type=int, default=4096, help="Max number of (padded) source tokens per batch")
+    parser.add_argument("--batch-size", type=int, default=32, help="Max number of lines per batch")
+    parser.add_argument("--num-workers", type=int, default=1, help="Number of worker processes, each one back-translating a contiguous shard of --file-in with its own models")
+    parser.add_argument("--worker-threads", type=int, help="Number of torch threads of each worker process (CPU translation)")
+    parser.add_argument("--shard-dir", type=str, help="Where shards are written as they are back-translated (defaults to <file-out>.shards). Re-running the same command resumes unfinished shards")
+
+    args = parser.parse_args()
+    assert os.path.exists(args.file_in)
+    assert not os.path.exists(args.file_out)
+    if args.pivot and args.pivot_language:
+        parser.error("--pivot and --pivot-language are mutually exclusive")
+    args.pivots = [tuple(pivot) for pivot in args.pivot] + [
+        (f"Helsinki-NLP/opus-mt-{args.src_language}-{language}", f"Helsinki-NLP/opus-mt-{language}-{args.src_language}")
+        for language in args.pivot_language
+    ]
+    if not args.pivots:
+        parser.error("At least one --pivot or --pivot-language is required")
+    if not args.shard_dir:
+        args.shard_dir = f"{args.file_out}.shards"
+    return args
+
+
+def check_shard_dir(shard_dir: str, pivots: List[Tuple[str, str]], num_workers: int):
+    """
+    Shards only hold complete records, back-translated with all pivots: resuming with other pivots (or another number of
+    workers, i.e. other shard boundaries) would mix incompatible records.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest_path = os.path.join(shard_dir, "pivots.json")
+    manifest = {"pivots": [list(pivot) for pivot in pivots], "num_workers": num_workers}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as file:
+            if json.load(file) != manifest:
+                raise ValueError(f"{shard_dir} was started with other pivots or --num-workers. Delete it, or re-run the same command")
+    else:
+        with open(manifest_path, "w") as file:
+            json.dump(manifest, file)
+
+
+def back_translate_shard(args: argparse.Namespace, shard_ix: int, device: str):
+    lines_in = read_file(args.file_in)
+    start, end = shard_range(len(lines_in), args.num_workers, shard_ix)
+    writer = ShardWriter(shard_path(args.shard_dir, shard_ix, args.num_workers))
+    todo = [ix for ix in range(start, end) if ix not in writer.done]
+    if not todo:
+        writer.close()
+        return
+
+    if args.worker_threads:
+        torch.set_num_threads(args.worker_threads)
+    logger.info(f"Shard {shard_ix}: using device {device}")
+    back_translators = [BackTranslator(model_name_fw=fw, model_name_bw=bw, device=device) for fw, bw in args.pivots]
+
+    # Lines are sorted by length once (with the tokenizer of the first forward model): all pivots share these batches
+    tokenizer = back_translators[0].fw_model.tokenizer
+    max_length = back_translators[0].fw_model.model.config.max_length
+    lengths = [len(ids) for ids in tokenizer([lines_in[ix] for ix in todo], truncation=True, max_length=max_length)["input_ids"]]
+    batches = token_budget_batches(lengths, max_tokens=args.max_tokens, max_batch_size=args.batch_size)
+    logger.info(f"Shard {shard_ix}: {len(todo)} lines in {len(batches)} length-sorted batches")
+
+    for batch in tqdm(batches, desc=f"shard {shard_ix}", position=shard_ix):
+        ixs = [todo[ix] for ix in batch]
+        src_texts = [lines_in[ix] for ix in ixs]
+        tgt_texts = [back_translator.process_multiple(src_texts) for back_translator in back_translators]
+        writer.write_many([
+            {
+                "ix": ix,
+                "src_text": src_text,
+                "tgt_texts": [t[i] for t in tgt_texts]
+            }
+            for i, (ix, src_text) in enumerate(zip(ixs, src_texts))
+        ])
+    writer.close()
+
+
+def main():
+    args = parse_args()
+    check_shard_dir(args.shard_dir, args.pivots, args.num_workers)
+
+    # Workers are spread over available GPUs
+    n_gpus = torch.cuda.device_count()
+    devices = [f"cuda:{shard_ix % n_gpus}" if n_gpus else "cpu" for shard_ix in range(args.num_workers)]
+
+    if args.num_workers == 1:
+        back_translate_shard(args, 0, devices[0])
+    else:
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=back_translate_shard, args=(args, shard_ix, devices[shard_ix])) for shard_ix in range(args.num_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed = [shard_ix for shard_ix, worker in enumerate(workers) if worker.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"Shards {failed} failed. Re-run the same command to resume them.")
+
+    # Merge shards in file order
+    n_lines = len(read_file(args.file_in))
+    if os.path.dirname(args.file_out):
+        os.makedirs(os.path.dirname(args.file_out), exist_ok=True)
+    merge_shards([shard_path(args.shard_dir, shard_ix, args.num_workers) for shard_ix in range(args.num_workers)], args.file_out, n_items=n_lines)
+    shutil.rmtree(args.shard_dir)
+
+
+if __name__ == "__main__":
+    main()
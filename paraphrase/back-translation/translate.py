@@ -1,8 +1,15 @@
+import json
 import tqdm
 import os
+import queue
+import threading
+from typing import Iterable, Iterator, List, Tuple
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 import torch
 
+from utils.batching import token_budget_batches
+from utils.sharding import ShardWriter
+
 
 def get_device():
     if torch.cuda.is_available():
@@ -24,25 +31,52 @@ def write_file(lines, path, exist_ok=False):
 
 
 class Translator:
-    def __init__(self, model_name: str = None):
+    def __init__(self, model_name: str = None, device=None):
         self.model_name = model_name
-        self.model = AutoModelForSeq2SeqLM.from_pretrained(self.model_name).to(get_device())
+        self.device = device if device else get_device()
+        self.model = AutoModelForSeq2SeqLM.from_pretrained(self.model_name).to(self.device)
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
 
     def translate(self, text):
         return self.translate_multiple([text])[0]
 
     def translate_multiple(self, texts):
-        inputs = self.tokenizer(texts, padding="longest", return_tensors="pt", truncation=True, max_length=self.model.config.max_length)['input_ids'].to(get_device())
+        inputs = self.tokenizer(texts, padding="longest", return_tensors="pt", truncation=True, max_length=self.model.config.max_length)['input_ids'].to(self.device)
         with torch.no_grad():
             outputs = self.model.generate(inputs)
         return [self.tokenizer.decode(output, skip_special_tokens=True) for output in outputs]
 
+    def stream(self, items: Iterable[Tuple[int, str]], window_size: int = 1024, max_tokens: int = 4096, max_batch_size: int = 32) -> Iterator[Tuple[List[int], List[str]]]:
+        """
+        Translates (index, text) items as they come: items are read by windows of `window_size`, sorted by length within
+        each window, and batched so that a padded batch holds at most `max_tokens` source tokens.
+        :return: iterator of (indices, translations), batch by batch
+        """
+        window = list()
+        for item in items:
+            window.append(item)
+            if len(window) >= window_size:
+                yield from self.translate_window(window, max_tokens=max_tokens, max_batch_size=max_batch_size)
+                window = list()
+        if window:
+            yield from self.translate_window(window, max_tokens=max_tokens, max_batch_size=max_batch_size)
+
+    def translate_window(self, window: List[Tuple[int, str]], max_tokens: int, max_batch_size: int) -> Iterator[Tuple[List[int], List[str]]]:
+        lengths = [
+            len(ids) for ids in self.tokenizer(
+                [text for _, text in window],
+                truncation=True,
+                max_length=self.model.config.max_length
+            )["input_ids"]
+        ]
+        for batch in token_budget_batches(lengths, max_tokens=max_tokens, max_batch_size=max_batch_size):
+            yield [window[ix][0] for ix in batch], self.translate_multiple([window[ix][1] for ix in batch])
+
 
 class BackTranslator:
-    def __init__(self, model_name_fw: str = None, model_name_bw: str = None):
-        self.fw_model = Translator(model_name=model_name_fw)
-        self.bw_model = Translator(model_name=model_name_bw)
+    def __init__(self, model_name_fw: str = None, model_name_bw: str = None, device=None):
+        self.fw_model = Translator(model_name=model_name_fw, device=device)
+        self.bw_model = Translator(model_name=model_name_bw, device=device)
 
     def process(self, text):
         return self.process_multiple([text])[0]
@@ -52,6 +86,52 @@ class BackTranslator:
         bw = self.bw_model.translate_multiple(fw)
         return bw
 
+    def stream(self, items: Iterable[Tuple[int, str]], window_size: int = 1024, max_tokens: int = 4096, max_batch_size: int = 32, queue_size: int = 8) -> Iterator[Tuple[List[int], List[str], List[str]]]:
+        """
+        Back-translates (index, text) items as a two-stage pipeline: a thread runs the forward model (see
+        `Translator.stream`), while the backward model translates forward batches as soon as they are ready.
+        :param queue_size: max number of forward batches waiting for the backward model
+        :return: iterator of (indices, forward translations, back-translations), batch by batch
+        """
+        forward_batches = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    forward_batches.put(item, timeout=.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def forward():
+            try:
+                for batch in self.fw_model.stream(items, window_size=window_size, max_tokens=max_tokens, max_batch_size=max_batch_size):
+                    if not put(batch):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        forward_thread = threading.Thread(target=forward, daemon=True)
+        forward_thread.start()
+        try:
+            while True:
+                batch = forward_batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                fw_ixs, fw_texts = batch
+                fw_text_of_ix = dict(zip(fw_ixs, fw_texts))
+                # Forward translations of a batch have similar lengths, but are re-batched under the backward model's budget
+                for ixs, bw_texts in self.bw_model.stream(zip(fw_ixs, fw_texts), window_size=len(fw_ixs), max_tokens=max_tokens, max_batch_size=max_batch_size):
+                    yield ixs, [fw_text_of_ix[ix] for ix in ixs], bw_texts
+        finally:
+            stop.set()
+            forward_thread.join()
+
 
 def main():
     import argparse
@@ -59,7 +139,13 @@ def main():
     parser.add_argument("--file-in", type=str, required=True)
     parser.add_argument("--file-out", type=str, required=True)
     parser.add_argument("--overwrite", action="store_true", default=False)
-    parser.add_argument("--model-name", type=str, required=True)
+    parser.add_argument("--model-name", type=str, required=True, help="Translation model (forward model when --model-name-bw is set)")
+    parser.add_argument("--model-name-bw", type=str, help="If set, back-translates --file-in: lines are translated by --model-name, then by this model, both running concurrently")
+    parser.add_argument("--max-tokens", type=int, default=4096, help="Max number of (padded) source tokens per batch")
+    parser.add_argument("--batch-size", type=int, default=32, help="Max number of lines per batch")
+    parser.add_argument("--window-size", type=int, default=1024, help="Lines are sorted by length within windows of this many lines")
+    parser.add_argument("--stream-file", type=str, help="Where translations are appended as they are produced (defaults to <file-out>.stream.jsonl). "
+                                                        "Re-running the same command resumes from it")
     args = parser.parse_args()
 
     # Checking args
@@ -69,21 +155,47 @@ def main():
     if os.path.exists(args.file_out) and not args.overwrite:
         raise FileExistsError(args.file_out)
 
+    stream_file = args.stream_file if args.stream_file else f"{args.file_out}.stream.jsonl"
     lines_in = read_file(args.file_in)
-    translator = Translator(model_name=args.model_name)
     n_lines_in = len(lines_in)
-    batch_size = 32
-    lines_out = list()
-
-    progress_bar = tqdm.tqdm(total=n_lines_in)
-
-    for i in range(0, n_lines_in, batch_size):
-        lines_batch = lines_in[i:i + batch_size]
-        lines_out += translator.translate_multiple(texts=lines_batch)
-        progress_bar.update(len(lines_batch))
-
+    writer = ShardWriter(stream_file)
+    todo = [(ix, line) for ix, line in enumerate(lines_in) if ix not in writer.done]
+
+    progress_bar = tqdm.tqdm(total=n_lines_in, initial=n_lines_in - len(todo))
+    if todo:
+        if args.model_name_bw:
+            translator = BackTranslator(model_name_fw=args.model_name, model_name_bw=args.model_name_bw)
+            batches = (
+                (ixs, [{"fw_text": f, "tgt_text": b} for f, b in zip(fw_texts, bw_texts)])
+                for ixs, fw_texts, bw_texts in translator.stream(todo, window_size=args.window_size, max_tokens=args.max_tokens, max_batch_size=args.batch_size)
+            )
+        else:
+            translator = Translator(model_name=args.model_name)
+            batches = (
+                (ixs, [{"tgt_text": t} for t in texts])
+                for ixs, texts in translator.stream(todo, window_size=args.window_size, max_tokens=args.max_tokens, max_batch_size=args.batch_size)
+            )
+        for ixs, records in batches:
+            writer.write_many([{"ix": ix, **record} for ix, record in zip(ixs, records)])
+            progress_bar.update(len(ixs))
+    writer.close()
     progress_bar.close()
-    write_file(lines=lines_out, path=args.file_out)
+
+    # All lines are translated: write them in file order
+    records = read_stream_file(stream_file)
+    assert sorted(records.keys()) == list(range(n_lines_in))
+    write_file(lines=[records[ix]["tgt_text"] for ix in range(n_lines_in)], path=f"{args.file_out}.tmp", exist_ok=True)
+    os.replace(f"{args.file_out}.tmp", args.file_out)
+    os.remove(stream_file)
+
+
+def read_stream_file(path):
+    records = dict()
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            records[record["ix"]] = record
+    return records
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+import functools
+from typing import List
+
+import numpy as np
+
+NGRAM_ORDER = 4
+
+
+@functools.lru_cache(maxsize=1)
+def get_bleu_tokenizer():
+    # Same tokenizer as sacrebleu's `sentence_bleu`
+    from sacrebleu.tokenizers import TOKENIZERS, DEFAULT_TOKENIZER
+    return TOKENIZERS[DEFAULT_TOKENIZER]()
+
+
+def tokenize_bleu(text: str) -> List[str]:
+    return get_bleu_tokenizer()(text.rstrip()).split()
+
+
+def sentence_bleu_many(hypotheses: List[str], references: List[str]) -> np.ndarray:
+    """
+    Batched equivalent of `[sacrebleu.sentence_bleu(hyp, [ref]).score for hyp, ref in zip(hypotheses, references)]`
+    (default `sentence_bleu` settings: 13a tokenization, floor smoothing with value 0, effective order).
+    Each distinct text is tokenized once, and n-gram matches of all pairs are counted with array operations.
+    """
+    assert len(hypotheses) == len(references)
+    if not hypotheses:
+        return np.zeros(0)
+
+    # Tokenize each distinct text once, mapping tokens to integers
+    text_to_ix = dict()
+    for text in list(references) + list(hypotheses):
+        text_to_ix.setdefault(text, len(text_to_ix))
+    vocabulary = dict()
+    token_ids = [[vocabulary.setdefault(token, len(vocabulary)) for token in tokenize_bleu(text)] for text in text_to_ix]
+    lengths = np.array([len(ids) for ids in token_ids], dtype=np.int64)
+    hyp_ixs = np.array([text_to_ix[text] for text in hypotheses], dtype=np.int64)
+    ref_ixs = np.array([text_to_ix[text] for text in references], dtype=np.int64)
+
+    # N-grams of all texts, as (text index, n-gram id) pairs. N-gram ids are unique across orders.
+    flat = np.array([token_id for ids in token_ids for token_id in ids], dtype=np.int64)
+    text_of_token = np.repeat(np.arange(len(token_ids)), lengths)
+    position = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    ngram_texts, ngram_ids, ngram_orders = list(), list(), list()
+    n_ngram_ids = 0
+    for n in range(1, NGRAM_ORDER + 1):
+        starts = np.nonzero(position + n <= lengths[text_of_token])[0]
+        if not len(starts):
+            break
+        _, ids = np.unique(np.stack([flat[starts + k] for k in range(n)], axis=1), axis=0, return_inverse=True)
+        ids = ids.reshape(-1)
+        ngram_texts.append(text_of_token[starts])
+        ngram_ids.append(ids + n_ngram_ids)
+        ngram_orders.append(np.full(ids.max() + 1, n - 1, dtype=np.int64))
+        n_ngram_ids += ids.max() + 1
+
+    total = np.maximum(lengths[hyp_ixs, None] - np.arange(NGRAM_ORDER)[None, :], 0).astype(np.float64)
+    correct = np.zeros((len(hypotheses), NGRAM_ORDER))
+    if ngram_ids:
+        # Count each n-gram in each text
+        keys, counts = np.unique(np.concatenate(ngram_texts) * n_ngram_ids + np.concatenate(ngram_ids), return_counts=True)
+        order_of_ngram = np.concatenate(ngram_orders)
+
+        # Clipped matches of each (hypothesis, reference) pair: sum over hypothesis n-grams of min(count, count in reference)
+        # Keys of hypothesis `i` span keys[lo[i]:hi[i]]
+        lo = np.searchsorted(keys, hyp_ixs * n_ngram_ids)
+        hi = np.searchsorted(keys, (hyp_ixs + 1) * n_ngram_ids)
+        pair_ixs = np.repeat(np.arange(len(hyp_ixs)), hi - lo)
+        key_ixs = np.arange(len(pair_ixs)) - np.repeat(np.cumsum(hi - lo) - (hi - lo), hi - lo) + np.repeat(lo, hi - lo)
+        ngram_of_key = keys[key_ixs] % n_ngram_ids
+        ref_keys = ref_ixs[pair_ixs] * n_ngram_ids + ngram_of_key
+        ref_key_ixs = np.minimum(np.searchsorted(keys, ref_keys), len(keys) - 1)
+        ref_counts = np.where(keys[ref_key_ixs] == ref_keys, counts[ref_key_ixs], 0)
+        correct = np.bincount(
+            pair_ixs * NGRAM_ORDER + order_of_ngram[ngram_of_key],
+            weights=np.minimum(counts[key_ixs], ref_counts),
+            minlength=len(hypotheses) * NGRAM_ORDER
+        ).reshape(len(hypotheses), NGRAM_ORDER)
+
+    # Same formula as sacrebleu's `BLEU.compute_bleu`
+    sys_len, ref_len = lengths[hyp_ixs].astype(np.float64), lengths[ref_ixs].astype(np.float64)
+    effective_order = (total > 0).sum(axis=1)
+    effective_order = np.where(effective_order == 0, NGRAM_ORDER, effective_order)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precisions = np.where(correct > 0, 100. * correct / total, 0.)
+        log_precisions = np.where(precisions > 0, np.log(np.where(precisions > 0, precisions, 1.)), -9999999999)
+        log_precisions = np.where(np.arange(NGRAM_ORDER)[None, :] < effective_order[:, None], log_precisions, 0.)
+        bp = np.where(sys_len < ref_len, np.where(sys_len > 0, np.exp(1 - ref_len / sys_len), 0.), 1.)
+    return bp * np.exp(log_precisions.sum(axis=1) / effective_order)
+
+
+def select_min_bleu_candidates(groups: List[List[List[str]]], src_texts: List[str]) -> List[List[str]]:
+    """
+    For each source text, picks the candidate of each group with the lowest BLEU w/r to the source (first one on ties).
+    Same choices as `filter_generated_texts_with_distance_metric(..., distance_metric_fn=bleu_score, lower_is_better=True)`,
+    scoring the whole batch at once.
+    :param groups: for each source text, groups of candidate paraphrases
+    """
+    hypotheses = [candidate for src_groups in groups for group in src_groups for candidate in group]
+    references = [src for src, src_groups in zip(src_texts, groups) for group in src_groups for _ in group]
+    scores = sentence_bleu_many(hypotheses, references)
+
+    output = list()
+    offset = 0
+    for src_groups in groups:
+        selected = list()
+        for group in src_groups:
+            selected.append(group[int(np.argmin(scores[offset:offset + len(group)]))])
+            offset += len(group)
+        output.append(selected)
+    return output
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from typing import List, Dict
+
+import numpy as np
+
+from paraphrase.modeling import ParaphraseModel
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def paraphrase_cache_key(src_text: str, generation_config: Dict) -> str:
+    """
+    :param generation_config: everything that changes the paraphrases of `src_text` (model, decoding, drop strategy...)
+    """
+    return hashlib.sha256(json.dumps([src_text, generation_config], sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ParaphraseCache:
+    """
+    On-disk (sqlite) cache of paraphrases, holding up to `max_samples` generations per key.
+    The database is in WAL mode, so that several runs can read and write it at the same time.
+    When it holds more than `max_entries` keys, least recently used keys are evicted.
+    Lookups only read the database: recency updates are buffered, and written by the next `add_many` transaction.
+    """
+
+    def __init__(self, path: str, max_samples: int = 4, max_entries: int = 1000000, timeout: float = 60.0, touch_interval: float = 3600.0, evict_every: int = 1000):
+        """
+        :param touch_interval: a looked up key has its last use time updated only if it is older than this (s)
+        :param evict_every: the number of keys is checked against `max_entries` every `evict_every` new keys (the cache
+            may exceed `max_entries` by that many keys)
+        """
+        assert max_samples > 0
+        self.path = path
+        self.max_samples = max_samples
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+        self.evict_every = evict_every
+        # sqlite connections can't be shared between threads
+        self.local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # key -> last use time, not written yet
+        self.touched: Dict[str, float] = dict()
+        self.n_new_keys = 0
+        self.lock = threading.Lock()
+
+        with self.transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, last_used REAL NOT NULL)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS samples ("
+                "key TEXT NOT NULL, sample_ix INTEGER NOT NULL, tgt_texts TEXT NOT NULL, PRIMARY KEY (key, sample_ix))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS keys_last_used ON keys (last_used)")
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction, taking the database write lock upfront so that concurrent runs wait for each other
+        instead of failing on a read -> write lock upgrade.
+        """
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[List[str]]]:
+        """
+        :return: key -> cached samples, for keys having at least one sample. Marks those keys as recently used.
+        """
+        unique_keys = list(dict.fromkeys(keys))
+        samples = dict()
+        now = time.time()
+        stale = list()
+        connection = self.connection()
+        # Stay under sqlite's max number of query parameters
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i:i + 500]
+            rows = connection.execute(
+                f"SELECT samples.key, samples.tgt_texts, keys.last_used FROM samples JOIN keys ON keys.key = samples.key "
+                f"WHERE samples.key IN ({','.join('?' * len(chunk))}) ORDER BY samples.key, samples.sample_ix",
+                chunk
+            ).fetchall()
+            for key, tgt_texts, last_used in rows:
+                if key not in samples and last_used < now - self.touch_interval:
+                    stale.append(key)
+                samples.setdefault(key, list()).append(json.loads(tgt_texts))
+
+        if stale:
+            with self.lock:
+                self.touched.update({key: now for key in stale})
+        return samples
+
+    def add_many(self, keys: List[str], tgt_texts: List[List[str]], rng=np.random):
+        """
+        Stores a new sample for each key. A key already holding `max_samples` samples has a random one replaced.
+        Buffered recency updates are written in the same transaction, and least recently used keys evicted if needed.
+        """
+        now = time.time()
+        with self.lock:
+            touched, self.touched = self.touched, dict()
+        try:
+            with self.transaction() as connection:
+                connection.executemany("UPDATE keys SET last_used = MAX(last_used, ?) WHERE key = ?", [(last_used, key) for key, last_used in touched.items()])
+                n_new_keys = 0
+                for key, tgt_texts_ in zip(keys, tgt_texts):
+                    n_samples = connection.execute("SELECT COUNT(*) FROM samples WHERE key = ?", (key,)).fetchone()[0]
+                    n_new_keys += int(n_samples == 0)
+                    sample_ix = n_samples if n_samples < self.max_samples else int(rng.randint(self.max_samples))
+                    connection.execute("INSERT OR REPLACE INTO keys (key, last_used) VALUES (?, ?)", (key, now))
+                    connection.execute(
+                        "INSERT OR REPLACE INTO samples (key, sample_ix, tgt_texts) VALUES (?, ?, ?)",
+                        (key, sample_ix, json.dumps(tgt_texts_, ensure_ascii=False))
+                    )
+                with self.lock:
+                    self.n_new_keys += n_new_keys
+                    check_eviction = self.n_new_keys >= self.evict_every
+                    if check_eviction:
+                        self.n_new_keys = 0
+                if check_eviction:
+                    self.evict(connection)
+        except BaseException:
+            # Written by a later transaction
+            with self.lock:
+                self.touched = {**touched, **self.touched}
+            raise
+
+    def evict(self, connection: sqlite3.Connection):
+        """
+        Evicts least recently used keys, if there are more than `max_entries`. Runs in the caller's write transaction.
+        """
+        if not self.max_entries:
+            return
+        n_keys = connection.execute("SELECT COUNT(*) FROM keys").fetchone()[0]
+        if n_keys <= self.max_entries:
+            return
+        # Evict down to 90% of the budget, so that eviction doesn't run at each check
+        n_evicted = n_keys - int(self.max_entries * .9)
+        connection.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS evicted_keys (key TEXT PRIMARY KEY)"
+        )
+        connection.execute("DELETE FROM evicted_keys")
+        connection.execute("INSERT INTO evicted_keys SELECT key FROM keys ORDER BY last_used LIMIT ?", (n_evicted,))
+        connection.execute("DELETE FROM samples WHERE key IN (SELECT key FROM evicted_keys)")
+        connection.execute("DELETE FROM keys WHERE key IN (SELECT key FROM evicted_keys)")
+        logger.info(f"Evicted {n_evicted} keys from paraphrase cache @ {self.path}")
+
+    def __len__(self):
+        return self.connection().execute("SELECT COUNT(*) FROM keys").fetchone()[0]
+
+
+class CachedParaphraseModel(ParaphraseModel):
+    """
+    Serves paraphrases from a `ParaphraseCache`, only calling the wrapped model for sources missing from the cache.
+    With probability `refresh_prob`, a cached source is paraphrased again, and the new sample added to the cache,
+    so that stochastic generations (e.g. with random token dropping) stay diverse across steps.
+    """
+
+    def __init__(self, model: ParaphraseModel, cache: ParaphraseCache, refresh_prob: float = 0.25, log_every: int = 100):
+        """
+        :param model: paraphrase model exposing `generation_config()`
+        :param log_every: log the hit rate and the generation time saved every `log_every` calls to `paraphrase`
+        """
+        super().__init__(device=model.device)
+        assert 0 <= refresh_prob <= 1
+        self.model = model
+        self.cache = cache
+        self.refresh_prob = refresh_prob
+        self.config = model.generation_config()
+        self.log_every = log_every
+
+        self.lock = threading.Lock()
+        self.n_calls = 0
+        self.stats = {"n_hits": 0, "n_misses": 0, "generation_time": 0.0}
+        self.total_stats = dict(self.stats)
+
+    def paraphrase(self, src_texts: List[str], rng=None, **kwargs):
+        rng = rng if rng is not None else np.random
+        keys = [paraphrase_cache_key(src_text, self.config) for src_text in src_texts]
+        cached = self.cache.get_many(keys)
+
+        output = [None] * len(src_texts)
+        to_generate = list()
+        for ix, key in enumerate(keys):
+            if key in cached and rng.random_sample() >= self.refresh_prob:
+                samples = cached[key]
+                output[ix] = samples[rng.randint(len(samples))]
+            else:
+                to_generate.append(ix)
+
+        generation_time = 0.0
+        if to_generate:
+            start = time.time()
+            generated = self.model.paraphrase([src_texts[ix] for ix in to_generate], rng=rng, **kwargs)
+            generation_time = time.time() - start
+            for ix, tgt_texts in zip(to_generate, generated):
+                output[ix] = tgt_texts
+            self.cache.add_many([keys[ix] for ix in to_generate], generated, rng=rng)
+
+        self.update_stats(n_hits=len(src_texts) - len(to_generate), n_misses=len(to_generate), generation_time=generation_time)
+        return output
+
+    def update_stats(self, n_hits: int, n_misses: int, generation_time: float):
+        with self.lock:
+            for stats in (self.stats, self.total_stats):
+                stats["n_hits"] += n_hits
+                stats["n_misses"] += n_misses
+                stats["generation_time"] += generation_time
+            self.n_calls += 1
+            if self.log_every and self.n_calls % self.log_every == 0:
+                logger.info(
+                    f"Paraphrase cache | " + " | ".join([f"{key}:{value:.4f}" for key, value in self.summarize(self.total_stats, self.time_per_generation()).items()])
+                )
+
+    def time_per_generation(self) -> float:
+        """
+        :return: mean generation time of a missed source, over the whole run
+        """
+        return self.total_stats["generation_time"] / self.total_stats["n_misses"] if self.total_stats["n_misses"] else 0.0
+
+    @staticmethod
+    def summarize(stats: Dict, time_per_generation: float) -> Dict[str, float]:
+        n = stats["n_hits"] + stats["n_misses"]
+        if not n:
+            return dict()
+        return {
+            "paraphrase_cache_hit_rate": stats["n_hits"] / n,
+            "paraphrase_cache_time_saved": stats["n_hits"] * time_per_generation
+        }
+
+    def close(self):
+        if hasattr(self.model, "close"):
+            self.model.close()
+
+    def pop_stats(self) -> Dict[str, float]:
+        """
+        :return: hit rate, and generation time saved (s), since the last call
+        """
+        with self.lock:
+            stats = self.summarize(self.stats, self.time_per_generation())
+            self.stats = {"n_hits": 0, "n_misses": 0, "generation_time": 0.0}
+        return stats
+
+    def generation_config(self) -> Dict:
+        return self.config
@@ -1,8 +1,14 @@
 # Easy data augmentation techniques for text classification
 # Credit to Jason Wei and Kai Zou for this script (found at https://github.com/jasonwei20/eda_nlp/)
+# Randomness comes from an explicit `rng` (a `random.Random`, defaults to the `random` module) and synonyms from a memoized
+# `SynonymIndex`, so that augmentations only depend on the seed, even when sentences are spread over processes.
 
+import json
+import multiprocessing
+import os
 import random
-from random import shuffle
+import re
+from typing import List, Dict, Iterable
 
 random.seed(1)
 
@@ -28,29 +34,28 @@ stop_words = ['i', 'me', 'my', 'myself', 'we', 'our',
               'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too',
               'very', 's', 't', 'can', 'will', 'just', 'don',
               'should', 'now', '']
+stop_words_set = frozenset(stop_words)
 
 # cleaning up text
-import re
+class OnlyCharsTable(dict):
+    """
+    `str.translate` table of `get_only_chars`: keeps lowercase ascii letters and spaces, deletes apostrophes, replaces any
+    other character (hyphens, tabs, newlines, digits, punctuation...) with a space. Filled lazily, one entry per character.
+    """
+
+    def __missing__(self, code: int):
+        self[code] = code if chr(code) in 'qwertyuiopasdfghjklzxcvbnm ' else ord(' ')
+        return self[code]
+
+
+only_chars_table = OnlyCharsTable({ord("’"): None, ord("'"): None})
+multiple_spaces = re.compile(' +')
 
 
 def get_only_chars(line):
-    clean_line = ""
-
-    line = line.replace("’", "")
-    line = line.replace("'", "")
-    line = line.replace("-", " ")  # replace hyphens with spaces
-    line = line.replace("\t", " ")
-    line = line.replace("\n", " ")
-    line = line.lower()
-
-    for char in line:
-        if char in 'qwertyuiopasdfghjklzxcvbnm ':
-            clean_line += char
-        else:
-            clean_line += ' '
-
-    clean_line = re.sub(' +', ' ', clean_line)  # delete extra spaces
-    if clean_line[0] == ' ':
+    # Apostrophes, hyphens, tabs and newlines have no case: lowercasing first doesn't change the output
+    clean_line = multiple_spaces.sub(' ', line.lower().translate(only_chars_table))  # delete extra spaces
+    if clean_line[:1] == ' ':
         clean_line = clean_line[1:]
     return clean_line
 
@@ -60,21 +65,17 @@ def get_only_chars(line):
 # Replace n words in the sentence with synonyms from wordnet
 ########################################################################
 
-# for the first time you use wordnet
-# import nltk
-# nltk.download('wordnet')
-from nltk.corpus import wordnet
-
-
-def synonym_replacement(words, n):
+def synonym_replacement(words, n, rng=None, synonyms=None):
+    rng = rng if rng is not None else random
     new_words = words.copy()
-    random_word_list = list(set([word for word in words if word not in stop_words]))
-    random.shuffle(random_word_list)
+    # Sorted before shuffling, so that the order only depends on the seed (not on the iteration order of the set)
+    random_word_list = sorted(set([word for word in words if word not in stop_words_set]))
+    rng.shuffle(random_word_list)
     num_replaced = 0
     for random_word in random_word_list:
-        synonyms = get_synonyms(random_word)
-        if len(synonyms) >= 1:
-            synonym = random.choice(list(synonyms))
+        word_synonyms = get_synonyms(random_word, synonyms=synonyms)
+        if len(word_synonyms) >= 1:
+            synonym = rng.choice(word_synonyms)
             new_words = [synonym if word == random_word else word for word in new_words]
             # print("replaced", random_word, "with", synonym)
             num_replaced += 1
@@ -88,16 +89,69 @@ def synonym_replacement(words, n):
     return new_words
 
 
-def get_synonyms(word):
+def get_wordnet_synonyms(word) -> List[str]:
+    # for the first time you use wordnet
+    # import nltk
+    # nltk.download('wordnet')
+    from nltk.corpus import wordnet
+
     synonyms = set()
     for syn in wordnet.synsets(word):
         for l in syn.lemmas():
             synonym = l.name().replace("_", " ").replace("-", " ").lower()
             synonym = "".join([char for char in synonym if char in ' qwertyuiopasdfghjklzxcvbnm'])
             synonyms.add(synonym)
-    if word in synonyms:
-        synonyms.remove(word)
-    return list(synonyms)
+    synonyms.discard(word)
+    return sorted(synonyms)
+
+
+class SynonymIndex:
+    """
+    Memoized WordNet synonyms (sorted, so that random choices among them only depend on the seed).
+    Can be precomputed for the vocabulary of a dataset and saved (JSON): WordNet is then only queried for other words
+    (e.g. synonyms inserted by random insertion).
+    """
+
+    def __init__(self, synonyms: Dict[str, List[str]] = None):
+        self.synonyms: Dict[str, List[str]] = dict(synonyms) if synonyms else dict()
+
+    def __len__(self):
+        return len(self.synonyms)
+
+    def get(self, word) -> List[str]:
+        """
+        :return: synonyms of `word` (must not be modified)
+        """
+        synonyms = self.synonyms.get(word)
+        if synonyms is None:
+            synonyms = self.synonyms[word] = get_wordnet_synonyms(word)
+        return synonyms
+
+    @classmethod
+    def build(cls, sentences: Iterable[str]) -> "SynonymIndex":
+        index = cls()
+        for word in sorted({word for sentence in sentences for word in get_only_chars(sentence).split(' ') if word}):
+            index.get(word)
+        return index
+
+    def save(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.synonyms, file, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "SynonymIndex":
+        with open(path, "r", encoding="utf-8") as file:
+            return cls(json.load(file))
+
+
+# Used when no index is given
+synonym_index = SynonymIndex()
+
+
+def get_synonyms(word, synonyms: SynonymIndex = None):
+    return (synonyms if synonyms is not None else synonym_index).get(word)
 
 
 ########################################################################
@@ -105,7 +159,8 @@ def get_synonyms(word):
 # Randomly delete words from the sentence with probability p
 ########################################################################
 
-def random_deletion(words, p):
+def random_deletion(words, p, rng=None):
+    rng = rng if rng is not None else random
     # obviously, if there's only one word, don't delete it
     if len(words) == 1:
         return words
@@ -113,13 +168,13 @@ def random_deletion(words, p):
     # randomly delete words with probability p
     new_words = []
     for word in words:
-        r = random.uniform(0, 1)
+        r = rng.uniform(0, 1)
         if r > p:
             new_words.append(word)
 
     # if you end up deleting all words, just return a random word
     if len(new_words) == 0:
-        rand_int = random.randint(0, len(words) - 1)
+        rand_int = rng.randint(0, len(words) - 1)
         return [words[rand_int]]
 
     return new_words
@@ -130,19 +185,20 @@ def random_deletion(words, p):
 # Randomly swap two words in the sentence n times
 ########################################################################
 
-def random_swap(words, n):
+def random_swap(words, n, rng=None):
     new_words = words.copy()
     for _ in range(n):
-        new_words = swap_word(new_words)
+        new_words = swap_word(new_words, rng=rng)
     return new_words
 
 
-def swap_word(new_words):
-    random_idx_1 = random.randint(0, len(new_words) - 1)
+def swap_word(new_words, rng=None):
+    rng = rng if rng is not None else random
+    random_idx_1 = rng.randint(0, len(new_words) - 1)
     random_idx_2 = random_idx_1
     counter = 0
     while random_idx_2 == random_idx_1:
-        random_idx_2 = random.randint(0, len(new_words) - 1)
+        random_idx_2 = rng.randint(0, len(new_words) - 1)
         counter += 1
         if counter > 3:
             return new_words
@@ -155,36 +211,41 @@ def swap_word(new_words):
 # Randomly insert n words into the sentence
 ########################################################################
 
-def random_insertion(words, n):
+def random_insertion(words, n, rng=None, synonyms=None, random_synonym=False):
     new_words = words.copy()
     for _ in range(n):
-        add_word(new_words)
+        add_word(new_words, rng=rng, synonyms=synonyms, random_synonym=random_synonym)
     return new_words
 
 
-def add_word(new_words):
-    synonyms = []
+def add_word(new_words, rng=None, synonyms=None, random_synonym=False):
+    """
+    :param random_synonym: insert a random synonym of the chosen word, instead of its first (alphabetically) synonym
+    """
+    rng = rng if rng is not None else random
+    word_synonyms = []
     counter = 0
-    while len(synonyms) < 1:
-        random_word = new_words[random.randint(0, len(new_words) - 1)]
-        synonyms = get_synonyms(random_word)
+    while len(word_synonyms) < 1:
+        random_word = new_words[rng.randint(0, len(new_words) - 1)]
+        word_synonyms = get_synonyms(random_word, synonyms=synonyms)
         counter += 1
         if counter >= 10:
             return
-    random_synonym = synonyms[0]
-    random_idx = random.randint(0, len(new_words) - 1)
-    new_words.insert(random_idx, random_synonym)
+    synonym = rng.choice(word_synonyms) if random_synonym else word_synonyms[0]
+    random_idx = rng.randint(0, len(new_words) - 1)
+    new_words.insert(random_idx, synonym)
 
 
 ########################################################################
 # main data augmentation function
 ########################################################################
 
-def eda(sentence, alpha_sr=0.1, alpha_ri=0.1, alpha_rs=0.1, p_rd=0.1, num_aug=9):
+def eda(sentence, alpha_sr=0.1, alpha_ri=0.1, alpha_rs=0.1, p_rd=0.1, num_aug=9, rng=None, synonyms: SynonymIndex = None, random_synonym_insertion=False):
+    rng = rng if rng is not None else random
     orig_sentence = sentence
     sentence = get_only_chars(sentence)
     words = sentence.split(' ')
-    words = [word for word in words if word is not '']
+    words = [word for word in words if word != '']
     num_words = len(words)
     if num_words == 0:
         return [orig_sentence] * (num_aug+1)
@@ -196,40 +257,81 @@ def eda(sentence, alpha_sr=0.1, alpha_ri=0.1, alpha_rs=0.1, p_rd=0.1, num_aug=9)
     if alpha_sr > 0:
         n_sr = max(1, int(alpha_sr * num_words))
         for _ in range(num_new_per_technique):
-            a_words = synonym_replacement(words, n_sr)
+            a_words = synonym_replacement(words, n_sr, rng=rng, synonyms=synonyms)
             augmented_sentences.append(' '.join(a_words))
 
     # ri
     if alpha_ri > 0:
         n_ri = max(1, int(alpha_ri * num_words))
         for _ in range(num_new_per_technique):
-            a_words = random_insertion(words, n_ri)
+            a_words = random_insertion(words, n_ri, rng=rng, synonyms=synonyms, random_synonym=random_synonym_insertion)
             augmented_sentences.append(' '.join(a_words))
 
     # rs
     if alpha_rs > 0:
         n_rs = max(1, int(alpha_rs * num_words))
         for _ in range(num_new_per_technique):
-            a_words = random_swap(words, n_rs)
+            a_words = random_swap(words, n_rs, rng=rng)
             augmented_sentences.append(' '.join(a_words))
 
     # rd
     if p_rd > 0:
         for _ in range(num_new_per_technique):
-            a_words = random_deletion(words, p_rd)
+            a_words = random_deletion(words, p_rd, rng=rng)
             augmented_sentences.append(' '.join(a_words))
 
     augmented_sentences = [get_only_chars(sentence) for sentence in augmented_sentences]
-    shuffle(augmented_sentences)
+    rng.shuffle(augmented_sentences)
 
     # trim so that we have the desired number of augmented sentences
     if num_aug >= 1:
         augmented_sentences = augmented_sentences[:num_aug]
     else:
         keep_prob = num_aug / len(augmented_sentences)
-        augmented_sentences = [s for s in augmented_sentences if random.uniform(0, 1) < keep_prob]
+        augmented_sentences = [s for s in augmented_sentences if rng.uniform(0, 1) < keep_prob]
 
     # append the original sentence
     augmented_sentences.append(sentence)
 
     return augmented_sentences
+
+
+########################################################################
+# Batched / parallel augmentation
+########################################################################
+
+def eda_seeded(args):
+    sentence, seed, num_aug, random_synonym_insertion = args
+    return eda(sentence, num_aug=num_aug, rng=random.Random(seed), random_synonym_insertion=random_synonym_insertion)
+
+
+def init_eda_worker(synonyms: Dict[str, List[str]]):
+    global synonym_index
+    synonym_index = SynonymIndex(synonyms)
+
+
+def get_eda_pool(n_workers: int, synonyms: SynonymIndex = None):
+    """
+    :return: process pool for `eda_many`, its workers starting with a copy of `synonyms` (None if `n_workers` is 0 or if
+        called from a daemon process, e.g. a paraphrase worker, which can't have children)
+    """
+    if not n_workers or multiprocessing.current_process().daemon:
+        return None
+    return multiprocessing.get_context("spawn").Pool(
+        n_workers,
+        initializer=init_eda_worker,
+        initargs=((synonyms if synonyms is not None else synonym_index).synonyms,)
+    )
+
+
+def eda_many(sentences: List[str], seeds: List[int], num_aug=9, synonyms: SynonymIndex = None, pool=None, random_synonym_insertion=False) -> List[List[str]]:
+    """
+    Augments each sentence with its own `random.Random(seed)`: the output doesn't depend on how sentences are spread
+    over the workers of `pool` (see `get_eda_pool`), if any.
+    """
+    if pool is None:
+        return [
+            eda(sentence, num_aug=num_aug, rng=random.Random(seed), synonyms=synonyms, random_synonym_insertion=random_synonym_insertion)
+            for sentence, seed in zip(sentences, seeds)
+        ]
+    return pool.map(eda_seeded, [(sentence, seed, num_aug, random_synonym_insertion) for sentence, seed in zip(sentences, seeds)])
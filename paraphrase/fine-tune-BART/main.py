@@ -119,6 +119,9 @@ class DataTrainingArguments:
         default=None, metadata={"help": "The list of additional datasets you want to use. Syntax:"
                                         "Name1,Path1|Name2,Path2|...|NameN,,PathN"}
     )
+    embedding_store_path: Optional[str] = field(
+        default=None, metadata={"help": "If set, USE embeddings of the evaluation metrics are persisted there, and reused across evaluations and runs."}
+    )
 
 
 def main():
@@ -279,7 +282,7 @@ def main():
 
     # Initialize our Trainer
     compute_metrics_fn = (
-        build_compute_metrics_fn(data_args.task, tokenizer) if training_args.predict_with_generate else None
+        build_compute_metrics_fn(data_args.task, tokenizer, embedding_store_path=data_args.embedding_store_path) if training_args.predict_with_generate else None
     )
     trainer = Seq2SeqTrainer(
         model=model,
@@ -2,6 +2,9 @@ import os
 
 
 class USEEmbedder:
+    # Same embeddings as `models.use.USEEmbedder` (see `models.encoders.sentence_embedder.CachedSentenceEmbedder`)
+    embedder_id = "universal-sentence-encoder/4"
+
     def __init__(self, force_cpu=False):
         if force_cpu:
             os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
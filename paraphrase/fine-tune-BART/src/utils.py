@@ -76,10 +76,14 @@ def calculate_bleu(output_lns, refs_lns, **kwargs) -> dict:
     return {"bleu": round(corpus_bleu(output_lns, [refs_lns], **kwargs).score, 4)}
 
 
-def build_compute_metrics_fn(task_name: str, tokenizer: PreTrainedTokenizer) -> Callable[[EvalPrediction], Dict]:
+def build_compute_metrics_fn(task_name: str, tokenizer: PreTrainedTokenizer, embedding_store_path: str = None) -> Callable[[EvalPrediction], Dict]:
     from .use import USEEmbedder
 
     use_embedder = USEEmbedder(force_cpu=True)
+    if embedding_store_path:
+        # Labels are the same at each evaluation, and predictions often repeat across checkpoints: only new texts are embedded
+        from models.encoders.sentence_embedder import CachedSentenceEmbedder
+        use_embedder = CachedSentenceEmbedder(use_embedder, embedding_store_path)
 
     def non_pad_len(tokens: np.ndarray) -> int:
         return np.count_nonzero(tokens != tokenizer.pad_token_id)
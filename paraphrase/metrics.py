@@ -0,0 +1,226 @@
+import multiprocessing
+from typing import List, Dict, Iterable, Tuple
+
+import numpy as np
+
+
+def dist_k(texts: List[str], k: int, lowercase: bool = False) -> float:
+    if lowercase:
+        texts = [t.lower() for t in texts]
+    splitted = [
+        t.strip().split()
+        for t in texts
+    ]
+    k_grams = [
+        tuple(s[i:i + k])
+        for s in splitted for i in range(0, len(s) - k + 1) if len(s) >= k
+    ]
+    n_distinct_k_grams = len(set(k_grams))
+    n_tokens = sum([len(s) for s in splitted])
+    return n_distinct_k_grams / n_tokens
+
+
+class DistinctNgrams:
+    """
+    Streaming dist-k of a corpus, for several `k` with and without lowercasing, from a single pass over its texts: each
+    text is split once, and its k-grams added to one set per (k, lowercase). Same values as `dist_k`.
+    """
+
+    def __init__(self, ks: Iterable[int] = (2, 3)):
+        self.ks = list(ks)
+        self.k_grams = {(k, lowercase): set() for k in self.ks for lowercase in (False, True)}
+        self.n_tokens = 0
+
+    def k_grams_of(self, text: str) -> Tuple[Dict[Tuple[int, bool], set], int]:
+        tokens = text.strip().split()
+        # Lowercasing never creates nor removes whitespace: lowercased tokens are those of the lowercased text
+        tokens_lowercased = [token.lower() for token in tokens]
+        k_grams = dict()
+        for k in self.ks:
+            k_grams[(k, False)] = set(zip(*[tokens[i:] for i in range(k)]))
+            k_grams[(k, True)] = set(zip(*[tokens_lowercased[i:] for i in range(k)]))
+        return k_grams, len(tokens)
+
+    def add_many(self, texts: List[str]):
+        for text in texts:
+            k_grams, n_tokens = self.k_grams_of(text)
+            for key, k_grams_ in k_grams.items():
+                self.k_grams[key].update(k_grams_)
+            self.n_tokens += n_tokens
+
+    def dist_k(self, k: int, lowercase: bool = False, extra_texts: List[str] = ()) -> float:
+        """
+        :param extra_texts: texts counted as if they were added to the corpus (without adding them)
+        """
+        k_grams = self.k_grams[(k, lowercase)]
+        extra_k_grams = set()
+        n_tokens = self.n_tokens
+        for text in extra_texts:
+            k_grams_, n_tokens_ = self.k_grams_of(text)
+            extra_k_grams.update(k_grams_[(k, lowercase)])
+            n_tokens += n_tokens_
+        return (len(k_grams) + len(extra_k_grams - k_grams)) / n_tokens
+
+
+def corpus_bleu_stats(sys_texts: List[str], ref_texts: List[str]) -> np.ndarray:
+    """
+    Sufficient statistics of `sacrebleu.corpus_bleu(sys_texts, [ref_texts])`, which add up over chunks of a corpus.
+    :return: correct n-grams (x4), total n-grams (x4), system length, reference length
+    """
+    import sacrebleu
+
+    bleu = sacrebleu.corpus_bleu(sys_texts, [ref_texts])
+    return np.array(list(bleu.counts) + list(bleu.totals) + [bleu.sys_len, bleu.ref_len], dtype=np.int64)
+
+
+def corpus_bleu_from_stats(stats: np.ndarray) -> float:
+    """
+    Same score as `sacrebleu.corpus_bleu` (default settings) on the corpus whose statistics are `stats`
+    """
+    from sacrebleu.metrics import BLEU
+
+    n = BLEU.NGRAM_ORDER
+    stats = stats.tolist()
+    return BLEU.compute_bleu(stats[:n], stats[n:2 * n], stats[2 * n], stats[2 * n + 1], smooth_method="exp").score
+
+
+def mean_pairwise_cosine_similarity(blocks: np.ndarray) -> np.ndarray:
+    """
+    :param blocks: embeddings (N x M x D), e.g. a source text and its paraphrases on each row
+    :return: for each block, mean cosine similarity of its M x M pairs, self-pairs included. Same values as
+        `(1 - sklearn.metrics.pairwise.pairwise_distances(block, metric="cosine")).sum() / M ** 2`, for all blocks at once
+    """
+    n_blocks, m, _ = blocks.shape
+    norms = np.sqrt(np.einsum("nmd,nmd->nm", blocks, blocks))
+    norms[norms == 0.0] = 1.0
+    normalized = blocks / norms[:, :, None]
+    distances = 1 - np.matmul(normalized, normalized.transpose(0, 2, 1))
+    np.clip(distances, 0, 2, out=distances)
+    distances[:, np.arange(m), np.arange(m)] = 0.0
+    return (1 - distances).reshape(n_blocks, m * m).sum(axis=1) / m ** 2
+
+
+class ParaphraseDiversityMetrics:
+    """
+    Diversity metrics of a paraphrase file (`{"src_text", "tgt_texts"}` records, R paraphrases per source), computed on
+    chunks of records as they are read. Metrics are those of utils/scripts/paraphrase/evaluate-paraphrase-diversity.py:
+        - BLEU of sources w/r to the i-th paraphrases, for each i (corpus statistics are computed by worker processes)
+        - dist-k of the i-th paraphrases, and of the i-th paraphrases plus the i-th source text
+        - mean cosine similarity between embeddings of a source and its paraphrases (self-pairs included)
+    """
+
+    def __init__(self, embedder=None, ks: Iterable[int] = (2, 3), n_bleu_workers: int = 0):
+        """
+        :param embedder: object with an `embed_many(texts) -> np.ndarray` method. If None, the similarity is not computed
+        :param n_bleu_workers: number of processes computing BLEU statistics (0: computed in this process)
+        """
+        self.embedder = embedder
+        self.ks = list(ks)
+        self.n_references: int = None
+        self.first_src_texts: List[str] = list()
+        self.distinct_ngrams: List[DistinctNgrams] = None
+        self.bleu_stats: List[np.ndarray] = None
+        self.similarities: List[np.ndarray] = list()
+
+        # Spawned, not forked: the embedder (e.g. TensorFlow) may already run threads in this process
+        self.bleu_pool = multiprocessing.get_context("spawn").Pool(n_bleu_workers) if n_bleu_workers else None
+        self.pending_bleu_stats = list()
+        self.max_pending_bleu_stats = 4 * n_bleu_workers
+
+    def add_many(self, records: List[Dict]):
+        if not records:
+            return
+        if self.n_references is None:
+            self.n_references = len(records[0]["tgt_texts"])
+            self.distinct_ngrams = [DistinctNgrams(self.ks) for _ in range(self.n_references)]
+            self.bleu_stats = [np.zeros(10, dtype=np.int64) for _ in range(self.n_references)]
+        assert all([len(record["tgt_texts"]) == self.n_references for record in records])
+
+        src_texts = [record["src_text"] for record in records]
+        refs = [[record["tgt_texts"][ix] for record in records] for ix in range(self.n_references)]
+        self.first_src_texts += src_texts[:self.n_references - len(self.first_src_texts)]
+
+        for ix, ref in enumerate(refs):
+            if self.bleu_pool is None:
+                self.bleu_stats[ix] += corpus_bleu_stats(src_texts, ref)
+            else:
+                self.pending_bleu_stats.append((ix, self.bleu_pool.apply_async(corpus_bleu_stats, (src_texts, ref))))
+            self.distinct_ngrams[ix].add_many(ref)
+        # Bounds the number of chunks held by the BLEU task queue
+        while len(self.pending_bleu_stats) > self.max_pending_bleu_stats:
+            self.collect_bleu_stats(1)
+
+        if self.embedder is not None:
+            src_embeddings = self.embedder.embed_many(src_texts)
+            tgt_embeddings = self.embedder.embed_many([tgt_text for record in records for tgt_text in record["tgt_texts"]])
+            blocks = np.concatenate((
+                src_embeddings.reshape(len(records), 1, -1),
+                tgt_embeddings.reshape(len(records), self.n_references, -1)
+            ), axis=1)
+            self.similarities.append(mean_pairwise_cosine_similarity(blocks))
+
+    def collect_bleu_stats(self, n: int = None):
+        n = len(self.pending_bleu_stats) if n is None else n
+        for ix, result in self.pending_bleu_stats[:n]:
+            self.bleu_stats[ix] += result.get()
+        self.pending_bleu_stats = self.pending_bleu_stats[n:]
+
+    def compute(self) -> Dict:
+        self.collect_bleu_stats()
+        metrics = dict()
+        bleus = [corpus_bleu_from_stats(stats) for stats in self.bleu_stats]
+        metrics["bleus"] = bleus
+        metrics["bleu"] = np.mean(bleus)
+        for k in self.ks:
+            for lowercase in (False, True):
+                suffix = "_lowercased" if lowercase else ""
+                metrics[f"dist-{k}{suffix}"] = np.mean([
+                    distinct_ngrams.dist_k(k, lowercase=lowercase) for distinct_ngrams in self.distinct_ngrams
+                ])
+                # The i-th paraphrases are counted with the i-th source text of the file
+                metrics[f"dist-{k}_with_orig{suffix}"] = np.mean([
+                    distinct_ngrams.dist_k(k, lowercase=lowercase, extra_texts=[src_text])
+                    for distinct_ngrams, src_text in zip(self.distinct_ngrams, self.first_src_texts)
+                ])
+        if self.embedder is not None:
+            metrics["use_similarity"] = float(np.mean(np.concatenate(self.similarities)))
+        return metrics
+
+    def close(self):
+        if self.bleu_pool is not None:
+            self.bleu_pool.close()
+            self.bleu_pool.join()
+
+
+def paraphrase_bleu_diversity_metrics(src_texts: List[str], tgt_texts: List[List[str]]) -> Dict[str, float]:
+    """
+    BLEU and dist-k metrics of paraphrases, computed as in utils/scripts/paraphrase/evaluate-paraphrase-diversity.py:
+    the i-th paraphrases of all source texts form a corpus, metrics are averaged over these corpora.
+    :param tgt_texts: for each source text, its paraphrases (the same number for all source texts)
+    """
+    import sacrebleu
+
+    n_paraphrases = len(tgt_texts[0])
+    assert all([len(t) == n_paraphrases for t in tgt_texts])
+    refs = [[t[ix] for t in tgt_texts] for ix in range(n_paraphrases)]
+
+    metrics = dict()
+    metrics["bleu"] = float(np.mean([sacrebleu.corpus_bleu(src_texts, [r]).score for r in refs]))
+    for k in (2, 3):
+        for lower in (False, True):
+            metrics[f"dist-{k}{'_lowercased' if lower else ''}"] = float(np.mean([dist_k(r, k=k, lowercase=lower) for r in refs]))
+    return metrics
+
+
+def paraphrase_agreement_metrics(tgt_texts: List[List[str]], ref_tgt_texts: List[List[str]]) -> Dict[str, float]:
+    """
+    How much paraphrases differ from reference paraphrases of the same source texts (e.g. generated by an fp32 model)
+    """
+    import sacrebleu
+
+    pairs = [(t, r) for tgt, ref in zip(tgt_texts, ref_tgt_texts) for t, r in zip(tgt, ref)]
+    return {
+        "identical_sources": float(np.mean([tgt == ref for tgt, ref in zip(tgt_texts, ref_tgt_texts)])),
+        "identical_paraphrases": float(np.mean([t == r for t, r in pairs])),
+        "bleu_to_reference": sacrebleu.corpus_bleu([t for t, _ in pairs], [[r for _, r in pairs]]).score,
+    }
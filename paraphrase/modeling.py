@@ -1,10 +1,20 @@
 import numpy as np
+import os
 import random
+import threading
 import torch
 import logging
 from typing import List, Dict, Callable, Union
 from transformers.models.auto.tokenization_auto import BartTokenizerFast
-from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, LogitsProcessor
+from transformers.modeling_outputs import BaseModelOutput
+
+from models.encoders.sentence_embedder import get_sentence_embedder
+from paraphrase.bleu import select_min_bleu_candidates
+from paraphrase.vocabulary import RestrictedVocabulary
+from utils.batching import pad_token_ids
+from utils.clustering import batched_ward_clustering, closest_to_centroids
+from utils.token_store import TokenStore
 
 default_device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
@@ -13,6 +23,33 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+def get_paraphrase_device(device: Union[str, torch.device] = None, quantize: bool = False) -> torch.device:
+    """
+    :param device: `auto` (or None) picks the GPU if there is one, the CPU otherwise
+    :param quantize: int8 quantized models only run on CPU (`auto` then picks the CPU)
+    """
+    if device is None or device == "auto":
+        return torch.device("cpu") if quantize else default_device
+    device = torch.device(device)
+    if device.type == "cuda" and not torch.cuda.is_available():
+        raise ValueError(f"Paraphrase device `{device}` was requested, but CUDA isn't available. Use `cpu` or `auto`")
+    if quantize and device.type != "cpu":
+        raise ValueError(f"Quantized paraphrase models only run on CPU (device `{device}` was requested)")
+    return device
+
+
+def quantize_paraphrase_model(model):
+    """
+    Dynamic int8 quantization of the linear layers of a seq2seq model, in place: weights are stored in int8, activations
+    are quantized on the fly. Decoding on CPU gets faster, outputs may slightly differ from fp32 ones.
+    Applied once per model (check outputs with utils/scripts/paraphrase/quantization-quality-check.py).
+    """
+    if not getattr(model, "is_quantized", False):
+        torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        model.is_quantized = True
+    return model
+
+
 class ParaphraseModel:
     def __init__(self, device=None):
         self.device = device if device else default_device
@@ -20,6 +57,12 @@ class ParaphraseModel:
     def paraphrase(self, src_texts: List[str], **kwargs):
         raise NotImplementedError
 
+    def generation_config(self) -> Dict:
+        """
+        :return: everything that changes the output of `paraphrase` (used to key cached paraphrases)
+        """
+        raise NotImplementedError
+
 
 class BaseParaphraseModel(ParaphraseModel):
     def __init__(
@@ -28,11 +71,16 @@ class BaseParaphraseModel(ParaphraseModel):
             tok_name_or_path: str = None,
             num_return_sequences: int = 1,
             num_beams: int = None,
-            device=None
+            device=None,
+            quantize: bool = False
     ):
-        super().__init__(device=device)
-        self.device = device if device else default_device
+        """
+        :param quantize: dynamic int8 quantization of the model (CPU only, see `quantize_paraphrase_model`)
+        """
+        super().__init__(device=get_paraphrase_device(device, quantize=quantize))
         self.model = AutoModelForSeq2SeqLM.from_pretrained(model_name_or_path).to(self.device)
+        if quantize:
+            quantize_paraphrase_model(self.model)
         self.tok = AutoTokenizer.from_pretrained(tok_name_or_path if tok_name_or_path else model_name_or_path)
         self.num_return_sequences = num_return_sequences
         self.num_beams = num_beams if num_beams else self.num_return_sequences
@@ -86,52 +134,154 @@ class DropChances:
             raise NotImplementedError
 
 
-class ForbidStrategies:
-    def __init__(self, special_ids: List[int]):
-        self.special_ids = special_ids
+class NgramBans:
+    """
+    Per-row banned n-grams (unigrams and bigrams), as padded tensors (n_rows x n_bans):
+        - `prefix_ids`: token which must end the generated text for the ban to apply (`UNIGRAM`: always applies)
+        - `next_ids`: banned token
+        - `valid`: whether the entry is a ban or padding
+    Bans of row `i` only apply to the beams generated from the i-th source text.
+    """
+    UNIGRAM = -1
+
+    def __init__(self, prefix_ids: torch.Tensor, next_ids: torch.Tensor, valid: torch.Tensor):
+        self.prefix_ids = prefix_ids
+        self.next_ids = next_ids
+        self.valid = valid
+
+    @staticmethod
+    def non_special_positions(input_ids: torch.Tensor, special_ids: List[int]):
+        """
+        :return: mask of non-special tokens, position of each token among the non-special tokens of its row,
+            number of non-special tokens of each row
+        """
+        is_special = (input_ids.unsqueeze(-1) == torch.tensor(special_ids, device=input_ids.device)).any(-1)
+        non_special = ~is_special
+        positions = non_special.long().cumsum(dim=1) - 1
+        return non_special, positions, non_special.sum(dim=1)
+
+    @classmethod
+    def unigram_drops(cls, input_ids: torch.Tensor, special_ids: List[int], drop_chance_fn: Callable, rng=None) -> "NgramBans":
+        """
+        Each non-special token is banned with probability `drop_chance_fn(position, n_tokens)`, positions and lengths
+        ignoring special tokens.
+        :param rng: numpy random generator (defaults to the global numpy generator)
+        """
+        rng = rng if rng is not None else np.random
+        non_special, positions, lengths = cls.non_special_positions(input_ids, special_ids)
+        drop_chances = drop_chance_fn(positions.float(), lengths.unsqueeze(1).float())
+        if not torch.is_tensor(drop_chances):
+            drop_chances = torch.full(input_ids.shape, drop_chances, device=input_ids.device)
+        draws = torch.from_numpy(rng.random_sample(tuple(input_ids.shape))).float().to(input_ids.device)
+        return cls(
+            prefix_ids=torch.full_like(input_ids, cls.UNIGRAM),
+            next_ids=input_ids,
+            valid=non_special & (draws < drop_chances)
+        )
+
+    @classmethod
+    def bigrams(cls, input_ids: torch.Tensor, special_ids: List[int]) -> "NgramBans":
+        """
+        Bans every bigram of non-special tokens of the row.
+        """
+        non_special, positions, _ = cls.non_special_positions(input_ids, special_ids)
+        n_rows, length = input_ids.shape
+
+        # Move non-special tokens to the left of each row (special tokens are all written to an extra, dropped column)
+        compact = torch.full((n_rows, length + 1), -1, dtype=input_ids.dtype, device=input_ids.device)
+        compact.scatter_(1, torch.where(non_special, positions, torch.full_like(positions, length)), input_ids)
+        compact = compact[:, :length]
+
+        prefix_ids, next_ids = compact[:, :-1], compact[:, 1:]
+        return cls(prefix_ids=prefix_ids, next_ids=next_ids, valid=(prefix_ids >= 0) & (next_ids >= 0))
+
+    def restricted(self, to_restricted: torch.Tensor) -> "NgramBans":
+        """
+        Same bans, for a model generating restricted vocabulary ids (see `paraphrase.vocabulary.RestrictedVocabulary`).
+        Bans involving a token outside of the vocabulary are dropped, as it can't be generated anyway.
+        :param to_restricted: restricted id of each full vocabulary id, -1 if not in the restricted vocabulary
+        """
+        to_restricted = to_restricted.to(self.next_ids.device)
+        is_unigram = self.prefix_ids == self.UNIGRAM
+        next_ids = to_restricted[self.next_ids.clamp(min=0)]
+        prefix_ids = torch.where(is_unigram, self.prefix_ids, to_restricted[self.prefix_ids.clamp(min=0)])
+        return NgramBans(
+            prefix_ids=prefix_ids,
+            next_ids=next_ids,
+            valid=self.valid & (next_ids >= 0) & (is_unigram | (prefix_ids >= 0))
+        )
+
+    def __len__(self):
+        return int(self.valid.sum().item())
+
+
+class NgramBanLogitsProcessor(LogitsProcessor):
+    """
+    Sets the score of banned tokens to -inf, with per-row `NgramBans`. Each step costs a fixed number of tensor operations,
+    whatever the number of bans (unlike `bad_words_ids`, which loops over banned n-grams in Python).
+    Generated sequences are assumed to be grouped by source row (beams of row 0, then beams of row 1...), which holds for
+    beam search and group beam search.
+    """
 
-    def unigram_dropping_strategy(self, input_ids: torch.Tensor, drop_chance_fn: Callable):
-        bad_words_ids = list()
-        for row in input_ids.tolist():
-            row = [item for item in row if item not in self.special_ids]
-            for item_ix, item in enumerate(row):
-                drop_chance = drop_chance_fn(item_ix, len(row))
-                if random.random() < drop_chance:
-                    bad_words_ids.append(item)
+    def __init__(self, bans: NgramBans):
+        self.bans = bans
 
-        # Reshape to correct format
-        bad_words_ids = [[item] for item in bad_words_ids]
-        return bad_words_ids
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        n_rows = self.bans.valid.size(0)
+        row_ixs = torch.arange(input_ids.size(0), device=input_ids.device) // (input_ids.size(0) // n_rows)
+        prefix_ids = self.bans.prefix_ids.to(input_ids.device)[row_ixs]
+        next_ids = self.bans.next_ids.to(input_ids.device)[row_ixs]
+        valid = self.bans.valid.to(input_ids.device)[row_ixs]
 
-    def bigram_dropping_strategy(self, input_ids: torch.Tensor):
-        bad_words_ids = list()
-        for row in input_ids.tolist():
-            row = [item for item in row if item not in self.special_ids]
-            for i in range(0, len(row) - 1):
-                bad_words_ids.append(row[i:i + 2])
-        return bad_words_ids
+        active = valid & ((prefix_ids == NgramBans.UNIGRAM) | (prefix_ids == input_ids[:, -1:]))
+        n_bans = torch.zeros_like(scores).scatter_add_(1, next_ids.clamp(min=0), active.to(scores.dtype))
+        return scores.masked_fill(n_bans > 0, -float("inf"))
 
 
 class BaseParaphraseBatchPreparer:
-    def __init__(self, tokenizer: BartTokenizerFast, device=None):
+    def __init__(self, tokenizer: BartTokenizerFast, device=None, token_store: TokenStore = None):
         self.tokenizer = tokenizer
         self.device = device if device else default_device
-
-    def prepare_batch(self, src_texts: List[str]):
-        batch = self.tokenizer.prepare_seq2seq_batch(src_texts=src_texts, return_tensors="pt", max_length=512)
-        batch = {k: v.to(self.device) for k, v in batch.items()}
-        self.pimp_batch(batch)
+        self.token_store = token_store
+        self.max_length = 512
+        self.lock = threading.Lock()
+
+    def prepare_batch(self, src_texts: List[str], rng=None):
+        """
+        :param rng: numpy random generator used by drop strategies (defaults to the global `random` module)
+        """
+        batch = self.tokenize_batch(src_texts)
+        self.pimp_batch(batch, rng=rng)
         return batch
 
+    def tokenize_batch(self, src_texts: List[str]) -> Dict[str, torch.Tensor]:
+        """
+        :return: padded `input_ids` and `attention_mask` of `src_texts`, on `self.device`, without drop strategy
+        """
+        # Fast tokenizers can't be used by several threads at once
+        with self.lock:
+            if self.token_store:
+                input_ids, attention_mask = pad_token_ids(
+                    self.token_store.encode(src_texts, tokenizer=self.tokenizer, max_length=self.max_length),
+                    pad_token_id=self.tokenizer.pad_token_id
+                )
+                batch = {"input_ids": input_ids, "attention_mask": attention_mask}
+            else:
+                batch = self.tokenizer.prepare_seq2seq_batch(src_texts=src_texts, return_tensors="pt", max_length=self.max_length)
+        return {k: v.to(self.device) for k, v in batch.items()}
+
     def pimp_batch(self, batch: Dict[str, torch.Tensor], **kwargs):
         # This must be implemented elsewhere!
         return
 
+    def generation_config(self) -> Dict:
+        return {"preparer": type(self).__name__, "max_length": self.max_length}
+
 
 class UnigramRandomDropParaphraseBatchPreparer(BaseParaphraseBatchPreparer):
 
-    def __init__(self, tokenizer: BartTokenizerFast, auc: float = None, drop_chance_speed: str = None, device=None):
-        super().__init__(tokenizer=tokenizer, device=device)
+    def __init__(self, tokenizer: BartTokenizerFast, auc: float = None, drop_chance_speed: str = None, device=None, token_store: TokenStore = None):
+        super().__init__(tokenizer=tokenizer, device=device, token_store=token_store)
 
         # Args checking
         self.auc = auc
@@ -140,24 +290,27 @@ class UnigramRandomDropParaphraseBatchPreparer(BaseParaphraseBatchPreparer):
         assert self.drop_chance_speed in ("flat", "slow", "fast", "up", "down")
 
     def pimp_batch(self, batch: Dict[str, torch.Tensor], **kwargs):
-        bad_words_ids = ForbidStrategies(
-            special_ids=self.tokenizer.all_special_ids
-        ).unigram_dropping_strategy(
+        bans = NgramBans.unigram_drops(
             batch["input_ids"],
-            drop_chance_fn=DropChances(auc=self.auc).get_drop_fn(self.drop_chance_speed)
+            special_ids=self.tokenizer.all_special_ids,
+            drop_chance_fn=DropChances(auc=self.auc).get_drop_fn(self.drop_chance_speed),
+            rng=kwargs.get("rng")
         )
-        if len(bad_words_ids):
-            batch["bad_words_ids"] = bad_words_ids
+        if len(bans):
+            batch["logits_processors"] = [NgramBanLogitsProcessor(bans)]
+
+    def generation_config(self) -> Dict:
+        return {**super().generation_config(), "auc": self.auc, "drop_chance_speed": self.drop_chance_speed}
 
 
 class BigramDropParaphraseBatchPreparer(BaseParaphraseBatchPreparer):
-    def __init__(self, tokenizer: BartTokenizerFast, device=None):
-        super().__init__(tokenizer=tokenizer, device=device)
+    def __init__(self, tokenizer: BartTokenizerFast, device=None, token_store: TokenStore = None):
+        super().__init__(tokenizer=tokenizer, device=device, token_store=token_store)
 
     def pimp_batch(self, batch: Dict[str, torch.Tensor], **kwargs):
-        bad_words_ids = ForbidStrategies(special_ids=self.tokenizer.all_special_ids).bigram_dropping_strategy(batch["input_ids"])
-        if len(bad_words_ids):
-            batch["bad_words_ids"] = bad_words_ids
+        bans = NgramBans.bigrams(batch["input_ids"], special_ids=self.tokenizer.all_special_ids)
+        if len(bans):
+            batch["logits_processors"] = [NgramBanLogitsProcessor(bans)]
 
 
 def tune_batch_random_drop(batch: Dict[str, torch.Tensor], drop_prob: float = 1):
@@ -176,9 +329,15 @@ def bleu_score(src: str, dst: str):
     return sentence_bleu(dst, [src]).score
 
 
-def filter_generated_texts_with_clustering(texts: List[str], n_return_sequences: int):
+def filter_generated_texts_with_clustering(texts: List[str], n_return_sequences: int, embedder=None):
+    """
+    :param embedder: object with an `embed_many(texts) -> np.ndarray` method (defaults to the USE embedder)
+    """
     assert len(texts) >= n_return_sequences
-    embeddings = use_embedder.embed_many(texts)
+    if embedder is None:
+        from models.use import get_use_embedder
+        embedder = get_use_embedder()
+    embeddings = embedder.embed_many(texts)
 
     # KMeans (this is too slow)
     # from sklearn.cluster import KMeans, AgglomerativeClustering
@@ -207,6 +366,27 @@ def filter_generated_texts_with_clustering(texts: List[str], n_return_sequences:
     return output
 
 
+def filter_generated_texts_with_clustering_batch(texts: List[List[str]], n_return_sequences: int, embedder) -> List[List[str]]:
+    """
+    Batched `filter_generated_texts_with_clustering`: embeds the candidates of all sources in a single call, clusters
+    the candidates of each source (Ward linkage) and picks the candidate closest to each cluster's mean, for all
+    sources at once.
+    :param texts: candidates of each source (same number of candidates for each source)
+    :param embedder: object with an `embed_many(texts) -> np.ndarray` method
+    """
+    n_candidates = len(texts[0])
+    assert n_candidates >= n_return_sequences and all([len(candidates) == n_candidates for candidates in texts])
+    embeddings = embedder.embed_many([text for candidates in texts for text in candidates])
+    embeddings = np.asarray(embeddings).reshape(len(texts), n_candidates, -1)
+
+    labels = batched_ward_clustering(embeddings, n_clusters=n_return_sequences)
+    selected = closest_to_centroids(embeddings, labels)
+    return [
+        [candidates[ix] for ix in selected_]
+        for candidates, selected_ in zip(texts, selected.tolist())
+    ]
+
+
 def filter_generated_texts_with_distance_metric(texts: List[List[str]], src: str, distance_metric_fn: Callable[[str, str], float], lower_is_better: bool = True):
     scores = [
         [distance_metric_fn(src, text) for text in group]
@@ -223,6 +403,44 @@ def filter_generated_texts_with_distance_metric(texts: List[List[str]], src: str
     ]
 
 
+def install_logits_processors_hook(model) -> threading.local:
+    """
+    `generate` of transformers 4.1 doesn't take custom logits processors: wraps `model._get_logits_processor` so that it
+    appends the processors set on the returned (thread-local) holder, under `processors`. Installed once per model.
+    """
+    if not hasattr(model, "extra_logits_processors"):
+        get_logits_processor = model._get_logits_processor
+        extra_logits_processors = threading.local()
+
+        def _get_logits_processor(*args, **kwargs):
+            processors = get_logits_processor(*args, **kwargs)
+            processors.extend(getattr(extra_logits_processors, "processors", list()))
+            return processors
+
+        model._get_logits_processor = _get_logits_processor
+        model.extra_logits_processors = extra_logits_processors
+    return model.extra_logits_processors
+
+
+def install_encoder_outputs_hook(model):
+    """
+    `generate` of transformers 4.1 always runs the encoder: wraps `model._prepare_encoder_decoder_kwargs_for_generation`
+    so that `encoder_outputs` passed to `generate` are used instead. They are copied, as `generate` overwrites their
+    hidden states with beam-expanded ones. Installed once per model.
+    """
+    if not hasattr(model, "prepare_encoder_outputs"):
+        prepare_encoder_outputs = model._prepare_encoder_decoder_kwargs_for_generation
+
+        def _prepare_encoder_decoder_kwargs_for_generation(input_ids, model_kwargs):
+            if "encoder_outputs" not in model_kwargs:
+                return prepare_encoder_outputs(input_ids, model_kwargs)
+            model_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=model_kwargs["encoder_outputs"].last_hidden_state)
+            return model_kwargs
+
+        model._prepare_encoder_decoder_kwargs_for_generation = _prepare_encoder_decoder_kwargs_for_generation
+        model.prepare_encoder_outputs = prepare_encoder_outputs
+
+
 class DBSParaphraseModel(ParaphraseModel):
     def __init__(
             self,
@@ -233,11 +451,26 @@ class DBSParaphraseModel(ParaphraseModel):
             diversity_penalty: float = 1.0,
             filtering_strategy: str = None,
             paraphrase_batch_preparer: BaseParaphraseBatchPreparer = None,
-            device=None
+            device=None,
+            embedder=None,
+            model=None,
+            tokenizer=None,
+            vocabulary: RestrictedVocabulary = None,
+            quantize: bool = False
     ):
-        super().__init__(device=device)
-        self.model = AutoModelForSeq2SeqLM.from_pretrained(model_name_or_path).to(self.device)
-        self.tokenizer = AutoTokenizer.from_pretrained(tok_name_or_path if tok_name_or_path else model_name_or_path)
+        """
+        :param embedder: sentence embedder used by the `clustering` filtering strategy, with an `embed_many` method and an
+            `embedder_id` (see `models.encoders.sentence_embedder.SentenceEmbedder`). Defaults to the USE embedder.
+        :param model: already loaded `model_name_or_path` model, shared with other paraphrase models (e.g. in a sweep)
+        :param tokenizer: already loaded `tok_name_or_path` tokenizer
+        :param vocabulary: if set, the model only generates tokens of this vocabulary (faster decoding)
+        :param quantize: dynamic int8 quantization of the model (CPU only, see `quantize_paraphrase_model`)
+        """
+        super().__init__(device=get_paraphrase_device(device, quantize=quantize))
+        self.model_name_or_path = model_name_or_path
+        self.tok_name_or_path = tok_name_or_path if tok_name_or_path else model_name_or_path
+        self.model = model if model is not None else AutoModelForSeq2SeqLM.from_pretrained(model_name_or_path).to(self.device)
+        self.tokenizer = tokenizer if tokenizer is not None else AutoTokenizer.from_pretrained(self.tok_name_or_path)
         self.num_return_sequences = self.num_beams = num_beams
         self.beam_group_size = beam_group_size
         self.num_beam_groups = self.num_beams // self.beam_group_size
@@ -247,57 +480,232 @@ class DBSParaphraseModel(ParaphraseModel):
         if paraphrase_batch_preparer is None:
             paraphrase_batch_preparer = BaseParaphraseBatchPreparer(tokenizer=self.tokenizer)
         self.paraphrase_batch_preparer = paraphrase_batch_preparer
+        self.extra_logits_processors = install_logits_processors_hook(self.model)
+        install_encoder_outputs_hook(self.model)
+        if vocabulary is not None:
+            vocabulary.apply(self.model)
+        elif hasattr(self.model, "restricted_vocabulary"):
+            raise ValueError("Model is restricted to a vocabulary: pass it as `vocabulary`")
+        self.vocabulary = vocabulary
+        # After the vocabulary restriction, so that the restricted output projection is quantized too
+        if quantize:
+            quantize_paraphrase_model(self.model)
+        elif getattr(self.model, "is_quantized", False):
+            raise ValueError("Model is quantized: pass `quantize=True`")
+        self.quantize = quantize
+        if self.filtering_strategy == "clustering" and embedder is None:
+            from models.use import get_use_embedder
+            embedder = get_use_embedder()
+        self.embedder = embedder
+
+    def encode(self, src_texts: List[str]) -> BaseModelOutput:
+        """
+        Runs the encoder on `src_texts`, batched as `paraphrase` does. The output can be passed to `paraphrase` of every
+        paraphrase model sharing this model and tokenizer, which then only decode.
+        """
+        batch = self.paraphrase_batch_preparer.tokenize_batch(src_texts)
+        with torch.no_grad():
+            return self.model.get_encoder()(**batch, return_dict=True)
 
     def paraphrase(self, src_texts: List[str], **kwargs):
-        batch = self.paraphrase_batch_preparer.prepare_batch(src_texts=src_texts)
-        max_length = batch["input_ids"].shape[1]
-        with torch.no_grad():
-            preds = self.model.generate(
-                **batch,
-                max_length=max_length,
-                num_beams=self.num_beams,
-                num_beam_groups=self.beam_group_size,
-                diversity_penalty=self.diversity_penalty,
-                num_return_sequences=self.num_return_sequences
-            )
+        """
+        :param kwargs: `rng` (drop strategies), `max_length` (generation), `encoder_outputs` (see `encode`)
+        """
+        batch = self.paraphrase_batch_preparer.prepare_batch(src_texts=src_texts, rng=kwargs.get("rng"))
+        # Generated texts are at most as long as the (padded) source batch, unless told otherwise
+        max_length = kwargs.get("max_length") if kwargs.get("max_length") else batch["input_ids"].shape[1]
+        if kwargs.get("encoder_outputs") is not None:
+            batch["encoder_outputs"] = kwargs["encoder_outputs"]
+        logits_processors = batch.pop("logits_processors", list())
+        if self.vocabulary is not None:
+            logits_processors = [NgramBanLogitsProcessor(processor.bans.restricted(self.vocabulary.to_restricted)) for processor in logits_processors]
+        self.extra_logits_processors.processors = logits_processors
+        try:
+            with torch.no_grad():
+                preds = self.model.generate(
+                    **batch,
+                    max_length=max_length,
+                    num_beams=self.num_beams,
+                    num_beam_groups=self.beam_group_size,
+                    diversity_penalty=self.diversity_penalty,
+                    num_return_sequences=self.num_return_sequences
+                )
+        finally:
+            self.extra_logits_processors.processors = list()
 
+        if self.vocabulary is not None:
+            preds = self.vocabulary.to_full[preds]
         tgt_texts = self.tokenizer.batch_decode(preds.detach().cpu(), skip_special_tokens=True)
 
         batches = [tgt_texts[i:i + self.num_return_sequences] for i in range(0, len(src_texts) * self.num_return_sequences, self.num_return_sequences)]
 
-        output = list()
-
-        for src, batch in zip(src_texts, batches):
-            if self.filtering_strategy == "clustering":
-                filtered = filter_generated_texts_with_clustering(batch, self.num_beam_groups)
-            elif self.filtering_strategy == "bleu":
-                filtered = filter_generated_texts_with_distance_metric(
-                    texts=[batch[i:i + self.beam_group_size] for i in range(0, len(batch), self.beam_group_size)],
-                    src=src,
-                    distance_metric_fn=bleu_score,
-                    lower_is_better=True
-                )
-            else:
-                raise ValueError
-            output.append(filtered)
+        if self.filtering_strategy == "bleu":
+            # Scores all candidates of the batch at once
+            return select_min_bleu_candidates(
+                groups=[[batch[i:i + self.beam_group_size] for i in range(0, len(batch), self.beam_group_size)] for batch in batches],
+                src_texts=src_texts
+            )
 
-        return output
+        if self.filtering_strategy == "clustering":
+            # Embeds and clusters candidates of the whole batch at once
+            return filter_generated_texts_with_clustering_batch(batches, self.num_beam_groups, embedder=self.embedder)
+
+        raise ValueError
+
+    def generation_config(self) -> Dict:
+        if self.filtering_strategy == "clustering" and not getattr(self.embedder, "embedder_id", None):
+            raise ValueError(f"{type(self.embedder).__name__} has no `embedder_id`: paraphrases filtered with it can't be keyed")
+        return {
+            "model": os.path.abspath(self.model_name_or_path) if os.path.exists(self.model_name_or_path) else self.model_name_or_path,
+            "tokenizer": os.path.abspath(self.tok_name_or_path) if os.path.exists(self.tok_name_or_path) else self.tok_name_or_path,
+            "num_beams": self.num_beams,
+            "beam_group_size": self.beam_group_size,
+            "diversity_penalty": self.diversity_penalty,
+            "filtering_strategy": self.filtering_strategy,
+            **({"clustering_embedder": self.embedder.embedder_id} if self.filtering_strategy == "clustering" else dict()),
+            **({"restricted_vocabulary": self.vocabulary.fingerprint} if self.vocabulary is not None else dict()),
+            **({"quantized": "int8-dynamic"} if self.quantize else dict()),
+            **self.paraphrase_batch_preparer.generation_config()
+        }
 
 
 class EDAParaphraseModel(ParaphraseModel):
     def __init__(
             self,
-            num_paraphrases: int = 5
+            num_paraphrases: int = 5,
+            synonyms_path: str = None,
+            n_workers: int = 0,
+            random_synonym_insertion: bool = False
     ):
+        """
+        :param synonyms_path: precomputed WordNet synonyms (see `paraphrase.eda.SynonymIndex`). Other words are looked up
+            in WordNet once.
+        :param n_workers: number of processes augmenting sentences of a batch in parallel (0: in the calling process)
+        :param random_synonym_insertion: random insertion inserts a random synonym of the chosen word, instead of its
+            first (alphabetically) synonym as in the original EDA implementation
+        """
+        from .eda import SynonymIndex, synonym_index
+
         logger.info(f"Instancing EDAParaphraseModel(num_paraphrases={num_paraphrases}) to generate paraphrases")
         self.num_paraphrases = num_paraphrases
+        self.synonyms = SynonymIndex.load(synonyms_path) if synonyms_path else synonym_index
+        self.n_workers = n_workers
+        self.random_synonym_insertion = random_synonym_insertion
+        self.pool = None
         super().__init__(device=None)
 
     def paraphrase(self, src_texts: List[str], **kwargs):
-        from .eda import eda
+        from .eda import eda_many, get_eda_pool
 
-        output = list()
-        for text in src_texts:
-            paraphrases = eda(text, num_aug=self.num_paraphrases)
-            output.append(paraphrases)
-        return output
+        # One seed per sentence, so that augmentations don't depend on how sentences are spread over workers
+        rng = kwargs.get("rng")
+        if rng is not None:
+            seeds = rng.randint(2 ** 31, size=len(src_texts)).tolist()
+        else:
+            seeds = [random.getrandbits(31) for _ in src_texts]
+        if self.n_workers and self.pool is None:
+            self.pool = get_eda_pool(self.n_workers, synonyms=self.synonyms)
+        return eda_many(src_texts, seeds, num_aug=self.num_paraphrases, synonyms=self.synonyms, pool=self.pool, random_synonym_insertion=self.random_synonym_insertion)
+
+    def generation_config(self) -> Dict:
+        return {
+            "model": "eda",
+            "num_paraphrases": self.num_paraphrases,
+            **({"random_synonym_insertion": True} if self.random_synonym_insertion else dict())
+        }
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def build_paraphrase_batch_preparer(
+        tokenizer: BartTokenizerFast,
+        drop_strategy: str = None,
+        drop_chance_speed: str = None,
+        drop_chance_auc: float = None,
+        device=None,
+        token_store: TokenStore = None) -> BaseParaphraseBatchPreparer:
+    if drop_strategy == "unigram":
+        return UnigramRandomDropParaphraseBatchPreparer(
+            tokenizer=tokenizer,
+            auc=drop_chance_auc,
+            drop_chance_speed=drop_chance_speed,
+            device=device,
+            token_store=token_store
+        )
+    elif drop_strategy == "bigram":
+        return BigramDropParaphraseBatchPreparer(tokenizer=tokenizer, device=device, token_store=token_store)
+    else:
+        return BaseParaphraseBatchPreparer(tokenizer=tokenizer, device=device, token_store=token_store)
+
+
+def build_dbs_paraphrase_model(
+        model_name_or_path: str,
+        tok_name_or_path: str = None,
+        num_beams: int = None,
+        beam_group_size: int = None,
+        diversity_penalty: float = None,
+        filtering_strategy: str = None,
+        drop_strategy: str = None,
+        drop_chance_speed: str = None,
+        drop_chance_auc: float = None,
+        device: Union[str, torch.device] = None,
+        token_store_path: str = None,
+        clustering_embedder_name_or_path: str = None,
+        clustering_embedding_store_path: str = None,
+        restricted_vocabulary_path: str = None,
+        quantize: bool = False,
+        share_with: DBSParaphraseModel = None) -> DBSParaphraseModel:
+    """
+    Builds a `DBSParaphraseModel` and its batch preparer from plain arguments (e.g. in a paraphrase worker process).
+    :param token_store_path: root of a pre-tokenized corpus store (see `utils.token_store`)
+    :param clustering_embedder_name_or_path: local encoder embedding candidates for the `clustering` filtering strategy
+    :param clustering_embedding_store_path: if set, candidate embeddings are persisted there across runs (see
+        `utils.embedding_store`), and only candidates never embedded before are embedded
+    :param device: `cpu`, `cuda`, `cuda:<ix>` or `auto` (see `get_paraphrase_device`)
+    :param restricted_vocabulary_path: restricted output vocabulary (see `paraphrase.vocabulary.RestrictedVocabulary`)
+    :param quantize: dynamic int8 quantization of the model (CPU only)
+    :param share_with: paraphrase model of the same checkpoint, whose model, tokenizer and clustering embedder are reused
+        instead of being loaded again (e.g. configs of a sweep)
+    """
+    device = get_paraphrase_device(device, quantize=quantize)
+    logger.info(f"Paraphrase model device: {device}{' (int8 quantized)' if quantize else ''}")
+    if share_with is not None:
+        tokenizer = share_with.tokenizer
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(tok_name_or_path if tok_name_or_path else model_name_or_path)
+    if share_with is not None and share_with.embedder is not None:
+        embedder = share_with.embedder
+    elif clustering_embedder_name_or_path:
+        embedder = get_sentence_embedder(clustering_embedder_name_or_path, store_path=clustering_embedding_store_path, device=device)
+    elif filtering_strategy == "clustering" and clustering_embedding_store_path:
+        embedder = get_sentence_embedder("use", store_path=clustering_embedding_store_path)
+    else:
+        embedder = None
+    vocabulary = RestrictedVocabulary.load(restricted_vocabulary_path, tokenizer) if restricted_vocabulary_path else None
+    paraphrase_batch_preparer = build_paraphrase_batch_preparer(
+        tokenizer=tokenizer,
+        drop_strategy=drop_strategy,
+        drop_chance_speed=drop_chance_speed,
+        drop_chance_auc=drop_chance_auc,
+        device=device,
+        token_store=TokenStore.load(token_store_path, tokenizer) if token_store_path else None
+    )
+    return DBSParaphraseModel(
+        model_name_or_path=model_name_or_path,
+        tok_name_or_path=tok_name_or_path,
+        num_beams=num_beams,
+        beam_group_size=beam_group_size,
+        diversity_penalty=diversity_penalty,
+        filtering_strategy=filtering_strategy,
+        paraphrase_batch_preparer=paraphrase_batch_preparer,
+        device=device,
+        embedder=embedder,
+        model=share_with.model if share_with is not None else None,
+        tokenizer=share_with.tokenizer if share_with is not None else None,
+        vocabulary=vocabulary,
+        quantize=quantize
+    )
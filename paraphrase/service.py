@@ -0,0 +1,205 @@
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+import logging
+from concurrent.futures import Future
+from typing import List, Dict
+
+import numpy as np
+
+from paraphrase.modeling import ParaphraseModel, EDAParaphraseModel, build_dbs_paraphrase_model
+from paraphrase.cache import ParaphraseCache, CachedParaphraseModel
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def build_paraphrase_model(spec: Dict) -> ParaphraseModel:
+    """
+    :param spec: {
+        "generation_method": "dbs" (default) or "eda",
+        "model": kwargs of `build_dbs_paraphrase_model` (dbs) or of `EDAParaphraseModel` (eda, optional),
+        "cache": optional {"path", "max_samples", "max_entries", "refresh_prob"}, to serve paraphrases from a `ParaphraseCache`
+    }
+    """
+    generation_method = spec.get("generation_method", "dbs")
+    if generation_method == "dbs":
+        model = build_dbs_paraphrase_model(**spec["model"])
+    elif generation_method == "eda":
+        model = EDAParaphraseModel(**spec.get("model", {"num_paraphrases": 5}))
+    else:
+        raise NotImplementedError(f"Paraphrase generation method `{generation_method}` not recognised.")
+
+    cache_spec = spec.get("cache")
+    if cache_spec:
+        model = CachedParaphraseModel(
+            model=model,
+            cache=ParaphraseCache(cache_spec["path"], max_samples=cache_spec["max_samples"], max_entries=cache_spec["max_entries"]),
+            refresh_prob=cache_spec["refresh_prob"]
+        )
+    return model
+
+
+def paraphrase_worker(spec: Dict, n_threads: int, requests: multiprocessing.Queue, results: multiprocessing.Queue):
+    import torch
+    if n_threads:
+        torch.set_num_threads(n_threads)
+    try:
+        model = build_paraphrase_model(spec)
+    except Exception:
+        results.put(("ready", None, traceback.format_exc()))
+        return
+    results.put(("ready", None, None))
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, src_texts, seed = request
+        try:
+            tgt_texts = model.paraphrase(src_texts, rng=np.random.RandomState(seed))
+            results.put((request_id, tgt_texts, None))
+        except Exception:
+            results.put((request_id, None, traceback.format_exc()))
+
+
+class ParaphraseService(ParaphraseModel):
+    """
+    Paraphrase model served by worker processes, each one owning a copy of the model.
+    Requests are queued with `submit`, which returns a future, so that paraphrases of future episodes can be generated
+    while the current step trains. Any worker may serve a request: its random generator is seeded by the client, so that
+    results don't depend on which worker served it.
+    """
+
+    def __init__(self, spec: Dict, n_workers: int = 1, n_threads: int = None, startup_timeout: float = 3600.0, poll_interval: float = 1.0):
+        """
+        :param spec: model spec (see `build_paraphrase_model`). It must be picklable.
+        :param n_threads: number of torch threads of each worker (e.g. so that workers and the encoder don't compete
+            for the same cores)
+        :param startup_timeout: max time (s) for workers to load their model
+        :param poll_interval: how often (s) workers are checked for liveness while waiting for them
+        """
+        super().__init__(device=None)
+        assert n_workers > 0
+        context = multiprocessing.get_context("spawn")
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.workers = [
+            context.Process(target=paraphrase_worker, args=(spec, n_threads, self.requests, self.results), daemon=True)
+            for _ in range(n_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+        self.poll_interval = poll_interval
+        logger.info(f"Starting {n_workers} paraphrase worker(s) ({n_threads if n_threads else 'default'} thread(s) each)")
+        try:
+            self.wait_ready(startup_timeout)
+        except BaseException:
+            self.terminate()
+            raise
+
+        self.request_ids = itertools.count()
+        self.futures: Dict[int, Future] = dict()
+        self.lock = threading.Lock()
+        # Set when a worker died: its in-flight requests are lost, so the service stops serving
+        self.error: Exception = None
+        self.closing = False
+        self.receiver = threading.Thread(target=self.receive, daemon=True)
+        self.receiver.start()
+
+    def dead_workers(self) -> List[int]:
+        return [worker_ix for worker_ix, worker in enumerate(self.workers) if worker.exitcode is not None]
+
+    def wait_ready(self, timeout: float):
+        """
+        Waits until all workers loaded their model. Raises if a worker failed to load it, died, or the timeout is reached.
+        """
+        n_ready = 0
+        start = time.time()
+        while n_ready < len(self.workers):
+            try:
+                _, _, error = self.results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                dead_workers = self.dead_workers()
+                if dead_workers:
+                    raise RuntimeError(f"Paraphrase worker(s) {dead_workers} died while loading their model "
+                                       f"(exit codes {[self.workers[ix].exitcode for ix in dead_workers]})")
+                if time.time() - start > timeout:
+                    raise TimeoutError(f"Paraphrase workers not ready after {timeout}s ({n_ready} / {len(self.workers)} ready)")
+                continue
+            if error is not None:
+                raise RuntimeError(f"Paraphrase worker failed to load its model:\n{error}")
+            n_ready += 1
+
+    def terminate(self):
+        # Queued requests will never be read: don't wait for them to be flushed when this process exits
+        self.requests.cancel_join_thread()
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            worker.join()
+
+    def fail_pending(self, error: Exception):
+        with self.lock:
+            self.error = error
+            futures = list(self.futures.values())
+            self.futures.clear()
+        for future in futures:
+            future.set_exception(error)
+
+    def receive(self):
+        while True:
+            try:
+                result = self.results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                dead_workers = self.dead_workers()
+                if dead_workers and not self.closing:
+                    self.fail_pending(RuntimeError(
+                        f"Paraphrase worker(s) {dead_workers} died (exit codes {[self.workers[ix].exitcode for ix in dead_workers]}): "
+                        f"their requests are lost"
+                    ))
+                    self.terminate()
+                    break
+                continue
+            if result is None:
+                break
+            request_id, tgt_texts, error = result
+            with self.lock:
+                future = self.futures.pop(request_id)
+            if error is not None:
+                future.set_exception(RuntimeError(f"Paraphrase worker failed:\n{error}"))
+            else:
+                future.set_result(tgt_texts)
+
+    def submit(self, src_texts: List[str], rng=None) -> Future:
+        """
+        :return: future of the paraphrases of `src_texts` (same output as `paraphrase`)
+        """
+        rng = rng if rng is not None else np.random
+        future = Future()
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            request_id = next(self.request_ids)
+            self.futures[request_id] = future
+        self.requests.put((request_id, list(src_texts), int(rng.randint(2 ** 31 - 1))))
+        return future
+
+    def paraphrase(self, src_texts: List[str], rng=None, **kwargs):
+        return self.submit(src_texts, rng=rng).result()
+
+    def close(self):
+        self.closing = True
+        if self.error is None:
+            for _ in self.workers:
+                self.requests.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.results.put(None)
+        self.receiver.join()
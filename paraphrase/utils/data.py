@@ -1,6 +1,7 @@
 import numpy as np
 import collections
-from typing import List, Dict, Callable, Union
+import json
+from typing import List, Dict, Callable, Union, Tuple
 
 import random
 from torch.utils.data import Dataset
@@ -8,11 +9,11 @@ from transformers.models.auto.tokenization_auto import BartTokenizerFast
 
 from paraphrase.modeling import ParaphraseModel
 from utils.data import get_jsonl_data, get_txt_data
+from utils.sampling import EpisodeSampler, UnlabeledPool
 import torch
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 import logging
 import time
-from models.use import USEEmbedder
 
 device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
@@ -37,6 +38,8 @@ class FewShotDataset:
         self.n_query = n_query
         self.data: Dict[str, List[Dict]] = None
         self.counter: Dict[str, int] = None
+        self.items: List[Dict] = None
+        self.sampler: EpisodeSampler = None
         self.load_file(data_path, labels_path)
 
     def load_file(self, data_path: str, labels_path: str = None):
@@ -57,24 +60,36 @@ class FewShotDataset:
         self.data = labels_dict
         self.counter = {key: 0 for key, _ in self.data.items()}
 
-    def get_episode(self) -> Dict:
+        # Compact representation used to sample episodes; row `i` of the sampler is self.items[i]
+        self.items = [item for key in self.data.keys() for item in self.data[key]]
+        self.sampler = EpisodeSampler.from_data_dict(self.data)
+
+    def get_episode_indices(self, rng=np.random) -> Dict[str, torch.Tensor]:
+        """
+        :param rng: numpy random generator to sample with (defaults to the global numpy generator)
+        :return: episode as index tensors in `self.items` (see `EpisodeSampler.sample`)
+        """
+        return self.sampler.sample(n_classes=self.n_classes, n_support=self.n_support, n_query=self.n_query, rng=rng)
+
+    def episode_items(self, episode_indices: Dict[str, torch.Tensor]) -> Dict:
+        """
+        :return: episode with items (e.g. {"sentence": ..., "label": ...}) in place of indices
+        """
         episode = dict()
-        if self.n_classes:
-            assert self.n_classes <= len(self.data.keys())
-            rand_keys = np.random.choice(list(self.data.keys()), self.n_classes, replace=False)
-
-            # Ensure enough data are query-able
-            assert min([len(val) for val in self.data.values()]) >= self.n_support + self.n_query
+        for key in ("xs", "xq"):
+            if key in episode_indices:
+                episode[key] = [[self.items[ix] for ix in row] for row in episode_indices[key].tolist()]
+        if "xu" in episode_indices:
+            episode["xu"] = [self.items[ix] for ix in episode_indices["xu"].tolist()]
+        return episode
 
-            # Shuffle data
-            for key in rand_keys:
-                random.shuffle(self.data[key])
+    def get_episode(self, rng=np.random) -> Dict:
+        if not self.n_classes:
+            return dict()
+        return self.episode_items(self.get_episode_indices(rng=rng))
 
-            if self.n_support:
-                episode["xs"] = [[self.data[k][i] for i in range(self.n_support)] for k in rand_keys]
-            if self.n_query:
-                episode["xq"] = [[self.data[k][self.n_support + i] for i in range(self.n_query)] for k in rand_keys]
-        return episode
+    def get_episodes(self, n_episodes: int, **kwargs) -> List[Dict]:
+        return [self.get_episode(**kwargs) for _ in range(n_episodes)]
 
     def __len__(self):
         return sum([len(label_data) for label, label_data in self.data.items()])
@@ -92,28 +107,8 @@ class FewShotPPDataset(FewShotDataset):
         super().__init__(data_path=data_path, n_classes=n_classes, n_support=n_support, n_query=n_query, labels_path=labels_path)
         self.n_unlabeled = n_unlabeled
 
-    def get_episode(self) -> Dict:
-        episode = super().get_episode()
-        if self.n_classes:
-            assert self.n_classes <= len(self.data.keys())
-            rand_keys = np.random.choice(list(self.data.keys()), self.n_classes, replace=False)
-
-            # Ensure enough data are query-able
-            assert all(len(self.data[key]) >= self.n_support + self.n_query + self.n_unlabeled for key in rand_keys)
-
-            # Shuffle data
-            for key in rand_keys:
-                random.shuffle(self.data[key])
-
-            if self.n_support:
-                episode["xs"] = [[self.data[k][i] for i in range(self.n_support)] for k in rand_keys]
-            if self.n_query:
-                episode["xq"] = [[self.data[k][self.n_support + i] for i in range(self.n_query)] for k in rand_keys]
-
-            if self.n_unlabeled:
-                episode['xu'] = [item for k in rand_keys for item in self.data[k][self.n_support + self.n_query:self.n_support + self.n_query + self.n_unlabeled]]
-
-        return episode
+    def get_episode_indices(self, rng=np.random) -> Dict[str, torch.Tensor]:
+        return self.sampler.sample(n_classes=self.n_classes, n_support=self.n_support, n_query=self.n_query, n_unlabeled=self.n_unlabeled, rng=rng)
 
 
 class FewShotSSLFileDataset(FewShotDataset):
@@ -125,19 +120,20 @@ class FewShotSSLFileDataset(FewShotDataset):
             n_query: int,
             n_unlabeled: int,
             unlabeled_file_path: str,
-            labels_path: str):
+            labels_path: str,
+            unlabeled_replace: bool = True):
         super().__init__(data_path=data_path, n_classes=n_classes, n_support=n_support, n_query=n_query, labels_path=labels_path)
         self.n_unlabeled = n_unlabeled
         logger.debug(f"Using augmented data @ {unlabeled_file_path}")
-        self.unlabeled_data = get_jsonl_data(unlabeled_file_path)
+        self.unlabeled_data = UnlabeledPool(unlabeled_file_path, parse=json.loads, replace=unlabeled_replace)
         logger.debug(f"Dataset has {len(self.unlabeled_data)} unlabeled samples")
 
-    def get_episode(self) -> Dict:
+    def get_episode(self, rng=np.random) -> Dict:
         # Get episode from regular few-shot
-        episode = super().get_episode()
+        episode = super().get_episode(rng=rng)
 
         # Get random augmentations in the file
-        unlabeled = np.random.choice(self.unlabeled_data, self.n_unlabeled).tolist()
+        unlabeled = self.unlabeled_data.sample(self.n_unlabeled, rng=rng)
 
         episode["x_augment"] = [
             {
@@ -152,7 +148,7 @@ class FewShotSSLFileDataset(FewShotDataset):
 
 class FewShotSSLParaphraseDataset(FewShotDataset):
     n_unlabeled: int
-    unlabeled_data: List[str]
+    unlabeled_data: UnlabeledPool
     paraphrase_model: ParaphraseModel
 
     def __init__(
@@ -164,25 +160,57 @@ class FewShotSSLParaphraseDataset(FewShotDataset):
             n_unlabeled: int,
             unlabeled_file_path: str,
             paraphrase_model: ParaphraseModel,
-            labels_path: str):
+            labels_path: str,
+            unlabeled_replace: bool = True,
+            paraphrase_lookahead: int = 1):
+        """
+        :param paraphrase_lookahead: when the paraphrase model can `submit` requests (e.g. `ParaphraseService`), number of
+            future calls to `get_episodes` whose paraphrases are requested in advance
+        """
         super().__init__(data_path=data_path, n_classes=n_classes, n_support=n_support, n_query=n_query, labels_path=labels_path)
         self.n_unlabeled = n_unlabeled
-        self.unlabeled_data = get_txt_data(unlabeled_file_path)
+        self.unlabeled_data = UnlabeledPool(unlabeled_file_path, replace=unlabeled_replace)
         self.paraphrase_model = paraphrase_model
+        self.paraphrase_lookahead = paraphrase_lookahead if hasattr(paraphrase_model, "submit") else 0
+        # Requests in flight, per random generator: each prefetching thread draws from its own generator
+        self.pending: Dict[Tuple[int, int], collections.deque] = collections.defaultdict(collections.deque)
 
     def get_episode(self, **kwargs) -> Dict:
-        episode = super().get_episode()
+        return self.get_episodes(1, **kwargs)[0]
+
+    def sample_episodes(self, n_episodes: int, rng=np.random) -> Tuple[List[Dict], List[List[str]]]:
+        episodes = list()
+        unlabeled = list()
+        for _ in range(n_episodes):
+            episodes.append(super().get_episode(rng=rng))
+
+            # Get random augmentations in the file
+            unlabeled.append(self.unlabeled_data.sample(self.n_unlabeled, rng=rng))
+        return episodes, unlabeled
+
+    def get_episodes(self, n_episodes: int, rng=np.random, **kwargs) -> List[Dict]:
+        if self.paraphrase_lookahead:
+            # Keep `paraphrase_lookahead` requests in flight, besides the one returned now
+            pending = self.pending[(id(rng), n_episodes)]
+            while len(pending) <= self.paraphrase_lookahead:
+                episodes, unlabeled = self.sample_episodes(n_episodes, rng=rng)
+                future = self.paraphrase_model.submit([src for unlabeled_ in unlabeled for src in unlabeled_], rng=rng)
+                pending.append((episodes, unlabeled, future))
+            episodes, unlabeled, future = pending.popleft()
+            tgt_texts = future.result()
+        else:
+            episodes, unlabeled = self.sample_episodes(n_episodes, rng=rng)
 
-        # Get random augmentations in the file
-        unlabeled = np.random.choice(self.unlabeled_data, self.n_unlabeled).tolist()
-        tgt_texts = self.paraphrase_model.paraphrase(unlabeled, **kwargs)
+            # Paraphrase unlabeled texts of all episodes at once
+            tgt_texts = self.paraphrase_model.paraphrase([src for unlabeled_ in unlabeled for src in unlabeled_], rng=rng, **kwargs)
 
-        episode["x_augment"] = [
-            {
-                "src_text": src,
-                "tgt_texts": tgts
-            }
-            for src, tgts in zip(unlabeled, tgt_texts)
-        ]
+        for episode_ix, (episode, unlabeled_) in enumerate(zip(episodes, unlabeled)):
+            episode["x_augment"] = [
+                {
+                    "src_text": src,
+                    "tgt_texts": tgts
+                }
+                for src, tgts in zip(unlabeled_, tgt_texts[episode_ix * self.n_unlabeled:(episode_ix + 1) * self.n_unlabeled])
+            ]
 
-        return episode
+        return episodes
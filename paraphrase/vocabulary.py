@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import logging
+from typing import List, Set
+
+import numpy as np
+import torch
+from torch import nn
+
+from utils.token_store import tokenizer_fingerprint
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class RestrictedVocabulary:
+    """
+    Whitelist of the tokens a seq2seq (BART) paraphrase model may generate. Once applied to a model, its output projection
+    only scores these tokens, which makes each decoding step much cheaper on CPU when the whitelist is small.
+    The encoder still reads full-vocabulary ids. The decoder reads and generates restricted ids: `to_full` maps them back.
+    On disk: a JSON file with the sorted token ids and the fingerprint of the tokenizer they belong to.
+    """
+
+    def __init__(self, token_ids: List[int], tokenizer_fingerprint: str):
+        self.token_ids = sorted(set(token_ids))
+        self.tokenizer_fingerprint = tokenizer_fingerprint
+        self.fingerprint = hashlib.sha1(json.dumps([tokenizer_fingerprint, self.token_ids]).encode("utf-8")).hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    @classmethod
+    def build(cls, tokenizer, sentences: List[str], n_general: int = 8000) -> "RestrictedVocabulary":
+        """
+        :param sentences: domain corpus (e.g. raw.txt and full.jsonl sentences)
+        :param n_general: number of general high-frequency tokens always kept. BART's vocabulary is sorted by decreasing
+            frequency in its pre-training corpus, so these are its first `n_general` ids.
+        """
+        token_ids: Set[int] = set(range(min(n_general, len(tokenizer))))
+        token_ids.update(tokenizer.all_special_ids)
+
+        # Tokens of each domain word, with and without a leading space (i.e. inside or at the start of a sentence), in
+        # its original, lowercase and capitalized forms
+        words = sorted({word for sentence in sentences for word in sentence.split()})
+        variants = sorted({variant for word in words for variant in (word, word.lower(), word.capitalize())})
+        texts = list(sentences) + variants + [f" {variant}" for variant in variants]
+        for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]:
+            token_ids.update(ids)
+
+        logger.info(f"Restricted vocabulary: {len(token_ids)} tokens ({len(words)} domain words, {n_general} general tokens)")
+        return cls(sorted(token_ids), tokenizer_fingerprint=tokenizer_fingerprint(tokenizer))
+
+    def save(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            json.dump({"tokenizer": self.tokenizer_fingerprint, "token_ids": self.token_ids}, file)
+
+    @classmethod
+    def load(cls, path: str, tokenizer) -> "RestrictedVocabulary":
+        with open(path, "r") as file:
+            data = json.load(file)
+        if data["tokenizer"] != tokenizer_fingerprint(tokenizer):
+            raise ValueError(f"Restricted vocabulary @ {path} was built for another tokenizer")
+        logger.info(f"Loading restricted vocabulary @ {path} ({len(data['token_ids'])} tokens)")
+        return cls(data["token_ids"], tokenizer_fingerprint=data["tokenizer"])
+
+    def apply(self, model):
+        """
+        Slices the output projection (`lm_head`, `final_logits_bias`) and the decoder input embeddings of a BART model
+        to the whitelist, and maps the special token ids of its config to restricted ids. Applied once per model.
+        """
+        if hasattr(model, "restricted_vocabulary"):
+            if model.restricted_vocabulary.fingerprint != self.fingerprint:
+                raise ValueError("Model is already restricted to another vocabulary")
+            self.to_full = model.restricted_vocabulary.to_full
+            self.to_restricted = model.restricted_vocabulary.to_restricted
+            return
+
+        device = model.lm_head.weight.device
+        full_size = model.lm_head.weight.size(0)
+        token_ids = torch.tensor(self.token_ids, dtype=torch.long, device=device)
+        assert int(token_ids.max()) < full_size
+        self.to_full = token_ids
+        self.to_restricted = torch.full((full_size,), -1, dtype=torch.long, device=device)
+        self.to_restricted[token_ids] = torch.arange(len(token_ids), device=device)
+
+        with torch.no_grad():
+            lm_head = nn.Linear(model.lm_head.in_features, len(token_ids), bias=False).to(device)
+            lm_head.weight.copy_(model.lm_head.weight[token_ids])
+            model.lm_head = lm_head
+            model.register_buffer("final_logits_bias", model.final_logits_bias[:, token_ids].clone())
+
+            for name in ("pad_token_id", "bos_token_id", "eos_token_id", "decoder_start_token_id", "forced_eos_token_id"):
+                token_id = getattr(model.config, name, None)
+                if token_id is not None:
+                    if int(self.to_restricted[token_id]) < 0:
+                        raise ValueError(f"Restricted vocabulary lacks {name} ({token_id})")
+                    setattr(model.config, name, int(self.to_restricted[token_id]))
+
+            decoder = model.get_decoder()
+            decoder.embed_tokens = nn.Embedding.from_pretrained(
+                decoder.embed_tokens.weight[token_ids].clone(),
+                freeze=True,
+                padding_idx=model.config.pad_token_id
+            )
+        model.restricted_vocabulary = self
+        logger.info(f"Restricted output vocabulary of the paraphrase model: {full_size} -> {len(token_ids)} tokens")
+
+    def share_of_known_tokens(self, token_ids: np.ndarray) -> float:
+        """
+        :return: share of `token_ids` (full-vocabulary ids) which are in the whitelist
+        """
+        if not len(token_ids):
+            return 1.
+        return float(np.isin(token_ids, self.token_ids).mean())
@@ -0,0 +1,43 @@
+from typing import List, Tuple
+
+import torch
+
+
+def token_budget_batches(lengths: List[int], max_tokens: int, max_batch_size: int = None) -> List[List[int]]:
+    """
+    Sorts items by length, then greedily groups them so that each batch, once padded to its longest item,
+    holds at most `max_tokens` tokens. An item longer than `max_tokens` gets a batch of its own.
+    :param lengths: number of tokens of each item
+    :param max_tokens: token budget of a padded batch (n_items x longest_item)
+    :param max_batch_size: optional cap on the number of items per batch
+    :return: list of batches, each batch being a list of indices in `lengths`
+    """
+    assert max_tokens > 0
+    order = sorted(range(len(lengths)), key=lambda ix: lengths[ix])
+
+    batches = list()
+    batch = list()
+    for ix in order:
+        # Items are sorted by length: the current item is the longest of the batch
+        too_many_tokens = (len(batch) + 1) * lengths[ix] > max_tokens
+        too_many_items = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (too_many_tokens or too_many_items):
+            batches.append(batch)
+            batch = list()
+        batch.append(ix)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def pad_token_ids(token_ids: List[List[int]], pad_token_id: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    :return: input_ids, attention_mask (both n_items x longest_item), right-padded with `pad_token_id`
+    """
+    max_length = max([len(ids) for ids in token_ids])
+    input_ids = torch.full((len(token_ids), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(token_ids), max_length), dtype=torch.long)
+    for row, ids in enumerate(token_ids):
+        input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, :len(ids)] = 1
+    return input_ids, attention_mask
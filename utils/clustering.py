@@ -0,0 +1,56 @@
+import numpy as np
+
+
+def batched_ward_clustering(embeddings: np.ndarray, n_clusters: int) -> np.ndarray:
+    """
+    Agglomerative clustering with Ward linkage, run on several independent sets of points at once.
+    At each step, every set merges its two clusters whose merge increases the within-cluster variance the least,
+    i.e. minimizing n_i * n_j / (n_i + n_j) * ||c_i - c_j||^2 (same merges as sklearn's `linkage='ward'`, up to ties).
+    :param embeddings: n_sets x n_points x dim
+    :return: labels (n_sets x n_points). A cluster is labelled by the index of its first point.
+    """
+    n_sets, n_points, _ = embeddings.shape
+    assert 0 < n_clusters <= n_points
+    centroids = embeddings.astype(np.float64)
+    sizes = np.ones((n_sets, n_points))
+    active = np.ones((n_sets, n_points), dtype=bool)
+    labels = np.tile(np.arange(n_points), (n_sets, 1))
+    set_ixs = np.arange(n_sets)
+
+    for _ in range(n_points - n_clusters):
+        squared_distances = ((centroids[:, :, None, :] - centroids[:, None, :, :]) ** 2).sum(-1)
+        costs = sizes[:, :, None] * sizes[:, None, :] / (sizes[:, :, None] + sizes[:, None, :]) * squared_distances
+        # Only consider pairs (i < j) of active clusters
+        valid = active[:, :, None] & active[:, None, :] & np.triu(np.ones((n_points, n_points), dtype=bool), k=1)
+        costs = np.where(valid, costs, np.inf)
+        best = costs.reshape(n_sets, -1).argmin(axis=1)
+        i, j = best // n_points, best % n_points
+
+        # Merge cluster j into cluster i (i < j, so clusters keep the index of their first point)
+        size_i, size_j = sizes[set_ixs, i], sizes[set_ixs, j]
+        centroids[set_ixs, i] = (size_i[:, None] * centroids[set_ixs, i] + size_j[:, None] * centroids[set_ixs, j]) / (size_i + size_j)[:, None]
+        sizes[set_ixs, i] = size_i + size_j
+        active[set_ixs, j] = False
+        labels = np.where(labels == j[:, None], i[:, None], labels)
+
+    return labels
+
+
+def closest_to_centroids(embeddings: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """
+    :param embeddings: n_sets x n_points x dim
+    :param labels: n_sets x n_points, as returned by `batched_ward_clustering`
+    :return: for each set, index of the point closest to the mean of its cluster, for each cluster, clusters being
+        ordered by their first point (n_sets x n_clusters)
+    """
+    n_sets, n_points, _ = embeddings.shape
+    members = labels[:, :, None] == np.arange(n_points)[None, None, :]  # n_sets x n_points x n_points (cluster label)
+    sizes = members.sum(axis=1)
+    centroids = np.einsum("spc,spd->scd", members.astype(np.float64), embeddings.astype(np.float64)) / np.maximum(sizes, 1)[:, :, None]
+    distances = np.linalg.norm(embeddings[:, :, None, :] - centroids[:, None, :, :], axis=-1)
+    closest = np.where(members, distances, np.inf).argmin(axis=1)  # n_sets x n_points (cluster label)
+
+    # Keep existing clusters only: their labels, sorted, are the index of their first point
+    n_clusters = int((sizes[0] > 0).sum())
+    cluster_labels = np.sort(np.where(sizes > 0, np.arange(n_points)[None, :], n_points), axis=1)[:, :n_clusters]
+    return np.take_along_axis(closest, cluster_labels, axis=1)
@@ -5,6 +5,8 @@ import os
 import json
 from typing import List, Dict
 
+from utils.sampling import EpisodeSampler
+
 
 def get_jsonl_data(jsonl_path: str):
     assert jsonl_path.endswith(".jsonl")
@@ -109,6 +111,9 @@ class FewShotDataLoader:
             self.data_dict = raw_data_to_dict(self.raw_data, shuffle=False)
         else:
             self.data_dict = raw_data_to_dict(self.raw_data, shuffle=True)
+            # Compact representation used to sample episodes; row `i` of the sampler is self.items[i]
+            self.items = [item for key in self.data_dict.keys() for item in self.data_dict[key]]
+            self.sampler = EpisodeSampler.from_data_dict(self.data_dict)
         self.unlabeled_file_path = unlabeled_file_path
         if self.unlabeled_file_path:
             self.unlabeled_data_loader = UnlabeledDataLoader(file_path=self.unlabeled_file_path)
@@ -117,11 +122,12 @@ class FewShotDataLoader:
         episode = dict()
         if n_classes:
             n_classes = min(n_classes, len(self.data_dict.keys()))
-            # rand_keys 是一個長度為 n_classes 的 ndarray，存放 label 名稱
-            rand_keys = np.random.choice(list(self.data_dict.keys()), n_classes, replace=False)
             assert min([len(val) for val in self.data_dict.values()]) >= n_support + n_query + n_unlabeled
 
             if self.aug:
+                # rand_keys 是一個長度為 n_classes 的 ndarray，存放 label 名稱
+                rand_keys = np.random.choice(list(self.data_dict.keys()), n_classes, replace=False)
+
                 # 有擴充資料，不能打亂
                 # episode["xs"] 裡面是一個長度為 n_classes /類別數量 的 list，每一個 list 包含一個長度為 n_support 的 list，
                 # 其中元素是每一個行 (dictionary)。episode["xs"][0][1] 為第 0 個類別的第一句話,
@@ -149,18 +155,17 @@ class FewShotDataLoader:
                     pass 
 
             else:
-                # 可以直接打亂，抽取前面幾個
-                for key, val in self.data_dict.items():
-                    random.shuffle(val)
+                # Partial sampling of indices, without shuffling every class
+                episode_indices = self.sampler.sample(n_classes=n_classes, n_support=n_support, n_query=n_query, n_unlabeled=n_unlabeled)
 
                 if n_support:
-                    episode["xs"] = [[self.data_dict[k][i] for i in range(n_support)] for k in rand_keys]
+                    episode["xs"] = [[self.items[ix] for ix in row] for row in episode_indices["xs"].tolist()]
 
                 if n_query:
-                    episode["xq"] = [[self.data_dict[k][n_support + i] for i in range(n_query)] for k in rand_keys]
+                    episode["xq"] = [[self.items[ix] for ix in row] for row in episode_indices["xq"].tolist()]
 
                 if n_unlabeled:
-                    episode['xu'] = [item for k in rand_keys for item in self.data_dict[k][n_support + n_query:n_support + n_query + n_unlabeled]]
+                    episode['xu'] = [self.items[ix] for ix in episode_indices["xu"].tolist()]
 
         if n_augment:
             episode = dict(**episode, **self.unlabeled_data_loader.create_episode(n_augment=n_augment))
@@ -0,0 +1,148 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import logging
+from contextlib import contextmanager
+from typing import List, Dict
+
+import numpy as np
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Sentence embeddings of a given embedder, persisted across runs.
+    On disk (<root>/<embedder id hash>/):
+        - meta.json: embedder id, embedding dim and dtype (that of the first embeddings added)
+        - embeddings.bin: embeddings (n_rows x dim), appended as new texts get embedded (memory-mapped)
+        - keys.txt: row `i` holds the embedding of the text whose hash (see `text_hash`) is on line `i`
+    Rows are only ever appended, under a file lock, so that several runs can share a store. Rows written after the last
+    complete line of keys.txt (e.g. after a crash) are ignored, and overwritten by the next append.
+    Embeddings are stored without any rounding: embeddings read from the store are those the embedder output.
+    """
+
+    def __init__(self, root: str, embedder_id: str):
+        self.embedder_id = embedder_id
+        self.path = os.path.join(root, hashlib.sha1(embedder_id.encode("utf-8")).hexdigest()[:16])
+        os.makedirs(self.path, exist_ok=True)
+        self.meta_path = os.path.join(self.path, "meta.json")
+        self.embeddings_path = os.path.join(self.path, "embeddings.bin")
+        self.keys_path = os.path.join(self.path, "keys.txt")
+        self.lock_path = os.path.join(self.path, "lock")
+
+        self.dim: int = None
+        self.dtype: np.dtype = None
+        self.key_to_row: Dict[str, int] = dict()
+        self.n_rows = 0
+        # Bytes of keys.txt already read
+        self.keys_size = 0
+        self.embeddings: np.ndarray = None
+        # Lookups and appends of the threads of a process
+        self.lock = threading.Lock()
+        with self.lock:
+            self.refresh()
+        logger.info(f"Embedding store @ {self.path}: {self.n_rows} embeddings of {embedder_id}")
+
+    @contextmanager
+    def file_lock(self):
+        """
+        Lock of the store across processes
+        """
+        with open(self.lock_path, "a") as file:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+    def refresh(self):
+        """
+        Reads rows appended (e.g. by other runs) since the last refresh.
+        """
+        if self.dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as file:
+                meta = json.load(file)
+            if meta["embedder_id"] != self.embedder_id:
+                raise ValueError(f"Store @ {self.path} holds embeddings of {meta['embedder_id']}, not {self.embedder_id}")
+            self.dim = meta["dim"]
+            self.dtype = np.dtype(meta["dtype"])
+        if not os.path.exists(self.keys_path) or os.path.getsize(self.keys_path) == self.keys_size:
+            return
+
+        with open(self.keys_path, "rb") as file:
+            file.seek(self.keys_size)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                self.key_to_row.setdefault(line[:-1].decode("utf-8"), self.n_rows)
+                self.n_rows += 1
+                self.keys_size += len(line)
+        self.embeddings = np.memmap(self.embeddings_path, dtype=self.dtype, mode="r", shape=(self.n_rows, self.dim)) if self.n_rows else None
+
+    def __len__(self):
+        return self.n_rows
+
+    def get_many(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        """
+        :return: text -> embedding, for texts in the store
+        """
+        with self.lock:
+            self.refresh()
+            found = dict()
+            for text in texts:
+                row = self.key_to_row.get(text_hash(text))
+                if row is not None:
+                    found[text] = row
+            if not found:
+                return dict()
+            # Reading rows in disk order
+            rows = np.array(sorted(set(found.values())))
+            embeddings = dict(zip(rows.tolist(), np.array(self.embeddings[rows])))
+        return {text: embeddings[row] for text, row in found.items()}
+
+    def add_many(self, texts: List[str], embeddings: np.ndarray):
+        """
+        Appends embeddings of texts missing from the store.
+        """
+        assert len(texts) == len(embeddings)
+        with self.lock, self.file_lock():
+            self.refresh()
+            new = dict()
+            for text, embedding in zip(texts, embeddings):
+                key = text_hash(text)
+                if key not in self.key_to_row:
+                    new[key] = embedding
+            if not new:
+                return
+
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                self.dtype = embeddings.dtype
+                with open(self.meta_path, "w") as file:
+                    json.dump({"embedder_id": self.embedder_id, "dim": self.dim, "dtype": self.dtype.name}, file)
+            assert embeddings.shape[1] == self.dim
+            if embeddings.dtype != self.dtype:
+                raise ValueError(f"Store @ {self.path} holds {self.dtype.name} embeddings, not {embeddings.dtype.name}")
+
+            # Embeddings first, keys then: a row is only valid once its key is written
+            row_size = self.dim * self.dtype.itemsize
+            with open(self.embeddings_path, "ab") as file:
+                file.truncate(self.n_rows * row_size)
+                file.write(np.stack(list(new.values())).tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+            with open(self.keys_path, "ab") as file:
+                file.truncate(self.keys_size)
+                file.write("".join([f"{key}\n" for key in new]).encode("utf-8"))
+                file.flush()
+                os.fsync(file.fileno())
+            self.refresh()
@@ -0,0 +1,92 @@
+import queue
+import threading
+import time
+import logging
+from typing import Callable, Any, Dict
+
+import numpy as np
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class EpisodePrefetcher:
+    """
+    Produces training items (e.g. paraphrased & tokenized episodes) in background threads, ahead of the training loop.
+        - worker `w` owns a `np.random.RandomState(seed + w)` and a queue of at most `depth` ready items
+        - items are consumed round-robin over workers, so the i-th item always comes from worker `i % n_workers`,
+          and is the same from one run to the other, whatever the scheduling of threads.
+    The training loop only blocks (stalls) when the next worker's queue is empty.
+    """
+
+    def __init__(self, produce_fn: Callable[[np.random.RandomState], Any], n_workers: int = 1, depth: int = 2, seed: int = 42):
+        """
+        :param produce_fn: builds one item from a random generator. It is called concurrently by all workers.
+        :param n_workers: number of producing threads
+        :param depth: max number of ready items per worker
+        :param seed: worker `w` draws from `np.random.RandomState(seed + w)`
+        """
+        assert n_workers > 0 and depth > 0
+        self.produce_fn = produce_fn
+        self.n_workers = n_workers
+        self.queues = [queue.Queue(maxsize=depth) for _ in range(n_workers)]
+        self.stop_event = threading.Event()
+        self.n_consumed = 0
+        self.metrics = {"queue_depth": list(), "stall_time": list()}
+
+        logger.info(f"Prefetching episodes with {n_workers} worker(s), {depth} episode(s) ahead each")
+        self.workers = [
+            threading.Thread(target=self.work, args=(worker_ix, np.random.RandomState(seed + worker_ix)), daemon=True)
+            for worker_ix in range(n_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def work(self, worker_ix: int, rng: np.random.RandomState):
+        worker_queue = self.queues[worker_ix]
+        while not self.stop_event.is_set():
+            try:
+                item = (self.produce_fn(rng), None)
+            except Exception as e:
+                item = (None, e)
+
+            # Don't hold a blocking `put` forever: the consumer may be gone
+            while not self.stop_event.is_set():
+                try:
+                    worker_queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if item[1] is not None:
+                return
+
+    def get(self):
+        """
+        :return: next item, blocking until it's ready. Exceptions raised by workers are raised here.
+        """
+        worker_queue = self.queues[self.n_consumed % self.n_workers]
+        self.metrics["queue_depth"].append(sum([q.qsize() for q in self.queues]))
+        start = time.time()
+        item, exception = worker_queue.get()
+        self.metrics["stall_time"].append(time.time() - start)
+        self.n_consumed += 1
+        if exception is not None:
+            raise exception
+        return item
+
+    def pop_metrics(self) -> Dict[str, float]:
+        """
+        :return: mean number of ready items, and mean time (s) the consumer waited, over `get` calls since the last call
+        """
+        metrics = dict()
+        if self.metrics["stall_time"]:
+            metrics["prefetch_queue_depth"] = float(np.mean(self.metrics["queue_depth"]))
+            metrics["prefetch_stall_time"] = float(np.mean(self.metrics["stall_time"]))
+        self.metrics = {"queue_depth": list(), "stall_time": list()}
+        return metrics
+
+    def close(self):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join()
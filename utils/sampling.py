@@ -0,0 +1,157 @@
+import os
+import threading
+import logging
+from typing import List, Dict, Callable, Any
+
+import numpy as np
+import torch
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def sample_without_replacement(n: int, k: int, rng=np.random) -> np.ndarray:
+    """
+    Draws `k` distinct integers in [0, n), using a partial Fisher-Yates shuffle of a virtual range(n).
+    Runs in O(k) time and memory, whatever `n`.
+    :param rng: numpy random generator (defaults to the global numpy generator)
+    """
+    assert 0 <= k <= n
+    draws = rng.randint(np.arange(k), n) if k else np.zeros(0, dtype=np.int64)
+    out = np.empty(k, dtype=np.int64)
+    swapped = dict()
+    for i, j in enumerate(draws.tolist()):
+        out[i] = swapped.get(j, j)
+        swapped[j] = swapped.get(i, i)
+    return out
+
+
+class EpisodeSampler:
+    """
+    Compact view of a labeled dataset: one sentence array, int32 label codes, and one index array per class.
+    Episodes are drawn as index tensors, in O(n_classes * (n_support + n_query + n_unlabeled)).
+    """
+
+    def __init__(self, sentences: List[str], labels: List[str], label_names: List[str] = None):
+        assert len(sentences) == len(labels)
+        self.sentences = np.array(sentences, dtype=object)
+        self.label_names = label_names if label_names else sorted(set(labels))
+        label_to_code = {label: code for code, label in enumerate(self.label_names)}
+        self.label_codes = np.array([label_to_code[label] for label in labels], dtype=np.int32)
+
+        order = np.argsort(self.label_codes, kind="stable")
+        self.class_sizes = np.bincount(self.label_codes, minlength=len(self.label_names))
+        self.class_indices: List[np.ndarray] = np.split(order, np.cumsum(self.class_sizes)[:-1])
+
+    @classmethod
+    def from_data_dict(cls, data_dict: Dict[str, List[Dict]]) -> "EpisodeSampler":
+        """
+        :param data_dict: label -> items ({"sentence": ..., "label": ...}). Row `i` of the sampler is the i-th item of
+            the flattened dict.
+        """
+        labels = list(data_dict.keys())
+        return cls(
+            sentences=[item["sentence"] for label in labels for item in data_dict[label]],
+            labels=[label for label in labels for _ in data_dict[label]],
+            label_names=labels
+        )
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def sample(self, n_classes: int, n_support: int, n_query: int, n_unlabeled: int = 0, rng=np.random) -> Dict[str, torch.Tensor]:
+        """
+        :return: {
+            "classes": n_classes label codes,
+            "xs": n_classes x n_support row indices (if n_support),
+            "xq": n_classes x n_query row indices (if n_query),
+            "xu": (n_classes * n_unlabeled) row indices (if n_unlabeled)
+        }
+        """
+        assert n_classes <= len(self.label_names)
+        classes = sample_without_replacement(len(self.label_names), n_classes, rng=rng)
+
+        # Ensure enough data are query-able
+        n_per_class = n_support + n_query + n_unlabeled
+        assert (self.class_sizes[classes] >= n_per_class).all()
+
+        indices = np.stack([
+            self.class_indices[c][sample_without_replacement(self.class_sizes[c], n_per_class, rng=rng)]
+            for c in classes
+        ]) if n_classes else np.zeros((0, n_per_class), dtype=np.int64)
+
+        episode = {"classes": torch.from_numpy(classes)}
+        if n_support:
+            episode["xs"] = torch.from_numpy(np.ascontiguousarray(indices[:, :n_support]))
+        if n_query:
+            episode["xq"] = torch.from_numpy(np.ascontiguousarray(indices[:, n_support:n_support + n_query]))
+        if n_unlabeled:
+            episode["xu"] = torch.from_numpy(np.ascontiguousarray(indices[:, n_support + n_query:]).reshape(-1))
+        return episode
+
+
+def build_line_offsets(path: str) -> np.ndarray:
+    """
+    :return: byte offsets of each line of `path`, plus the file size (n_lines + 1 values)
+    """
+    offsets = [0]
+    with open(path, "rb") as file:
+        for line in file:
+            offsets.append(offsets[-1] + len(line))
+    return np.array(offsets, dtype=np.int64)
+
+
+class UnlabeledPool:
+    """
+    Pool of unlabeled items, one per line of a file, sampled in O(k) without loading the file in memory.
+    Lines are read through a line-offset index, cached next to the file (`<path>.offsets.npy`) and memory-mapped.
+    """
+
+    def __init__(self, path: str, parse: Callable[[str], Any] = None, replace: bool = True):
+        """
+        :param parse: function applied to each (stripped) line read, e.g. `json.loads` for .jsonl files
+        :param replace: whether items are drawn with replacement
+        """
+        self.path = path
+        self.parse = parse
+        self.replace = replace
+        self.offsets = self.load_offsets(path)
+        self.lock = threading.Lock()
+        self.file = open(path, "rb")
+
+    @staticmethod
+    def load_offsets(path: str) -> np.ndarray:
+        offsets_path = f"{path}.offsets.npy"
+        if os.path.exists(offsets_path) and os.path.getmtime(offsets_path) >= os.path.getmtime(path):
+            offsets = np.load(offsets_path, mmap_mode="r")
+            if offsets[-1] == os.path.getsize(path):
+                return offsets
+
+        logger.info(f"Indexing lines of {path}")
+        offsets = build_line_offsets(path)
+        try:
+            np.save(offsets_path, offsets)
+        except OSError:
+            logger.warning(f"Could not cache line offsets @ {offsets_path}")
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ix: int):
+        with self.lock:
+            self.file.seek(int(self.offsets[ix]))
+            line = self.file.read(int(self.offsets[ix + 1] - self.offsets[ix]))
+        line = line.decode("utf-8").strip()
+        return self.parse(line) if self.parse else line
+
+    def get_many(self, ixs: List[int]) -> List:
+        return [self[ix] for ix in ixs]
+
+    def sample(self, k: int, rng=np.random) -> List:
+        if self.replace:
+            ixs = rng.randint(0, len(self), k)
+        else:
+            ixs = sample_without_replacement(len(self), k, rng=rng)
+        return self.get_many(ixs.tolist())
@@ -0,0 +1,34 @@
+import argparse
+import logging
+
+from paraphrase.eda import SynonymIndex
+from utils.data import get_jsonl_data, get_txt_data
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-path", type=str, action="append", default=[], help="Path to a .jsonl file with a `sentence` field (e.g. full.jsonl). Can be repeated.")
+    parser.add_argument("--unlabeled-path", type=str, action="append", default=[], help="Path to a .txt file, one sentence per line (e.g. raw.txt). Can be repeated.")
+    parser.add_argument("--output-path", type=str, required=True, help="Path of the synonym table (.json)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    sentences = list()
+    for data_path in args.data_path:
+        sentences += [item["sentence"] for item in get_jsonl_data(data_path)]
+    for unlabeled_path in args.unlabeled_path:
+        sentences += get_txt_data(unlabeled_path)
+
+    index = SynonymIndex.build(sentences)
+    index.save(args.output_path)
+    logger.warning(f"{len(index)} words, {sum([1 for synonyms in index.synonyms.values() if synonyms])} with synonyms @ {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+#!/usr/bin/env bash
+
+for dataset in BANKING77 HWU64 OOS Liu; do
+    PYTHONPATH=. python utils/scripts/paraphrase/build-eda-synonyms.py \
+        --data-path data/${dataset}/full.jsonl \
+        --unlabeled-path data/${dataset}/raw.txt \
+        --output-path data/${dataset}/eda-synonyms.json
+done
@@ -0,0 +1,39 @@
+import argparse
+import logging
+
+from transformers import AutoTokenizer
+
+from paraphrase.vocabulary import RestrictedVocabulary
+from utils.data import get_jsonl_data, get_txt_data
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-path", type=str, action="append", default=[], help="Path to a .jsonl file with a `sentence` field (e.g. full.jsonl). Can be repeated.")
+    parser.add_argument("--unlabeled-path", type=str, action="append", default=[], help="Path to a .txt file, one sentence per line (e.g. raw.txt). Can be repeated.")
+    parser.add_argument("--tokenizer-name-or-path", type=str, required=True, help="Tokenizer of the paraphrase model")
+    parser.add_argument("--n-general", type=int, default=8000, help="Number of general high-frequency tokens (first ids of the BART vocabulary) kept on top of the domain tokens")
+    parser.add_argument("--output-path", type=str, required=True, help="Path of the restricted vocabulary (.json)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    sentences = list()
+    for data_path in args.data_path:
+        sentences += [item["sentence"] for item in get_jsonl_data(data_path)]
+    for unlabeled_path in args.unlabeled_path:
+        sentences += get_txt_data(unlabeled_path)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name_or_path)
+    vocabulary = RestrictedVocabulary.build(tokenizer, sentences=sentences, n_general=args.n_general)
+    vocabulary.save(args.output_path)
+    logger.warning(f"{len(vocabulary)} / {len(tokenizer)} tokens @ {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
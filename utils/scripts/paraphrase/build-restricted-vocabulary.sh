@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+
+paraphrase_tokenizer_name_or_path="facebook/bart-base"
+
+for dataset in BANKING77 HWU64 OOS Liu; do
+    PYTHONPATH=. python utils/scripts/paraphrase/build-restricted-vocabulary.py \
+        --data-path data/${dataset}/full.jsonl \
+        --unlabeled-path data/${dataset}/raw.txt \
+        --tokenizer-name-or-path ${paraphrase_tokenizer_name_or_path} \
+        --output-path data/${dataset}/restricted-vocabulary.json
+done
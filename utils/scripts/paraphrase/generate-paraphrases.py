@@ -1,12 +1,18 @@
 import os
-from paraphrase.modeling import UnigramRandomDropParaphraseBatchPreparer, BigramDropParaphraseBatchPreparer, BaseParaphraseBatchPreparer, DBSParaphraseModel
-from transformers import AutoTokenizer
+import itertools
+import json
+import multiprocessing
+import shutil
+from paraphrase.modeling import BaseParaphraseBatchPreparer, build_dbs_paraphrase_model
+import numpy as np
 import torch
 import argparse
 import logging
+from typing import List, Tuple, Dict
 from tqdm import tqdm
 
-from utils.data import write_jsonl_data
+from utils.batching import token_budget_batches
+from utils.sharding import ShardWriter, shard_range, shard_path, merge_shards
 
 logging.basicConfig()
 logger = logging.getLogger()
@@ -15,8 +21,18 @@ logger = logging.getLogger()
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--src-file', required=True, type=str)
-    parser.add_argument('--tgt-file', required=True, type=str)
+    parser.add_argument('--tgt-file', type=str, help="Output file (required unless --sweep-config is set)")
+    parser.add_argument('--sweep-config', type=str, help="JSON list of generation configs, e.g. "
+                                                         "[{\"tgt_file\": ..., \"drop_strategy\": \"unigram\", \"drop_chance_auc\": 0.5, ...}, ...]. "
+                                                         "Keys are those of the --paraphrase-* flags (without prefix), which give default values, and `tgt_file`. "
+                                                         "The encoder runs once per batch, for all configs. Each config gets the same outputs as a run of its own")
     parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--max-tokens', type=int, help="If set, lines are sorted by length and batched under this budget of (padded) source tokens. "
+                                                        "Generation lengths stay those of --batch-size chunks in file order, so outputs are unchanged")
+    parser.add_argument('--num-shards', type=int, default=1, help="Number of worker processes, each one generating paraphrases of a contiguous shard of --src-file with its own model")
+    parser.add_argument('--shard-dir', type=str, help="Where shards are written as they are generated (defaults to <tgt-file>.shards). Re-running the same command resumes unfinished shards")
+    parser.add_argument('--worker-threads', type=int, help="Number of torch threads of each worker process (CPU generation)")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed (drop strategies). Shard `k` uses seed + k")
 
     # Augmentation & Paraphrase
     parser.add_argument("--paraphrase-model-name-or-path", type=str)
@@ -28,62 +44,195 @@ def parse_args():
     parser.add_argument("--paraphrase-drop-strategy", type=str)
     parser.add_argument("--paraphrase-drop-chance-speed", type=str)
     parser.add_argument("--paraphrase-drop-chance-auc", type=float)
+    parser.add_argument("--paraphrase-quantize", action="store_true", help="Dynamic int8 quantization of the paraphrase model (shards then run on CPU)")
+    parser.add_argument("--paraphrase-restricted-vocabulary-path", type=str, help="Restricted output vocabulary (see build-restricted-vocabulary.py), shared by all configs: faster decoding, outputs may differ")
 
     args = parser.parse_args()
     assert os.path.exists(args.src_file)
-    assert not os.path.exists(args.tgt_file)
+    args.configs = get_generation_configs(args)
+    for config in args.configs:
+        assert not os.path.exists(config["tgt_file"])
+    if not args.shard_dir:
+        args.shard_dir = f"{args.configs[0]['tgt_file']}.shards"
     return args
 
 
+def get_generation_configs(args: argparse.Namespace) -> List[Dict]:
+    """
+    :return: list of configs (kwargs of `build_dbs_paraphrase_model`, plus `tgt_file`). Without --sweep-config, the single
+        config given by the --paraphrase-* flags.
+    """
+    default = {
+        "tgt_file": args.tgt_file,
+        "num_beams": args.paraphrase_num_beams,
+        "beam_group_size": args.paraphrase_beam_group_size,
+        "diversity_penalty": args.paraphrase_diversity_penalty,
+        "filtering_strategy": args.paraphrase_filtering_strategy,
+        "drop_strategy": args.paraphrase_drop_strategy,
+        "drop_chance_speed": args.paraphrase_drop_chance_speed,
+        "drop_chance_auc": args.paraphrase_drop_chance_auc,
+    }
+    if not args.sweep_config:
+        assert args.tgt_file, "--tgt-file is required"
+        return [default]
+
+    with open(args.sweep_config, "r") as file:
+        sweep = json.load(file)
+    configs = list()
+    for config in sweep:
+        unknown = set(config.keys()) - set(default.keys())
+        if unknown:
+            raise ValueError(f"Unknown sweep config keys: {sorted(unknown)}")
+        configs.append({**default, **config})
+    tgt_files = [config["tgt_file"] for config in configs]
+    assert all(tgt_files) and len(set(tgt_files)) == len(tgt_files), "Each sweep config needs its own `tgt_file`"
+    return configs
+
+
+def get_config_shard_dir(args: argparse.Namespace, config_ix: int) -> str:
+    if len(args.configs) == 1:
+        return args.shard_dir
+    return os.path.join(args.shard_dir, f"config-{config_ix:03d}")
+
+
+def get_generation_max_lengths(lines: List[str], paraphrase_batch_preparer: BaseParaphraseBatchPreparer, batch_size: int) -> Tuple[List[int], List[int]]:
+    """
+    DBS generates at most as many tokens as the padded source batch. When lines are batched by `batch_size` in file
+    order, a line's generation max length is the length of the longest line of its chunk.
+    :return: token length of each line, generation max length of each line
+    """
+    lengths = [
+        len(ids) for ids in paraphrase_batch_preparer.tokenizer(
+            lines,
+            max_length=paraphrase_batch_preparer.max_length,
+            truncation=True
+        )["input_ids"]
+    ]
+    max_lengths = [max(lengths[i - i % batch_size:i - i % batch_size + batch_size]) for i in range(len(lines))]
+    return lengths, max_lengths
+
+
+def get_length_sorted_batches(ixs: List[int], lengths: List[int], max_lengths: List[int], max_tokens: int) -> List[Tuple[List[int], int]]:
+    """
+    Groups lines by length, under a budget of `max_tokens` padded source tokens per batch. Each line keeps its generation
+    max length (see `get_generation_max_lengths`): only lines sharing the same generation max length are batched together.
+    :return: list of (line indices, generation max length)
+    """
+    batches = list()
+    for max_length, ixs_ in itertools.groupby(sorted(ixs, key=lambda ix: max_lengths[ix]), key=lambda ix: max_lengths[ix]):
+        ixs_ = list(ixs_)
+        for batch in token_budget_batches([lengths[ix] for ix in ixs_], max_tokens=max_tokens):
+            batches.append(([ixs_[ix] for ix in batch], max_length))
+    logger.info(f"{len(ixs)} lines in {len(batches)} length-sorted batches")
+    return batches
+
+
+def generate_shard(args: argparse.Namespace, shard_ix: int, device: str):
+    # Open input file
+    with open(args.src_file, "r") as file:
+        lines_in = [line.strip() for line in file]
+
+    # Shards are aligned on --batch-size chunks, so that lines get the same generation max length as without sharding
+    start, end = shard_range(len(lines_in), args.num_shards, shard_ix, align=args.batch_size)
+    writers = [
+        ShardWriter(shard_path(get_config_shard_dir(args, config_ix), shard_ix, args.num_shards))
+        for config_ix in range(len(args.configs))
+    ]
+    todo = [ix for ix in range(end - start) if any([ix + start not in writer.done for writer in writers])]
+    if not todo:
+        for writer in writers:
+            writer.close()
+        return
+
+    if args.worker_threads:
+        torch.set_num_threads(args.worker_threads)
+    logger.info(f"Shard {shard_ix}: using device {device}")
+
+    # Load paraphrase models: configs share the BART model and tokenizer loaded for the first one
+    paraphrase_models = list()
+    for config in args.configs:
+        paraphrase_models.append(build_dbs_paraphrase_model(
+            model_name_or_path=args.paraphrase_model_name_or_path,
+            tok_name_or_path=args.paraphrase_tokenizer_name_or_path,
+            num_beams=config["num_beams"],
+            beam_group_size=config["beam_group_size"],
+            diversity_penalty=config["diversity_penalty"],
+            filtering_strategy=config["filtering_strategy"],
+            drop_strategy=config["drop_strategy"],
+            drop_chance_speed=config["drop_chance_speed"],
+            drop_chance_auc=config["drop_chance_auc"],
+            device=device,
+            restricted_vocabulary_path=args.paraphrase_restricted_vocabulary_path,
+            quantize=args.paraphrase_quantize,
+            share_with=paraphrase_models[0] if paraphrase_models else None
+        ))
+    # Each config draws from its own generator, seeded as in a run of its own
+    rngs = [np.random.RandomState(args.seed + shard_ix) for _ in args.configs]
+
+    lengths, max_lengths = get_generation_max_lengths(lines_in[start:end], paraphrase_models[0].paraphrase_batch_preparer, args.batch_size)
+
+    if args.max_tokens:
+        batches = get_length_sorted_batches(todo, lengths, max_lengths, args.max_tokens)
+    else:
+        batches = list()
+        for _, batch_ixs in itertools.groupby(todo, key=lambda ix: ix // args.batch_size):
+            batch_ixs = list(batch_ixs)
+            batches.append((batch_ixs, max_lengths[batch_ixs[0]]))
+
+    for batch_ixs, max_length in tqdm(batches, desc=f"shard {shard_ix}", position=shard_ix):
+        lines_batch = [lines_in[start + ix] for ix in batch_ixs]
+        # Configs still missing some of these lines (after a resume) decode them from the same encoder states
+        models_todo = [
+            (paraphrase_model, rng, writer)
+            for paraphrase_model, rng, writer in zip(paraphrase_models, rngs, writers)
+            if any([start + ix not in writer.done for ix in batch_ixs])
+        ]
+        encoder_outputs = paraphrase_models[0].encode(lines_batch) if len(models_todo) > 1 else None
+        for paraphrase_model, rng, writer in models_todo:
+            paraphrases = paraphrase_model.paraphrase(src_texts=lines_batch, max_length=max_length, rng=rng, encoder_outputs=encoder_outputs)
+            writer.write_many([
+                {
+                    "ix": start + ix,
+                    "src_text": line,
+                    "tgt_texts": p
+                }
+                for ix, line, p in zip(batch_ixs, lines_batch, paraphrases)
+                if start + ix not in writer.done
+            ])
+    for writer in writers:
+        writer.close()
+
+
 def main():
     # Load arguments
     args = parse_args()
 
-    # Set physical device which will be used
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    logger.info(f"Using device {device}")
-
-    # Load paraphrase model
-    paraphrase_tokenizer = AutoTokenizer.from_pretrained(args.paraphrase_tokenizer_name_or_path)
-    if args.paraphrase_drop_strategy == "unigram":
-        paraphrase_batch_preparer = UnigramRandomDropParaphraseBatchPreparer(
-            tokenizer=paraphrase_tokenizer,
-            auc=args.paraphrase_drop_chance_auc,
-            drop_chance_speed=args.paraphrase_drop_chance_speed,
-            device=device
-        )
-    elif args.paraphrase_drop_strategy == "bigram":
-        paraphrase_batch_preparer = BigramDropParaphraseBatchPreparer(tokenizer=paraphrase_tokenizer, device=device)
+    # Set physical device(s) which will be used: shards are spread over available GPUs (quantized models run on CPU)
+    n_gpus = 0 if args.paraphrase_quantize else torch.cuda.device_count()
+    devices = [f"cuda:{shard_ix % n_gpus}" if n_gpus else "cpu" for shard_ix in range(args.num_shards)]
+
+    if args.num_shards == 1:
+        generate_shard(args, 0, devices[0])
     else:
-        paraphrase_batch_preparer = BaseParaphraseBatchPreparer(tokenizer=paraphrase_tokenizer, device=device)
-
-    paraphrase_model = DBSParaphraseModel(
-        model_name_or_path=args.paraphrase_model_name_or_path,
-        tok_name_or_path=args.paraphrase_tokenizer_name_or_path,
-        num_beams=args.paraphrase_num_beams,
-        beam_group_size=args.paraphrase_beam_group_size,
-        diversity_penalty=args.paraphrase_diversity_penalty,
-        filtering_strategy=args.paraphrase_filtering_strategy,
-        paraphrase_batch_preparer=paraphrase_batch_preparer,
-        device=device
-    )
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=generate_shard, args=(args, shard_ix, devices[shard_ix])) for shard_ix in range(args.num_shards)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed = [shard_ix for shard_ix, worker in enumerate(workers) if worker.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"Shards {failed} failed. Re-run the same command to resume them.")
 
-    # Open input file
+    # Merge shards in file order, one output file per config
     with open(args.src_file, "r") as file:
-        lines_in = [line.strip() for line in file]
-    out = list()
-
-    for i in tqdm(range(0, len(lines_in), args.batch_size)):
-        lines_batch = lines_in[i:i + args.batch_size]
-        paraphrases = paraphrase_model.paraphrase(src_texts=lines_batch)
-        for line, p in zip(lines_batch, paraphrases):
-            out.append({
-                "src_text": line,
-                "tgt_texts": p
-            })
-
-    os.makedirs(os.path.dirname(args.tgt_file), exist_ok=True)
-    write_jsonl_data(out, args.tgt_file)
+        n_lines = sum([1 for _ in file])
+    for config_ix, config in enumerate(args.configs):
+        if os.path.dirname(config["tgt_file"]):
+            os.makedirs(os.path.dirname(config["tgt_file"]), exist_ok=True)
+        config_shard_dir = get_config_shard_dir(args, config_ix)
+        merge_shards([shard_path(config_shard_dir, shard_ix, args.num_shards) for shard_ix in range(args.num_shards)], config["tgt_file"], n_items=n_lines)
+    shutil.rmtree(args.shard_dir)
 
     #
     # # Load model, tokenizer
@@ -0,0 +1,86 @@
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+import torch
+
+from paraphrase.metrics import paraphrase_bleu_diversity_metrics, paraphrase_agreement_metrics
+from paraphrase.modeling import build_dbs_paraphrase_model
+from utils.data import get_txt_data
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src-file", type=str, required=True, help="Sentences to paraphrase, one per line (e.g. raw.txt)")
+    parser.add_argument("--n-lines", type=int, default=512, help="Number of lines of --src-file to paraphrase")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--threads", type=int, help="Number of torch threads")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (line sample, drop strategies), the same for both models")
+    parser.add_argument("--output-path", type=str, help="If set, the report is also written there (.json)")
+
+    parser.add_argument("--paraphrase-model-name-or-path", type=str, required=True)
+    parser.add_argument("--paraphrase-tokenizer-name-or-path", type=str)
+    parser.add_argument("--paraphrase-num-beams", type=int, default=15)
+    parser.add_argument("--paraphrase-beam-group-size", type=int, default=3)
+    parser.add_argument("--paraphrase-diversity-penalty", type=float, default=0.5)
+    parser.add_argument("--paraphrase-filtering-strategy", type=str, default="bleu")
+    parser.add_argument("--paraphrase-drop-strategy", type=str)
+    parser.add_argument("--paraphrase-drop-chance-speed", type=str)
+    parser.add_argument("--paraphrase-drop-chance-auc", type=float)
+    parser.add_argument("--paraphrase-restricted-vocabulary-path", type=str)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    lines = get_txt_data(args.src_file)
+    lines = [lines[ix] for ix in sorted(np.random.RandomState(args.seed).permutation(len(lines))[:args.n_lines])]
+
+    # Both models run on CPU, so that durations are comparable
+    outputs, durations = dict(), dict()
+    for name, quantize in (("fp32", False), ("int8", True)):
+        paraphrase_model = build_dbs_paraphrase_model(
+            model_name_or_path=args.paraphrase_model_name_or_path,
+            tok_name_or_path=args.paraphrase_tokenizer_name_or_path,
+            num_beams=args.paraphrase_num_beams,
+            beam_group_size=args.paraphrase_beam_group_size,
+            diversity_penalty=args.paraphrase_diversity_penalty,
+            filtering_strategy=args.paraphrase_filtering_strategy,
+            drop_strategy=args.paraphrase_drop_strategy,
+            drop_chance_speed=args.paraphrase_drop_chance_speed,
+            drop_chance_auc=args.paraphrase_drop_chance_auc,
+            device="cpu",
+            restricted_vocabulary_path=args.paraphrase_restricted_vocabulary_path,
+            quantize=quantize
+        )
+        rng = np.random.RandomState(args.seed)
+        outputs[name] = list()
+        start = time.perf_counter()
+        for i in range(0, len(lines), args.batch_size):
+            outputs[name] += paraphrase_model.paraphrase(src_texts=lines[i:i + args.batch_size], rng=rng)
+        durations[name] = time.perf_counter() - start
+        del paraphrase_model
+
+    report = {"n_lines": len(lines)}
+    for name in ("fp32", "int8"):
+        report[name] = {
+            "seconds_per_line": durations[name] / len(lines),
+            **paraphrase_bleu_diversity_metrics(lines, outputs[name])
+        }
+    report["speedup"] = durations["fp32"] / durations["int8"]
+    report["int8_vs_fp32"] = paraphrase_agreement_metrics(outputs["int8"], outputs["fp32"])
+    logger.warning(json.dumps(report, indent=1))
+    if args.output_path:
+        with open(args.output_path, "w") as file:
+            json.dump(report, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+import torch
+
+from paraphrase.modeling import build_dbs_paraphrase_model
+from utils.data import get_txt_data
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src-file", type=str, required=True, help="Sentences to paraphrase, one per line (e.g. raw.txt)")
+    parser.add_argument("--restricted-vocabulary-path", type=str, required=True, help="Built by build-restricted-vocabulary.py")
+    parser.add_argument("--n-lines", type=int, default=512, help="Number of (first) lines of --src-file to paraphrase")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, help="Number of torch threads")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (drop strategies), the same for both decodings")
+    parser.add_argument("--output-path", type=str, help="If set, the report is also written there (.json)")
+
+    parser.add_argument("--paraphrase-model-name-or-path", type=str, required=True)
+    parser.add_argument("--paraphrase-tokenizer-name-or-path", type=str)
+    parser.add_argument("--paraphrase-num-beams", type=int, default=15)
+    parser.add_argument("--paraphrase-beam-group-size", type=int, default=3)
+    parser.add_argument("--paraphrase-diversity-penalty", type=float, default=0.5)
+    parser.add_argument("--paraphrase-filtering-strategy", type=str, default="bleu")
+    parser.add_argument("--paraphrase-drop-strategy", type=str)
+    parser.add_argument("--paraphrase-drop-chance-speed", type=str)
+    parser.add_argument("--paraphrase-drop-chance-auc", type=float)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    lines = get_txt_data(args.src_file)[:args.n_lines]
+
+    outputs, durations = dict(), dict()
+    for name, restricted_vocabulary_path in (("full", None), ("restricted", args.restricted_vocabulary_path)):
+        paraphrase_model = build_dbs_paraphrase_model(
+            model_name_or_path=args.paraphrase_model_name_or_path,
+            tok_name_or_path=args.paraphrase_tokenizer_name_or_path,
+            num_beams=args.paraphrase_num_beams,
+            beam_group_size=args.paraphrase_beam_group_size,
+            diversity_penalty=args.paraphrase_diversity_penalty,
+            filtering_strategy=args.paraphrase_filtering_strategy,
+            drop_strategy=args.paraphrase_drop_strategy,
+            drop_chance_speed=args.paraphrase_drop_chance_speed,
+            drop_chance_auc=args.paraphrase_drop_chance_auc,
+            device=args.device,
+            restricted_vocabulary_path=restricted_vocabulary_path
+        )
+        rng = np.random.RandomState(args.seed)
+        outputs[name] = list()
+        start = time.perf_counter()
+        for i in range(0, len(lines), args.batch_size):
+            outputs[name] += paraphrase_model.paraphrase(src_texts=lines[i:i + args.batch_size], rng=rng)
+        durations[name] = time.perf_counter() - start
+        if restricted_vocabulary_path:
+            vocabulary = paraphrase_model.vocabulary
+            tokenizer = paraphrase_model.tokenizer
+        del paraphrase_model
+
+    # Share of full-vocabulary outputs which could have been generated with the restricted vocabulary
+    full_token_ids = [
+        ids for tgt_texts in outputs["full"] for ids in tokenizer(tgt_texts, add_special_tokens=False)["input_ids"]
+    ]
+    report = {
+        "n_lines": len(lines),
+        "vocabulary_size": len(vocabulary),
+        "full_vocabulary_size": len(tokenizer),
+        "full_seconds_per_line": durations["full"] / len(lines),
+        "restricted_seconds_per_line": durations["restricted"] / len(lines),
+        "speedup": durations["full"] / durations["restricted"],
+        "lines_with_different_outputs": float(np.mean([full != restricted for full, restricted in zip(outputs["full"], outputs["restricted"])])),
+        "different_paraphrases": float(np.mean([
+            f != r
+            for full, restricted in zip(outputs["full"], outputs["restricted"])
+            for f, r in zip(full, restricted)
+        ])),
+        "full_output_tokens_in_vocabulary": vocabulary.share_of_known_tokens(np.array([token_id for ids in full_token_ids for token_id in ids])),
+        "full_outputs_in_vocabulary": float(np.mean([vocabulary.share_of_known_tokens(np.array(ids)) == 1 for ids in full_token_ids])),
+    }
+    logger.warning(json.dumps(report, indent=1))
+    if args.output_path:
+        with open(args.output_path, "w") as file:
+            json.dump(report, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import collections
+import json
+import logging
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+# Only loaded when the feature using them is invoked (USE embeddings, tensorboard logs, BLEU metrics, EDA).
+# sklearn is not listed: transformers imports `sklearn.metrics` at import time whenever it is installed
+DEFAULT_FORBIDDEN = ["tensorflow", "tensorflow_hub", "tensorboardX", "sacrebleu", "nltk"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", type=str, default="models.proto.protaugment", help="Entry point whose import is measured")
+    parser.add_argument("--budget-ms", type=float, default=6000, help="Max import time (best of --repeat fresh interpreters)")
+    parser.add_argument("--forbidden", type=str, action="append", help=f"Top-level package which must not be imported. Can be repeated (default: {DEFAULT_FORBIDDEN})")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of measures, the fastest one is kept")
+    parser.add_argument("--top", type=int, default=15, help="Number of top-level packages shown in the breakdown")
+    parser.add_argument("--output-path", type=str, help="If set, the report is also written there (.json)")
+    return parser.parse_args()
+
+
+def measure_import(module: str) -> Tuple[float, List[str], Dict[str, float]]:
+    """
+    Imports `module` in a fresh interpreter, with `-X importtime`.
+    :return: import duration (ms), imported modules, self import time (ms) of each top-level package
+    """
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(json.dumps({'ms': 1000 * (time.perf_counter() - start), 'modules': sorted(sys.modules)}))\n"
+    )
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{process.stderr[-2000:]}")
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+
+    # Lines look like `import time:  <self us> | <cumulative us> | <indented module name>`
+    package_ms = collections.defaultdict(float)
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        package_ms[name.strip().split(".")[0]] += int(self_us) / 1000
+    return result["ms"], result["modules"], dict(package_ms)
+
+
+def main():
+    args = parse_args()
+    forbidden = args.forbidden if args.forbidden else DEFAULT_FORBIDDEN
+
+    measures = [measure_import(args.module) for _ in range(args.repeat)]
+    import_ms, modules, package_ms = min(measures, key=lambda measure: measure[0])
+    loaded_forbidden = sorted({module.split(".")[0] for module in modules} & set(forbidden))
+
+    report = {
+        "module": args.module,
+        "import_ms": import_ms,
+        "budget_ms": args.budget_ms,
+        "all_import_ms": [measure[0] for measure in measures],
+        "slowest_packages_ms": dict(sorted(package_ms.items(), key=lambda item: -item[1])[:args.top]),
+        "forbidden_loaded": loaded_forbidden,
+    }
+    logger.warning(json.dumps(report, indent=1))
+    if args.output_path:
+        with open(args.output_path, "w") as file:
+            json.dump(report, file, indent=1)
+
+    if loaded_forbidden:
+        logger.error(f"Importing {args.module} loads {loaded_forbidden}")
+        sys.exit(1)
+    if import_ms > args.budget_ms:
+        logger.error(f"Importing {args.module} takes {import_ms:.0f}ms, over the {args.budget_ms:.0f}ms budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
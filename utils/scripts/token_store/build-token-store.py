@@ -0,0 +1,38 @@
+import argparse
+import logging
+
+from transformers import AutoTokenizer
+
+from utils.data import get_jsonl_data, get_txt_data
+from utils.token_store import TokenStore
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-path", type=str, action="append", default=[], help="Path to a .jsonl file with a `sentence` field (e.g. full.jsonl). Can be repeated.")
+    parser.add_argument("--unlabeled-path", type=str, action="append", default=[], help="Path to a .txt file, one sentence per line (e.g. raw.txt). Can be repeated.")
+    parser.add_argument("--tokenizer-name-or-path", type=str, action="append", required=True, help="Tokenizer to build a store for. Can be repeated.")
+    parser.add_argument("--output-path", type=str, required=True, help="Root of the token store. One sub-directory is created per tokenizer fingerprint.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    sentences = list()
+    for data_path in args.data_path:
+        sentences += [item["sentence"] for item in get_jsonl_data(data_path)]
+    for unlabeled_path in args.unlabeled_path:
+        sentences += get_txt_data(unlabeled_path)
+
+    for tokenizer_name_or_path in args.tokenizer_name_or_path:
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path)
+        store = TokenStore.build(args.output_path, tokenizer=tokenizer, sentences=sentences)
+        logger.warning(f"{tokenizer_name_or_path}: {len(store)} sentences, {len(store.ids)} tokens @ {store.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+#!/usr/bin/env bash
+
+paraphrase_tokenizer_name_or_path="facebook/bart-base"
+
+for dataset in BANKING77 HWU64 OOS Liu; do
+    PYTHONPATH=. python utils/scripts/token_store/build-token-store.py \
+        --data-path data/${dataset}/full.jsonl \
+        --unlabeled-path data/${dataset}/raw.txt \
+        --tokenizer-name-or-path transformer_models/${dataset}/fine-tuned \
+        --tokenizer-name-or-path ${paraphrase_tokenizer_name_or_path} \
+        --output-path data/${dataset}/token-store
+done
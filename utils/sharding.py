@@ -0,0 +1,107 @@
+import json
+import os
+import logging
+from typing import List, Dict, Tuple, Set
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def shard_range(n_items: int, n_shards: int, shard_ix: int, align: int = 1) -> Tuple[int, int]:
+    """
+    Contiguous slice of items of a shard. Shards are balanced, and their boundaries are multiples of `align` (e.g. a batch
+    size, so that sharding doesn't change batches).
+    :return: start (inclusive), end (exclusive)
+    """
+    assert 0 <= shard_ix < n_shards
+    n_chunks = (n_items + align - 1) // align
+    start = (shard_ix * n_chunks // n_shards) * align
+    end = min(((shard_ix + 1) * n_chunks // n_shards) * align, n_items)
+    return start, end
+
+
+def shard_path(shard_dir: str, shard_ix: int, n_shards: int) -> str:
+    return os.path.join(shard_dir, f"shard-{shard_ix:03d}-of-{n_shards:03d}.jsonl")
+
+
+class ShardWriter:
+    """
+    Appends records (dicts with an `ix` key) to a JSONL shard, as they are produced.
+    Re-opening an existing shard resumes it: complete records are kept (see `done`), a partially written last line
+    (e.g. after a crash) is dropped.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Set[int] = set()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        valid_size = 0
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        self.done.add(json.loads(line.decode("utf-8"))["ix"])
+                    except ValueError:
+                        break
+                    valid_size += len(line)
+            if valid_size < os.path.getsize(path):
+                logger.warning(f"Dropping partially written record at the end of {path}")
+            logger.info(f"Resuming {path}: {len(self.done)} records already written")
+
+        self.file = open(path, "ab")
+        self.file.truncate(valid_size)
+
+    def write_many(self, records: List[Dict]):
+        """
+        Writes and flushes `records` to disk, so that they survive a crash.
+        """
+        self.file.write("".join([json.dumps(record, ensure_ascii=False) + "\n" for record in records]).encode("utf-8"))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.done.update([record["ix"] for record in records])
+
+    def close(self):
+        self.file.close()
+
+
+def merge_shards(shard_paths: List[str], out_path: str, n_items: int = None):
+    """
+    Merges contiguous shards, given in order, into a single JSONL file, records being ordered by `ix` (which is dropped).
+    Shards are streamed one at a time: only the byte offset of each record of the current shard is held in memory.
+    The output is written to a temporary file first, then moved, so that it is either complete or missing.
+    :param n_items: if set, checks that records 0..n_items-1 are all present, once
+    """
+    tmp_path = f"{out_path}.tmp"
+    next_ix = 0
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as out_file:
+            for path in shard_paths:
+                # Records of a shard are written as they are produced, e.g. in length-sorted batches
+                offsets: Dict[int, int] = dict()
+                with open(path, "rb") as file:
+                    offset = 0
+                    for line in file:
+                        offsets[json.loads(line.decode("utf-8"))["ix"]] = offset
+                        offset += len(line)
+
+                    ixs = sorted(offsets.keys())
+                    if ixs and ixs != list(range(next_ix, next_ix + len(ixs))):
+                        raise ValueError(f"{path} doesn't hold records {next_ix}..{next_ix + len(ixs) - 1}: shards are incomplete or not in order")
+                    for ix in ixs:
+                        file.seek(offsets[ix])
+                        record = json.loads(file.readline().decode("utf-8"))
+                        record.pop("ix")
+                        out_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                next_ix += len(ixs)
+
+        if n_items is not None and next_ix != n_items:
+            raise ValueError(f"Shards hold {next_ix} records, expected {n_items}")
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, out_path)
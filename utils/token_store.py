@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import shutil
+import logging
+from typing import List, Dict
+
+import numpy as np
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Hash of everything that changes the ids a tokenizer outputs: its class, vocabulary, special tokens and casing.
+    """
+    h = hashlib.sha1()
+    h.update(type(tokenizer).__name__.encode("utf-8"))
+    h.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode("utf-8"))
+    h.update(json.dumps(tokenizer.all_special_tokens, ensure_ascii=False).encode("utf-8"))
+    h.update(json.dumps(tokenizer.init_kwargs.get("do_lower_case")).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def truncate_token_ids(token_ids: List[int], max_length: int = None) -> List[int]:
+    """
+    Truncates a sequence built with special tokens, keeping its last (end of sequence) token.
+    """
+    if max_length is None or len(token_ids) <= max_length:
+        return token_ids
+    return token_ids[:max_length - 1] + token_ids[-1:]
+
+
+class TokenStore:
+    """
+    Pre-tokenized sentences, for a given tokenizer.
+    On disk (<root>/<tokenizer fingerprint>/):
+        - ids.npy: token ids of all sentences, concatenated (memory-mapped)
+        - offsets.npy: sentence `i` spans ids[offsets[i]:offsets[i + 1]] (memory-mapped)
+        - sentences.json: sentences, in store order
+    Sentences are looked up by text: store order (unique sentences of full.jsonl and raw.txt) matches neither the rows
+    of an episode sampler nor generated paraphrases, which are only known as text.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        with open(os.path.join(path, "sentences.json"), "r", encoding="utf-8") as file:
+            sentences = json.load(file)
+        self.sentence_to_ix: Dict[str, int] = {sentence: ix for ix, sentence in enumerate(sentences)}
+        assert len(self.offsets) == len(sentences) + 1
+
+    @classmethod
+    def load(cls, root: str, tokenizer) -> "TokenStore":
+        path = os.path.join(root, tokenizer_fingerprint(tokenizer))
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No token store for this tokenizer @ {path}. Build it with utils/scripts/token_store/build-token-store.py")
+        logger.info(f"Loading token store @ {path}")
+        return cls(path)
+
+    @classmethod
+    def build(cls, root: str, tokenizer, sentences: List[str], batch_size: int = 1024) -> "TokenStore":
+        path = os.path.join(root, tokenizer_fingerprint(tokenizer))
+        sentences = list(dict.fromkeys(sentences))
+        logger.info(f"Tokenizing {len(sentences)} unique sentences to {path}")
+
+        ids = list()
+        offsets = [0]
+        for i in range(0, len(sentences), batch_size):
+            for token_ids in tokenizer(sentences[i:i + batch_size], add_special_tokens=True, truncation=False)["input_ids"]:
+                ids += token_ids
+                offsets.append(len(ids))
+
+        # Write to a temporary directory, then move it so that a store is either complete or missing
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "ids.npy"), np.array(ids, dtype=np.int32))
+        np.save(os.path.join(tmp_path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+        with open(os.path.join(tmp_path, "sentences.json"), "w", encoding="utf-8") as file:
+            json.dump(sentences, file, ensure_ascii=False)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+        return cls(path)
+
+    def __len__(self):
+        return len(self.sentence_to_ix)
+
+    def get(self, ix: int, max_length: int = None) -> List[int]:
+        return truncate_token_ids(self.ids[self.offsets[ix]:self.offsets[ix + 1]].tolist(), max_length=max_length)
+
+    def encode(self, sentences: List[str], tokenizer, max_length: int = None) -> List[List[int]]:
+        """
+        Token ids of `sentences`. Sentences missing from the store (e.g. generated paraphrases) are tokenized in one call.
+        """
+        out = [
+            self.get(self.sentence_to_ix[sentence], max_length=max_length) if sentence in self.sentence_to_ix else None
+            for sentence in sentences
+        ]
+        missing = [ix for ix, token_ids in enumerate(out) if token_ids is None]
+        if missing:
+            missing_ids = tokenizer(
+                [sentences[ix] for ix in missing],
+                add_special_tokens=True,
+                max_length=max_length,
+                truncation=max_length is not None
+            )["input_ids"]
+            for ix, token_ids in zip(missing, missing_ids):
+                out[ix] = token_ids
+        return out